@@ -1,5 +1,8 @@
 import telebot
-from telebot import types
+from telebot import types, apihelper
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sqlite3
 import json
 from datetime import datetime, date
@@ -7,8 +10,19 @@ import os
 import sys
 import logging
 import time
+import heapq
+import hashlib
+import hmac
 #import schedule
 import threading
+import asyncio
+import queue
+import atexit
+import functools
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,29 +30,912 @@ load_dotenv()
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Инициализация бота
-bot = telebot.TeleBot(str(os.getenv('BOT_TOKEN')))
+# Инициализация бота: обработчики вызываются из UpdateExecutor, а не из пула telebot
+bot = telebot.TeleBot(str(os.getenv('BOT_TOKEN')), threaded=False)
 
 # Список супер-администраторов (user_id)
 SUPER_ADMINS = [1310818613, 5054882870]
 # Список разрешенных пользователей
 ALLOWED_USER_IDS = [1310818613, 5054882870,5115418851]
+# Хранилище: sqlite (по умолчанию) или memory - всё в памяти, без сохранения между запусками
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
 DB_PATH = os.getenv('DB_PATH', 'attendance_bot.db')
+# Сколько секунд ждать снятия блокировки SQLite перед ошибкой "database is locked"
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+# Размер кэша подготовленных выражений на каждое соединение
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+# Групповой коммит: сколько ждать попутчиков для пачки записей (сек) и её предельный размер
+WRITE_BATCH_WINDOW = float(os.getenv('WRITE_BATCH_WINDOW', '0.002'))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '200'))
+# Как часто сбрасывать изменившиеся username в БД (сек)
+USERNAME_FLUSH_INTERVAL = float(os.getenv('USERNAME_FLUSH_INTERVAL', '5'))
+# Сколько профилей (user_id -> ФИО) держать в LRU-кэше
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+# Сколько секунд помнить ответ на нажатие inline-кнопки для повторных нажатий
+CALLBACK_RESULT_TTL = float(os.getenv('CALLBACK_RESULT_TTL', '60'))
+# Лимиты Telegram на отправку: сообщений в секунду всего и в один чат, в минуту в одну группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+# Сколько сообщений в чат можно отправить подряд, прежде чем включится TELEGRAM_CHAT_RATE
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_PER_MINUTE = float(os.getenv('TELEGRAM_GROUP_PER_MINUTE', '20'))
+# Ежедневная рассылка отчётов: сообщений в секунду (остальное - ответам пользователям)
+REPORT_SEND_RATE = float(os.getenv('REPORT_SEND_RATE', str(TELEGRAM_GLOBAL_RATE / 2)))
+# Сколько раз повторять запрос после ответа 429 (Too Many Requests)
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+# HTTP-сессия Bot API: размер пула keep-alive соединений, таймауты соединения и
+# ответа (сек), запас к таймауту long polling и число повторов при обрыве соединения
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '15'))
+HTTP_POLL_READ_MARGIN = float(os.getenv('HTTP_POLL_READ_MARGIN', '10'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+# Рассылка уведомлений администраторам: число параллельных отправок и предел очереди
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '8'))
+NOTIFY_MAX_PENDING = int(os.getenv('NOTIFY_MAX_PENDING', '1000'))
+# Outbox: попыток доставки до dead-letter, задержка между ними (сек), размер пачки,
+# как часто проверять очередь без новых сообщений (сек) и сколько дней хранить доставленные
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '2'))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '600'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+# Обработка обновлений: число потоков и предел очереди каждого из них
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+# Long polling: обновлений за один getUpdates (максимум Telegram - 100) и разбор
+# накопившейся очереди пачками с отбрасыванием избыточных обновлений при старте
+UPDATE_PAGE_SIZE = int(os.getenv('UPDATE_PAGE_SIZE', '100'))
+UPDATE_CATCH_UP = os.getenv('UPDATE_CATCH_UP', '1') == '1'
+# Транспорт: threaded (по умолчанию) или asyncio - приём обновлений и доставка outbox
+# на AsyncTeleBot (нужен aiohttp); обработчики в обоих случаях синхронные, в UpdateExecutor
+BOT_ENGINE = os.getenv('BOT_ENGINE', 'threaded')
+# asyncio-транспорт: потоков для обращений к хранилищу
+ASYNC_DB_WORKERS = int(os.getenv('ASYNC_DB_WORKERS', '4'))
+# Приём обновлений: polling (по умолчанию) или webhook - встроенный HTTP-сервер на порту контейнера
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес бота, например https://bot.amvera.io
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # по умолчанию выводится из токена
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '80'))
+# Сколько одновременных соединений Telegram может открыть к webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Предел тела запроса к webhook (байт): обновление от Telegram не больше нескольких килобайт
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(1024 * 1024)))
+# Живой отчёт: пауза после изменения перед правкой сообщения (сек) и предел
+# откладывания при непрерывных изменениях (сек)
+LIVE_REPORT_DEBOUNCE = float(os.getenv('LIVE_REPORT_DEBOUNCE', '3'))
+LIVE_REPORT_MAX_DELAY = float(os.getenv('LIVE_REPORT_MAX_DELAY', '15'))
+# Сводка уведомлений админам: окно накопления (сек) и события, которые уходят
+# сразу и заодно отправляют накопленное (added, removed, approval)
+DIGEST_WINDOW = float(os.getenv('DIGEST_WINDOW', '900'))
+DIGEST_URGENT_EVENTS = set(filter(None, os.getenv('DIGEST_URGENT_EVENTS', 'approval').split(',')))
+# Архив закрытых дней (подключается к основной БД как схема archive)
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH')  # по умолчанию <DB_PATH>_archive.db
+# Через сколько дней неподтверждённые причины "Другое" уходят в архив
+ARCHIVE_PENDING_DAYS = int(os.getenv('ARCHIVE_PENDING_DAYS', '7'))
 
 # ФУНКЦИЯ ПРОВЕРКИ ДОСТУПА
 def is_user_allowed(user_id):
     """Проверить, есть ли у пользователя доступ к боту"""
     return user_id in ALLOWED_USER_IDS
 
-class Database:
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite (одно соединение на поток)
+
+    Соединение открывается один раз при первом обращении из потока и
+    переиспользуется дальше: схема не разбирается заново, а подготовленные
+    выражения остаются в кэше соединения."""
+
+    def __init__(self, db_path, trace=None, attachments=None):
+        self.db_path = db_path
+        self.trace = trace  # callback для записи выполняемых SQL (см. explain_database_queries)
+        self.attachments = attachments or {}  # имя схемы -> путь к файлу БД
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connect(self, **kwargs):
+        """Открыть новое соединение с настройками для конкурентной работы"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT,  # busy_timeout
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            **kwargs
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for schema, path in self.attachments.items():
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+            conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def get_connection(self):
+        """Получить соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def cursor(self):
+        """Курсор на соединении потока: commit при успехе, rollback при ошибке
+
+        Предназначен для чтения; запись идёт через DatabaseWriter."""
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            yield c
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+    def close_all(self):
+        """Закрыть все открытые соединения"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.warning(f"⚠️ Ошибка закрытия соединения с БД: {e}")
+        self._local = threading.local()
+
+class DatabaseWriter:
+    """Единственный поток записи в SQLite с групповым коммитом
+
+    Обработчики кладут в очередь задания - функции, принимающие курсор, - и
+    получают Future с результатом. Поток забирает задания пачкой (всё, что
+    накопилось, плюс попутчиков в пределах WRITE_BATCH_WINDOW) и фиксирует их
+    одним COMMIT. Каждое задание выполняется в своей точке сохранения, поэтому
+    ошибка одного задания не откатывает остальные."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        """Поставить задание в очередь записи, вернуть Future"""
+        if self._stopped:
+            raise RuntimeError("Поток записи в БД остановлен")
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def queue_size(self):
+        """Количество заданий, ожидающих записи"""
+        return self._queue.qsize()
+
+    def stop(self, timeout=10):
+        """Дописать очередь и остановить поток"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        # Соединение записи принадлежит только этому потоку; транзакциями управляем сами
+        conn = self.pool.connect(isolation_level=None)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch, stop = self._collect_batch(item)
+                self._commit_batch(conn, batch)
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def _collect_batch(self, first):
+        """Собрать пачку заданий в пределах окна группового коммита"""
+        batch = [first]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit_batch(self, conn, batch):
+        """Выполнить пачку заданий одной транзакцией"""
+        c = conn.cursor()
+        outcomes = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                c.execute("SAVEPOINT job")
+                try:
+                    result = job(c)
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    outcomes.append((future, None, e))
+                else:
+                    c.execute("RELEASE job")
+                    outcomes.append((future, result, None))
+            c.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"❌ Ошибка группового коммита ({len(batch)} заданий): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            c.close()
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class StateStore:
+    """Состояния диалогов пользователей в памяти процесса
+
+    Проверка состояния в предикатах обработчиков - поиск в словаре без
+    запроса к БД и разбора JSON. Изменения сразу же записываются в таблицу
+    user_states (write-through), а при старте хранилище восстанавливается
+    из неё. Если запись не удалась, прежнее значение в памяти возвращается,
+    чтобы память не расходилась с таблицей."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+        # user_id -> номер последнего изменения, запись которого ещё не завершилась
+        self._pending = {}
+        self._changes = 0
+
+    def load(self, rows):
+        """Заполнить хранилище строками (user_id, state, data_json) из user_states"""
+        states = {}
+        for user_id, state, data_json in rows:
+            states[user_id] = (state, json.loads(data_json) if data_json else None)
+        with self._lock:
+            self._states = states
+
+    def get(self, user_id):
+        """Получить (state, data) пользователя"""
+        return self._states.get(user_id, (None, None))
+
+    def set(self, user_id, state, data, persist):
+        """Установить состояние и поставить запись в очередь под той же блокировкой
+
+        Блокировка гарантирует, что записи в БД идут в том же порядке,
+        что и изменения в памяти."""
+        return self._change(user_id, (state, data), persist)
+
+    def clear(self, user_id, persist):
+        """Удалить состояние пользователя"""
+        return self._change(user_id, None, persist)
+
+    def _change(self, user_id, value, persist):
+        with self._lock:
+            previous = self._states.get(user_id)
+            if value is None:
+                self._states.pop(user_id, None)
+            else:
+                self._states[user_id] = value
+            self._changes += 1
+            change = self._pending[user_id] = self._changes
+            written = persist()
+        # Ожидающий результата видит память уже после возможного отката
+        settled = Future()
+        written.add_done_callback(lambda done: self._settle(user_id, previous, change, done, settled))
+        return settled
+
+    def _settle(self, user_id, previous, change, written, settled):
+        """Запись завершилась: при ошибке вернуть прежнее значение, если его не сменили позже"""
+        error = written.exception()
+        with self._lock:
+            if self._pending.get(user_id) == change:
+                del self._pending[user_id]
+                if error is not None:
+                    if previous is None:
+                        self._states.pop(user_id, None)
+                    else:
+                        self._states[user_id] = previous
+                    logging.warning(f"⚠️ Состояние пользователя {user_id} не записано в БД, восстановлено прежнее")
+        if error is not None:
+            settled.set_exception(error)
+        else:
+            settled.set_result(written.result())
+
+    def __len__(self):
+        return len(self._states)
+
+class ProfileCache:
+    """LRU-кэш профилей пользователей (user_id -> ФИО) ограниченного размера
+
+    Хранится и отсутствие профиля (None), чтобы незарегистрированные
+    пользователи не приводили к запросу в БД на каждое сообщение. Записи
+    сбрасываются при регистрации и смене username."""
+
+    _MISSING = object()
+
+    def __init__(self, max_size=PROFILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        # Счётчик сбросов: результат чтения из БД, начатого до сброса, не кладём в кэш
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Вернуть ФИО из кэша или ProfileCache._MISSING"""
+        with self._lock:
+            value = self._items.get(user_id, self._MISSING)
+            if value is self._MISSING:
+                self.misses += 1
+            else:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+            return value
+
+    def epoch(self):
+        return self._epoch
+
+    def put(self, user_id, fio, epoch):
+        """Положить значение, прочитанное из БД при данном epoch"""
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._items[user_id] = fio
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._epoch += 1
+            self._items.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._items)
+
+class UsernameRegistry:
+    """Соответствие username -> user_id в памяти с отложенной записью
+
+    Сообщение с уже известным username ничего не пишет в БД. Реальные
+    изменения копятся в буфере и сбрасываются в таблицу usernames одной
+    пачкой по таймеру и при остановке."""
+
+    def __init__(self, flush):
+        self._ids = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush = flush  # принимает список (username, user_id) и записывает его
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def load(self, rows):
+        """Заполнить реестр строками (username, user_id) из таблицы usernames"""
+        with self._lock:
+            self._ids = dict(rows)
+
+    def get(self, username):
+        """Получить user_id по username (без учёта регистра)"""
+        return self._ids.get(username.lower())
+
+    def update(self, username, user_id):
+        """Запомнить username; вернуть True, если соответствие изменилось"""
+        username = username.lower()
+        with self._lock:
+            if self._ids.get(username) == user_id:
+                return False
+            self._ids[username] = user_id
+            self._pending[username] = user_id
+        return True
+
+    def flush(self):
+        """Записать накопленные изменения в БД"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self._flush(list(pending.items()))
+            logging.info(f"💾 Сохранено изменений username: {len(pending)}")
+        except Exception as e:
+            logging.error(f"❌ Ошибка сохранения username: {e}")
+            with self._lock:
+                # Возвращаем в буфер всё, что не успело смениться повторно
+                for username, user_id in pending.items():
+                    self._pending.setdefault(username, user_id)
+
+    def start(self, interval=USERNAME_FLUSH_INTERVAL):
+        """Запустить периодический сброс буфера"""
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name='usernames-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановить таймер и сбросить остаток буфера"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _run(self, interval):
+        while not self._stop_event.wait(interval):
+            self.flush()
+
+class GroupDirectory:
+    """Индекс групп и их администраторов в памяти
+
+    Хранит chat_id -> администраторы, admin_id -> группы и chat_id -> название.
+    Загружается один раз при старте и обновляется методами Database, которые
+    меняют group_admins и groups, поэтому проверки прав и рассылки по
+    администраторам не ходят в БД."""
+
+    def __init__(self):
+        self._admins = {}
+        self._groups = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def load(self, admin_rows, group_rows):
+        """Заполнить индекс строками (chat_id, admin_id) и (chat_id, name)"""
+        admins, groups = {}, {}
+        for chat_id, admin_id in admin_rows:
+            admins.setdefault(chat_id, set()).add(admin_id)
+            groups.setdefault(admin_id, set()).add(chat_id)
+        with self._lock:
+            self._admins, self._groups = admins, groups
+            self._names = dict(group_rows)
+
+    def admins_of(self, chat_id):
+        """Администраторы группы (по возрастанию ID)"""
+        return sorted(self._admins.get(chat_id, ()))
+
+    def groups_of(self, admin_id):
+        """Группы администратора: список (chat_id, name)"""
+        return [(chat_id, self._names.get(chat_id)) for chat_id in sorted(self._groups.get(admin_id, ()))]
+
+    def is_admin(self, chat_id, admin_id):
+        return admin_id in self._admins.get(chat_id, ())
+
+    def name_of(self, chat_id):
+        return self._names.get(chat_id)
+
+    def all_admins(self):
+        """Все пары (chat_id, name, admin_id) в порядке названия группы, как ORDER BY в SQLite"""
+        with self._lock:
+            rows = [(chat_id, self._names.get(chat_id), admin_id)
+                    for chat_id, admins in self._admins.items() for admin_id in admins]
+        return sorted(rows, key=lambda row: (row[1] is not None, row[1] or '', row[2]))
+
+    def add_admin(self, chat_id, admin_id):
+        with self._lock:
+            self._admins.setdefault(chat_id, set()).add(admin_id)
+            self._groups.setdefault(admin_id, set()).add(chat_id)
+
+    def remove_admin(self, chat_id, admin_id):
+        with self._lock:
+            self._admins.get(chat_id, set()).discard(admin_id)
+            self._groups.get(admin_id, set()).discard(chat_id)
+
+    def set_name(self, chat_id, name):
+        with self._lock:
+            self._names[chat_id] = name
+
+class Storage(ABC):
+    """Интерфейс хранилища бота
+
+    Обработчики работают только через эти методы. Реализации: Database
+    (SQLite) и MemoryDatabase (словари в памяти, для бенчмарков и
+    временных запусков); выбирается переменной STORAGE_BACKEND. Здесь же
+    общие для обеих части: индекс групп в памяти и подписчики на изменения
+    отсутствий. Методы интерфейса абстрактные: реализация, в которой какого-то
+    нет, не создаётся. Совместимость реализаций проверяет tests/test_storage.py."""
+
     def __init__(self):
+        self.groups = GroupDirectory()
+        # Подписчики на изменения данных дневного отчёта (см. add_absence_listener)
+        self._absence_listeners = []
+        # Подписчики на новые сообщения в outbox (см. add_outbox_listener)
+        self._outbox_listeners = []
+        # Режим уведомлений администраторов: admin_id -> 'digest' (по умолчанию 'instant')
+        self._notify_modes = {}
+
+    def close(self):
+        """Освободить ресурсы хранилища"""
+
+    def add_absence_listener(self, callback):
+        """Подписаться на изменения сегодняшних отсутствий
+
+        callback(group_chat_id) вызывается после фиксации изменения;
+        group_chat_id=None означает, что могли измениться данные любой группы."""
+        self._absence_listeners.append(callback)
+
+    def _absences_changed(self, group_chat_id=None):
+        for callback in self._absence_listeners:
+            try:
+                callback(group_chat_id)
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработчика изменения отсутствий: {e}")
+
+    def add_outbox_listener(self, callback):
+        """Подписаться на появление сообщений в outbox; callback() вызывается после фиксации"""
+        self._outbox_listeners.append(callback)
+
+    def _outbox_changed(self):
+        for callback in self._outbox_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработчика outbox: {e}")
+
+    @staticmethod
+    def _resolve_messages(messages, result):
+        """Сообщения для outbox: список или функция от результата операции (например, ID записи)"""
+        if messages is None:
+            return []
+        return list(messages(result) if callable(messages) else messages)
+
+    @staticmethod
+    def _retry_at(attempts):
+        """Когда повторить доставку после attempts неудачных попыток (экспоненциальная задержка)"""
+        return time.time() + min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+
+    @staticmethod
+    def _format_absence_row(fio, absence_type, reason, user_id):
+        """Форматировать причину и тип отсутствия для активных отсутствий"""
+        if reason == absence_type:  # Это активное отсутствие
+            reason = format_reason_for_report(reason)
+            absence_type = 'уважительно'
+        return (fio, absence_type, reason, user_id)
+
+    # Группы и их администраторы читаются из индекса в памяти
+    def get_group_admins(self, chat_id):
+        """Получить список администраторов конкретной группы"""
+        result = self.groups.admins_of(chat_id)
+        logging.debug(f"🔍 Администраторы группы {chat_id}: {result} (всего: {len(result)})")
+        return result
+
+    def is_group_admin(self, chat_id, admin_id):
+        """Проверить, является ли пользователь администратором группы"""
+        return self.groups.is_admin(chat_id, admin_id)
+
+    def get_admin_groups(self, admin_id):
+        """Получить все группы, где администратор имеет доступ"""
+        groups = self.groups.groups_of(admin_id)
+        logging.debug(f"🔍 Найдено {len(groups)} групп для администратора {admin_id}")
+        return groups
+
+    def get_all_group_admins(self):
+        """Получить всех администраторов групп с информацией о группах"""
+        return self.groups.all_admins()
+
+    def get_group_name(self, chat_id):
+        """Получить название группы"""
+        return self.groups.name_of(chat_id)
+
+    def get_notify_mode(self, admin_id):
+        """Режим уведомлений администратора: 'instant' или 'digest'"""
+        return self._notify_modes.get(admin_id, 'instant')
+
+    # Пакетные чтения; реализации могут заменить их одним запросом
+    def get_user_fios(self, user_ids):
+        """Получить ФИО сразу для нескольких пользователей: словарь user_id -> ФИО или None"""
+        return {user_id: self.get_user_fio(user_id) for user_id in dict.fromkeys(user_ids)}
+
+    def get_today_absences_for_groups(self, group_chat_ids):
+        """Получить отсутствия за сегодня сразу для нескольких групп: group_chat_id -> строки"""
+        return {group_chat_id: self.get_today_absences(group_chat_id)
+                for group_chat_id in dict.fromkeys(group_chat_ids)}
+
+    # Методы, которые реализует каждое хранилище
+    @abstractmethod
+    def set_user_state(self, user_id, state, data=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_state(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear_user_state(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_last_update_id(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_last_update_id(self, update_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_bot_state(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_bot_state(self, key, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_report_schedule(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_admin_report_time(self, admin_id, report_time):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_group_report_time(self, chat_id, report_time):
+        raise NotImplementedError
+
+    @abstractmethod
+    def register_user(self, user_id, fio):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_fio(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_username(self, username, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_id_by_username(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_absence(self, user_id, absence_type, reason="", group_chat_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_today_absences(self, group_chat_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_absence_from_today(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_admin(self, admin_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_admin_ids(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_admin(self, admin_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_group_admin(self, chat_id, admin_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_group_admin(self, chat_id, admin_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_pending_absence(self, user_id, reason, group_chat_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_pending_absence(self, pending_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_pending_absence(self, pending_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_active_absence(self, user_id, absence_type, message_id=None, chat_id=None, group_chat_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_active_absence(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_active_absence(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_active_absences(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def mark_absent(self, user_id, absence_type, reason, group_chat_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def start_active_absence(self, user_id, absence_type, group_chat_id=None, messages=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_active_absence_message(self, user_id, message_id, chat_id, absence_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def end_active_absence(self, user_id, messages=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def cancel_absence(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def submit_custom_reason(self, user_id, reason, group_chat_id=None, messages=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def approve_pending(self, pending_id, absence_type):
+        raise NotImplementedError
+
+    @abstractmethod
+    def archive_closed_days(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_group_month_stats(self, group_chat_id, month):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_month_stats(self, group_chat_id, month):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_pending_bind(self, chat_id, requester_id, group_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_activation_key(self, key, chat_id, target_admin_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_activation_key(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def use_activation_key(self, key, chat_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_group_name(self, chat_id, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def enqueue_messages(self, messages):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_due_messages(self, limit=OUTBOX_BATCH_SIZE):
+        raise NotImplementedError
+
+    @abstractmethod
+    def record_deliveries(self, outcomes):
+        raise NotImplementedError
+
+    @abstractmethod
+    def purge_outbox(self, days=OUTBOX_RETENTION_DAYS):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_live_report(self, group_chat_id, enabled):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_notify_mode(self, admin_id, mode):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_live_report_groups(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_live_report_message(self, group_chat_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_live_report_message(self, group_chat_id, report_date, message_id):
+        raise NotImplementedError
+
+class Database(Storage):
+    """Хранилище в SQLite (основное)"""
+
+    # Миграции схемы: (версия, описание, метод). Применяются по порядку и
+    # ровно один раз - применённые версии записываются в schema_version.
+    MIGRATIONS = [
+        (1, 'базовые таблицы', '_migration_base_schema'),
+        (2, 'колонки, добавленные в старых версиях бота', '_migration_legacy_columns'),
+        (3, 'индексы для частых запросов', '_migration_indexes'),
+        (4, 'уникальная пара (chat_id, admin_id) в group_admins', '_migration_unique_group_admins'),
+        (5, 'outbox исходящих сообщений', '_migration_outbox'),
+        (6, 'живой отчёт в закреплённом сообщении', '_migration_live_reports'),
+        (7, 'режим уведомлений администраторов', '_migration_notify_settings'),
+        (8, 'время ежедневного отчёта в группах', '_migration_group_report_times'),
+    ]
+
+    def __init__(self, db_path=DB_PATH, trace=None, archive_path=None):
+        archive_path = archive_path or (ARCHIVE_DB_PATH if db_path == DB_PATH else None) \
+            or f"{os.path.splitext(db_path)[0]}_archive.db"
+        self.pool = ConnectionPool(db_path, trace=trace, attachments={'archive': archive_path})
+        self.writer = DatabaseWriter(self.pool)
+        self.states = StateStore()
+        self.usernames = UsernameRegistry(self._save_usernames)
+        self.profiles = ProfileCache()
+        super().__init__()
         self.init_db()
+        self._load_states()
+        self._load_usernames()
+        self._load_groups()
+        self._load_notify_modes()
+        self.usernames.start()
+
+    def close(self):
+        """Дописать очередь записи и закрыть соединения"""
+        self.usernames.stop()
+        self.writer.stop()
+        self.pool.close_all()
+
+    def submit_write(self, job):
+        """Поставить задание записи в очередь; вернуть Future с его результатом"""
+        return self.writer.submit(job)
+
+    def _write(self, job):
+        """Выполнить задание записи и дождаться коммита"""
+        return self.writer.submit(job).result()
 
     def init_db(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
+        """Инициализация базы данных: применить недостающие миграции"""
+        self._write(self._apply_migrations)
+        # Архив - отдельный файл, который могли перенести или удалить, поэтому
+        # его таблицы проверяются при каждом старте, а не миграцией
+        self._write(self._create_archive_schema)
+
+    def _apply_migrations(self, c):
+        """Применить миграции новее текущей версии схемы одной транзакцией"""
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute("SELECT MAX(version) FROM schema_version")
+        current = c.fetchone()[0] or 0
+
+        for version, description, method_name in self.MIGRATIONS:
+            if version <= current:
+                continue
+            getattr(self, method_name)(c)
+            c.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                      (version, description))
+            logging.info(f"✅ Применена миграция {version}: {description}")
+
+    def _migration_base_schema(self, c):
+        """Создать таблицы, если их нет"""
         # Таблица пользователей
         c.execute('''CREATE TABLE IF NOT EXISTS users
                     (user_id INTEGER PRIMARY KEY,
@@ -131,157 +1028,288 @@ class Database:
                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                      used_at TIMESTAMP)''')
 
-        conn.commit()
-
-        # Миграция - добавляем колонки если их нет
-        self._migrate_db(c)
-        conn.commit()
-        conn.close()
-
-    def _migrate_db(self, cursor):
-        """Миграция БД - добавление недостающих колонок"""
-        try:
-            # Проверяем наличие таблицы и её колонок для active_absences
-            cursor.execute("PRAGMA table_info(active_absences)")
-            aa_columns = [col[1] for col in cursor.fetchall()]
-
-            if 'chat_id' not in aa_columns:
-                cursor.execute("ALTER TABLE active_absences ADD COLUMN chat_id INTEGER")
-                logging.info("✅ Добавлена колонка chat_id в таблицу active_absences")
-
-            if 'message_id' not in aa_columns:
-                cursor.execute("ALTER TABLE active_absences ADD COLUMN message_id INTEGER")
-                logging.info("✅ Добавлена колонка message_id в таблицу active_absences")
-
-            if 'group_chat_id' not in aa_columns:
-                cursor.execute("ALTER TABLE active_absences ADD COLUMN group_chat_id INTEGER")
-                logging.info("✅ Добавлена колонка group_chat_id в таблицу active_absences")
-
-            # Для absences
-            cursor.execute("PRAGMA table_info(absences)")
-            abs_columns = [col[1] for col in cursor.fetchall()]
-
-            if 'group_chat_id' not in abs_columns:
-                cursor.execute("ALTER TABLE absences ADD COLUMN group_chat_id INTEGER")
-                logging.info("✅ Добавлена колонка group_chat_id в таблицу absences")
-
-            # Для pending_binds
-            cursor.execute("PRAGMA table_info(pending_binds)")
-            pb_columns = [col[1] for col in cursor.fetchall()]
-
-            if 'group_name' not in pb_columns:
-                cursor.execute("ALTER TABLE pending_binds ADD COLUMN group_name TEXT")
-                logging.info("✅ Добавлена колонка group_name в таблицу pending_binds")
+    def _migration_legacy_columns(self, cursor):
+        """Добавить колонки, которых нет в БД, созданных старыми версиями бота"""
+        # Проверяем наличие таблицы и её колонок для active_absences
+        cursor.execute("PRAGMA table_info(active_absences)")
+        aa_columns = [col[1] for col in cursor.fetchall()]
+
+        if 'chat_id' not in aa_columns:
+            cursor.execute("ALTER TABLE active_absences ADD COLUMN chat_id INTEGER")
+            logging.info("✅ Добавлена колонка chat_id в таблицу active_absences")
+
+        if 'message_id' not in aa_columns:
+            cursor.execute("ALTER TABLE active_absences ADD COLUMN message_id INTEGER")
+            logging.info("✅ Добавлена колонка message_id в таблицу active_absences")
+
+        if 'group_chat_id' not in aa_columns:
+            cursor.execute("ALTER TABLE active_absences ADD COLUMN group_chat_id INTEGER")
+            logging.info("✅ Добавлена колонка group_chat_id в таблицу active_absences")
+
+        # Для absences
+        cursor.execute("PRAGMA table_info(absences)")
+        abs_columns = [col[1] for col in cursor.fetchall()]
+
+        if 'group_chat_id' not in abs_columns:
+            cursor.execute("ALTER TABLE absences ADD COLUMN group_chat_id INTEGER")
+            logging.info("✅ Добавлена колонка group_chat_id в таблицу absences")
+
+        # Для pending_binds
+        cursor.execute("PRAGMA table_info(pending_binds)")
+        pb_columns = [col[1] for col in cursor.fetchall()]
+
+        if 'group_name' not in pb_columns:
+            cursor.execute("ALTER TABLE pending_binds ADD COLUMN group_name TEXT")
+            logging.info("✅ Добавлена колонка group_name в таблицу pending_binds")
+
+        # Для pending_absences
+        cursor.execute("PRAGMA table_info(pending_absences)")
+        pa_columns = [col[1] for col in cursor.fetchall()]
+
+        if 'group_chat_id' not in pa_columns:
+            cursor.execute("ALTER TABLE pending_absences ADD COLUMN group_chat_id INTEGER")
+            logging.info("✅ Добавлена колонка group_chat_id в таблицу pending_absences")
+
+    def _migration_indexes(self, c):
+        """Индексы под запросы отчётов, прав администраторов и привязок"""
+        # Отчёт за день по группе и поиск записей пользователя за день
+        c.execute("CREATE INDEX IF NOT EXISTS idx_absences_date_group ON absences (date, group_chat_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_absences_user_date ON absences (user_id, date)")
+        # Группы администратора (покрывающий индекс для JOIN с groups)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_group_admins_admin ON group_admins (admin_id, chat_id)")
+        # Последний запрос на привязку группы
+        c.execute("CREATE INDEX IF NOT EXISTS idx_pending_binds_chat ON pending_binds (chat_id, requested_at)")
+        # Активные отсутствия группы
+        c.execute("CREATE INDEX IF NOT EXISTS idx_active_absences_group ON active_absences (group_chat_id)")
+
+    def _migration_unique_group_admins(self, c):
+        """Убрать дубли администраторов групп и запретить их уникальным индексом"""
+        c.execute('''DELETE FROM group_admins
+                     WHERE id NOT IN (SELECT MIN(id) FROM group_admins GROUP BY chat_id, admin_id)''')
+        if c.rowcount:
+            logging.info(f"🧹 Удалено дублирующихся записей group_admins: {c.rowcount}")
+        # Индекс также обслуживает выборку администраторов по chat_id
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_group_admins_chat_admin ON group_admins (chat_id, admin_id)")
+
+    def _migration_outbox(self, c):
+        """Очередь исходящих сообщений: пишется в одной транзакции с изменением данных"""
+        c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     chat_id INTEGER,
+                     text TEXT,
+                     options TEXT,
+                     kind TEXT,
+                     payload TEXT,
+                     dedup_key TEXT UNIQUE,
+                     status TEXT DEFAULT 'pending',
+                     attempts INTEGER DEFAULT 0,
+                     next_attempt_at REAL DEFAULT 0,
+                     last_error TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     finished_at TIMESTAMP)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+
+    def _migration_live_reports(self, c):
+        """Группы с живым отчётом и его сообщение за текущий день"""
+        c.execute('''CREATE TABLE IF NOT EXISTS live_reports
+                    (group_chat_id INTEGER PRIMARY KEY,
+                     enabled INTEGER DEFAULT 1,
+                     report_date TEXT,
+                     message_id INTEGER)''')
+
+    def _migration_notify_settings(self, c):
+        """Режим уведомлений администраторов (мгновенно или сводкой)"""
+        c.execute('''CREATE TABLE IF NOT EXISTS notify_settings
+                    (admin_id INTEGER PRIMARY KEY,
+                     mode TEXT)''')
+
+    def _migration_group_report_times(self, c):
+        """Время ежедневного отчёта в саму группу (у администраторов - admin_settings.report_time)"""
+        c.execute('''CREATE TABLE IF NOT EXISTS group_report_times
+                    (chat_id INTEGER PRIMARY KEY,
+                     report_time TEXT)''')
 
-            # Для pending_absences
-            cursor.execute("PRAGMA table_info(pending_absences)")
-            pa_columns = [col[1] for col in cursor.fetchall()]
+    def _create_archive_schema(self, c):
+        """Создать таблицы архива и месячных сводок, если их нет"""
+        # Закрытые дни из absences; id сохраняется, чтобы повторный перенос был безопасен
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.absences_archive
+                    (id INTEGER PRIMARY KEY,
+                     user_id INTEGER,
+                     absence_type TEXT,
+                     reason TEXT,
+                     date TEXT,
+                     month TEXT,
+                     group_chat_id INTEGER,
+                     created_at TIMESTAMP)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS archive.idx_absences_archive_month
+                     ON absences_archive (month, group_chat_id)''')
 
-            if 'group_chat_id' not in pa_columns:
-                cursor.execute("ALTER TABLE pending_absences ADD COLUMN group_chat_id INTEGER")
-                logging.info("✅ Добавлена колонка group_chat_id в таблицу pending_absences")
+        # Так и не подтверждённые причины "Другое"
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.pending_absences_archive
+                    (id INTEGER PRIMARY KEY,
+                     user_id INTEGER,
+                     reason TEXT,
+                     date TEXT,
+                     month TEXT,
+                     group_chat_id INTEGER,
+                     created_at TIMESTAMP)''')
 
-        except Exception as e:
-            logging.info(f"Миграция: {e} (возможно колонки уже существуют)")
+        # Сводки за месяц: по пользователю, по группе и по причине
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.rollup_user_month
+                    (month TEXT,
+                     user_id INTEGER,
+                     group_chat_id INTEGER,
+                     absence_type TEXT,
+                     days INTEGER,
+                     PRIMARY KEY (month, user_id, group_chat_id, absence_type))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.rollup_group_month
+                    (month TEXT,
+                     group_chat_id INTEGER,
+                     absence_type TEXT,
+                     absences INTEGER,
+                     users INTEGER,
+                     PRIMARY KEY (month, group_chat_id, absence_type))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS archive.rollup_reason_month
+                    (month TEXT,
+                     group_chat_id INTEGER,
+                     reason TEXT,
+                     absences INTEGER,
+                     PRIMARY KEY (month, group_chat_id, reason))''')
 
     # УПРАВЛЕНИЕ СОСТОЯНИЯМИ
+    def _load_states(self):
+        """Восстановить состояния пользователей из user_states"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT user_id, state, data FROM user_states")
+            rows = c.fetchall()
+        self.states.load(rows)
+        logging.info(f"📥 Загружено состояний пользователей: {len(self.states)}")
+
     def set_user_state(self, user_id, state, data=None):
         """Установить состояние пользователя"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
         data_json = json.dumps(data) if data else None
-        c.execute('''REPLACE INTO user_states (user_id, state, data)
-                     VALUES (?, ?, ?)''', (user_id, state, data_json))
-        conn.commit()
-        conn.close()
+        # В памяти храним то же, что вернётся после чтения из БД
+        data = json.loads(data_json) if data_json else None
+
+        def job(c):
+            c.execute('''REPLACE INTO user_states (user_id, state, data)
+                         VALUES (?, ?, ?)''', (user_id, state, data_json))
+        self.states.set(user_id, state, data, lambda: self.submit_write(job)).result()
 
     def get_user_state(self, user_id):
         """Получить состояние пользователя"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT state, data FROM user_states WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        conn.close()
-        if result:
-            data = json.loads(result[1]) if result[1] else None
-            return result[0], data
-        return None, None
+        return self.states.get(user_id)
 
     def clear_user_state(self, user_id):
         """Очистить состояние пользователя"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        def job(c):
+            c.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        self.states.clear(user_id, lambda: self.submit_write(job)).result()
 
     def get_last_update_id(self):
         """Получить последний обработанный update_id"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT value FROM bot_state WHERE key = 'last_update_id'")
-        result = c.fetchone()
-        conn.close()
+        with self.pool.cursor() as c:
+            c.execute("SELECT value FROM bot_state WHERE key = 'last_update_id'")
+            result = c.fetchone()
         return int(result[0]) if result else 0
 
     def save_last_update_id(self, update_id):
         """Сохранить последний update_id"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("REPLACE INTO bot_state (key, value) VALUES ('last_update_id', ?)",
-                 (str(update_id),))
-        conn.commit()
-        conn.close()
+        def job(c):
+            c.execute("REPLACE INTO bot_state (key, value) VALUES ('last_update_id', ?)",
+                     (str(update_id),))
+        self._write(job)
+
+    def get_bot_state(self, key):
+        """Получить служебное значение из bot_state (строка или None)"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+            result = c.fetchone()
+        return result[0] if result else None
+
+    def set_bot_state(self, key, value):
+        """Сохранить служебное значение в bot_state"""
+        def job(c):
+            c.execute("REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, str(value)))
+        self._write(job)
 
     def register_user(self, user_id, fio):
         """Зарегистрировать пользователя с ФИО"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+        def job(c):
             c.execute('''REPLACE INTO users (user_id, fio)
                          VALUES (?, ?)''', (user_id, fio))
-            conn.commit()
+
+        try:
+            self._write(job)
+            self.profiles.invalidate(user_id)
+            # ФИО выводится в отчётах
+            self._absences_changed()
             print(f"✅ База: user_id={user_id}, fio={fio}")
         except Exception as e:
             print(f"❌ Ошибка базы: {e}")
             raise
-        finally:
-            conn.close()
 
     def get_user_fio(self, user_id):
         """Получить ФИО пользователя"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT fio FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        conn.close()
-        return result[0] if result else None
+        fio = self.profiles.get(user_id)
+        if fio is not ProfileCache._MISSING:
+            return fio
+        epoch = self.profiles.epoch()
+        with self.pool.cursor() as c:
+            c.execute("SELECT fio FROM users WHERE user_id = ?", (user_id,))
+            result = c.fetchone()
+        fio = result[0] if result else None
+        self.profiles.put(user_id, fio, epoch)
+        return fio
+
+    def get_user_fios(self, user_ids):
+        """Получить ФИО сразу для нескольких пользователей: словарь user_id -> ФИО или None
+
+        Недостающие в кэше профили читаются одним запросом (пачками по 500,
+        чтобы не упереться в лимит параметров SQLite)."""
+        result, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            fio = self.profiles.get(user_id)
+            if fio is ProfileCache._MISSING:
+                missing.append(user_id)
+            else:
+                result[user_id] = fio
+        if not missing:
+            return result
+
+        epoch = self.profiles.epoch()
+        found = {}
+        with self.pool.cursor() as c:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                c.execute(f"SELECT user_id, fio FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk)
+                found.update(c.fetchall())
+        for user_id in missing:
+            result[user_id] = found.get(user_id)
+            self.profiles.put(user_id, result[user_id], epoch)
+        return result
 
     def add_absence(self, user_id, absence_type, reason="", group_chat_id=None):
         """Добавить запись об отсутствии"""
         today = date.today().isoformat()
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        # Удаляем старую запись на сегодня (если есть)
-        c.execute('''DELETE FROM absences
-                     WHERE user_id = ? AND date = ? AND group_chat_id = ?''',
-                     (user_id, today, group_chat_id))
 
-        # Добавляем новую запись
-        c.execute('''INSERT INTO absences
-                     (user_id, absence_type, reason, date, group_chat_id)
-                     VALUES (?, ?, ?, ?, ?)''',
-                     (user_id, absence_type, reason, today, group_chat_id))
+        def job(c):
+            # Удаляем старую запись на сегодня (если есть)
+            c.execute('''DELETE FROM absences
+                         WHERE user_id = ? AND date = ? AND group_chat_id = ?''',
+                         (user_id, today, group_chat_id))
 
-        conn.commit()
-        conn.close()
+            # Добавляем новую запись
+            c.execute('''INSERT INTO absences
+                         (user_id, absence_type, reason, date, group_chat_id)
+                         VALUES (?, ?, ?, ?, ?)''',
+                         (user_id, absence_type, reason, today, group_chat_id))
+        self._write(job)
+        self._absences_changed(group_chat_id)
 
     def get_today_absences(self, group_chat_id=None):
         """Получить отсутствия за сегодня для конкретной группы"""
         today = date.today().isoformat()
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
 
         # Основной запрос для обычных отсутствий
         absences_query = '''SELECT u.fio, a.absence_type, a.reason, a.user_id
@@ -312,227 +1340,1372 @@ class Database:
         full_query = f"{absences_query} UNION ALL {active_query}"
         full_params = absences_params + active_params
 
-        c.execute(full_query, full_params)
-        result = c.fetchall()
+        with self.pool.cursor() as c:
+            c.execute(full_query, full_params)
+            result = c.fetchall()
+
+        return [self._format_absence_row(*row) for row in result]
 
-        # Форматируем причину и тип отсутствия для активных отсутствий
-        formatted_result = []
-        for fio, absence_type, reason, user_id in result:
-            if reason == absence_type:  # Это активное отсутствие
-                reason = format_reason_for_report(reason)
-                absence_type = 'уважительно'
-            formatted_result.append((fio, absence_type, reason, user_id))
+    def get_today_absences_for_groups(self, group_chat_ids):
+        """Получить отсутствия за сегодня сразу для нескольких групп
 
-        conn.close()
-        return formatted_result
+        Один запрос на все группы (пачками по 400, чтобы не упереться в лимит
+        параметров SQLite). Возвращает словарь group_chat_id -> список строк
+        в формате get_today_absences; у групп без отсутствующих список пустой."""
+        group_chat_ids = list(dict.fromkeys(group_chat_ids))
+        result = {group_chat_id: [] for group_chat_id in group_chat_ids}
+        today = date.today().isoformat()
+
+        with self.pool.cursor() as c:
+            for start in range(0, len(group_chat_ids), 400):
+                chunk = group_chat_ids[start:start + 400]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f'''SELECT a.group_chat_id, u.fio, a.absence_type, a.reason, a.user_id
+                               FROM absences a
+                               LEFT JOIN users u ON a.user_id = u.user_id
+                               WHERE a.date = ? AND a.group_chat_id IN ({placeholders})
+                               UNION ALL
+                               SELECT aa.group_chat_id, u.fio, aa.absence_type, aa.absence_type, aa.user_id
+                               FROM active_absences aa
+                               LEFT JOIN users u ON aa.user_id = u.user_id
+                               WHERE aa.group_chat_id IN ({placeholders})''',
+                          [today, *chunk, *chunk])
+                for group_chat_id, *row in c.fetchall():
+                    result[group_chat_id].append(self._format_absence_row(*row))
+        return result
 
     def set_admin(self, admin_id):
         """Добавить администратора"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+        def job(c):
             c.execute("INSERT OR IGNORE INTO admin_settings (admin_id) VALUES (?)", (admin_id,))
-            conn.commit()
+
+        try:
+            self._write(job)
         except Exception as e:
             print(f"Ошибка добавления админа: {e}")
-        finally:
-            conn.close()
 
     def get_admin_ids(self):
         """Получить список всех администраторов"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT admin_id FROM admin_settings")
-        result = [row[0] for row in c.fetchall()]
-        conn.close()
+        with self.pool.cursor() as c:
+            c.execute("SELECT admin_id FROM admin_settings")
+            result = [row[0] for row in c.fetchall()]
         logging.info(f"🔍 Получены администраторы из БД: {result} (всего: {len(result)})")
         return result
 
-    def get_group_admins(self, chat_id):
-        """Получить список администраторов конкретной группы"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT admin_id FROM group_admins WHERE chat_id = ?", (chat_id,))
-        result = [row[0] for row in c.fetchall()]
-        conn.close()
-        logging.info(f"🔍 Администраторы группы {chat_id}: {result} (всего: {len(result)})")
-        return result
+    def get_report_schedule(self):
+        """Расписание ежедневных отчётов: список ('admin' | 'group', ID, 'ЧЧ:ММ')"""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT 'admin', admin_id, report_time FROM admin_settings WHERE report_time IS NOT NULL
+                         UNION ALL
+                         SELECT 'group', chat_id, report_time FROM group_report_times''')
+            return c.fetchall()
+
+    def set_admin_report_time(self, admin_id, report_time):
+        """Установить время ежедневного отчёта администратора (добавляет его в admin_settings)"""
+        def job(c):
+            c.execute('''INSERT INTO admin_settings (admin_id, report_time) VALUES (?, ?)
+                         ON CONFLICT(admin_id) DO UPDATE SET report_time = excluded.report_time''',
+                      (admin_id, report_time))
+        self._write(job)
+
+    def set_group_report_time(self, chat_id, report_time):
+        """Установить время ежедневного отчёта в группу; None - не отправлять"""
+        def job(c):
+            if report_time is None:
+                c.execute("DELETE FROM group_report_times WHERE chat_id = ?", (chat_id,))
+            else:
+                c.execute("REPLACE INTO group_report_times (chat_id, report_time) VALUES (?, ?)",
+                          (chat_id, report_time))
+        self._write(job)
+
+    def _load_groups(self):
+        """Загрузить индекс групп и администраторов в память"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT chat_id, admin_id FROM group_admins")
+            admin_rows = c.fetchall()
+            c.execute("SELECT chat_id, name FROM groups")
+            group_rows = c.fetchall()
+        self.groups.load(admin_rows, group_rows)
+        logging.info(f"📥 Загружено групп: {len(group_rows)}, связей с администраторами: {len(admin_rows)}")
+
+    def _load_notify_modes(self):
+        """Загрузить режимы уведомлений администраторов в память"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT admin_id, mode FROM notify_settings")
+            self._notify_modes = dict(c.fetchall())
+
+    def set_notify_mode(self, admin_id, mode):
+        """Сохранить режим уведомлений администратора ('instant' или 'digest')"""
+        def job(c):
+            c.execute('''INSERT INTO notify_settings (admin_id, mode) VALUES (?, ?)
+                         ON CONFLICT(admin_id) DO UPDATE SET mode = excluded.mode''', (admin_id, mode))
+        self._write(job)
+        self._notify_modes[admin_id] = mode
 
     def add_group_admin(self, chat_id, admin_id):
         """Добавить администратора к группе"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
-            c.execute('''INSERT INTO group_admins
+        def job(c):
+            c.execute('''INSERT OR IGNORE INTO group_admins
                          (chat_id, admin_id)
                          VALUES (?, ?)''', (chat_id, admin_id))
-            conn.commit()
+
+        try:
+            self._write(job)
+            self.groups.add_admin(chat_id, admin_id)
             logging.info(f"✅ Администратор {admin_id} добавлен к группе {chat_id}")
             return True
         except Exception as e:
             logging.error(f"❌ Ошибка добавления администратора {admin_id} к группе {chat_id}: {e}")
             return False
-        finally:
-            conn.close()
-
-    def get_admin_groups(self, admin_id):
-        """Получить все группы, где администратор имеет доступ"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
-            c.execute('''SELECT g.chat_id, g.name
-                        FROM group_admins ga
-                        LEFT JOIN groups g ON ga.chat_id = g.chat_id
-                        WHERE ga.admin_id = ?''', (admin_id,))
-            groups = c.fetchall()
-            logging.info(f"🔍 Найдено {len(groups)} групп для администратора {admin_id}")
-            return groups
-        finally:
-            conn.close()
 
     def remove_group_admin(self, chat_id, admin_id):
         """Удалить администратора из группы"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+        def job(c):
             c.execute('''DELETE FROM group_admins WHERE chat_id = ? AND admin_id = ?''', (chat_id, admin_id))
-            conn.commit()
+
+        try:
+            self._write(job)
+            self.groups.remove_admin(chat_id, admin_id)
             logging.info(f"✅ Администратор {admin_id} удален из группы {chat_id}")
             return True
         except Exception as e:
             logging.error(f"❌ Ошибка удаления администратора {admin_id} из группы {chat_id}: {e}")
             return False
-        finally:
-            conn.close()
-
-    def get_all_group_admins(self):
-        """Получить всех администраторов групп с информацией о группах"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
-            c.execute('''SELECT g.chat_id, g.name, ga.admin_id
-                        FROM group_admins ga
-                        LEFT JOIN groups g ON ga.chat_id = g.chat_id
-                        ORDER BY g.name, ga.admin_id''')
-            result = c.fetchall()
-            return result
-        finally:
-            conn.close()
 
     def remove_admin(self, admin_id):
         """Удалить администратора"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM admin_settings WHERE admin_id = ?", (admin_id,))
-        conn.commit()
-        conn.close()
+        def job(c):
+            c.execute("DELETE FROM admin_settings WHERE admin_id = ?", (admin_id,))
+        self._write(job)
+
+    def _load_usernames(self):
+        """Загрузить соответствия username -> user_id в память"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT username, user_id FROM usernames")
+            rows = c.fetchall()
+        self.usernames.load(rows)
+        logging.info(f"📥 Загружено username: {len(rows)}")
+
+    def _save_usernames(self, items):
+        """Записать пачку (username, user_id) одной транзакцией"""
+        def job(c):
+            c.executemany("REPLACE INTO usernames (username, user_id) VALUES (?, ?)", items)
+        self._write(job)
 
     def update_username(self, username, user_id):
-        """Обновить username -> user_id"""
-        if username:
+        """Обновить username -> user_id; вернуть True, если соответствие изменилось
+
+        Запись в БД отложенная: изменения сбрасываются пачкой по таймеру."""
+        if not username:
+            return False
+        changed = self.usernames.update(username, user_id)
+        if changed:
+            self.profiles.invalidate(user_id)
             logging.info(f"Обновляем username: {username.lower()} для user_id: {user_id}")
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("REPLACE INTO usernames (username, user_id) VALUES (?, ?)", (username.lower(), user_id))
-            conn.commit()
-            conn.close()
+        return changed
 
     def get_user_id_by_username(self, username):
         """Получить user_id по username"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM usernames WHERE username = ?", (username.lower(),))
-        result = c.fetchone()
-        conn.close()
-        return result[0] if result else None
+        return self.usernames.get(username)
 
     def add_pending_absence(self, user_id, reason, group_chat_id=None):
         """Добавить ожидающую подтверждения причину"""
         today = date.today().isoformat()
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''INSERT INTO pending_absences (user_id, reason, date, group_chat_id)
-                     VALUES (?, ?, ?, ?)''', (user_id, reason, today, group_chat_id))
-        conn.commit()
-        conn.close()
-        return c.lastrowid
+
+        def job(c):
+            c.execute('''INSERT INTO pending_absences (user_id, reason, date, group_chat_id)
+                         VALUES (?, ?, ?, ?)''', (user_id, reason, today, group_chat_id))
+            return c.lastrowid
+        return self._write(job)
 
     def get_pending_absence(self, pending_id):
         """Получить ожидающую причину по ID"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT pa.id, pa.user_id, pa.reason, pa.date, pa.group_chat_id, pa.created_at, u.fio
-                     FROM pending_absences pa
-                     LEFT JOIN users u ON pa.user_id = u.user_id
-                     WHERE pa.id = ?''', (pending_id,))
-        result = c.fetchone()
-        conn.close()
-        return result
+        with self.pool.cursor() as c:
+            c.execute('''SELECT pa.id, pa.user_id, pa.reason, pa.date, pa.group_chat_id, pa.created_at, u.fio
+                         FROM pending_absences pa
+                         LEFT JOIN users u ON pa.user_id = u.user_id
+                         WHERE pa.id = ?''', (pending_id,))
+            return c.fetchone()
 
     def delete_pending_absence(self, pending_id):
         """Удалить ожидающую причину"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''DELETE FROM pending_absences WHERE id = ?''', (pending_id,))
-        conn.commit()
-        conn.close()
+        def job(c):
+            c.execute('''DELETE FROM pending_absences WHERE id = ?''', (pending_id,))
+        self._write(job)
 
     def add_active_absence(self, user_id, absence_type, message_id=None, chat_id=None, group_chat_id=None):
         """Добавить пользователя в список текущих отсутствующих (Болею/Отпуск)"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+        def job(c):
             c.execute('''REPLACE INTO active_absences
                         (user_id, absence_type, message_id, chat_id, group_chat_id)
                         VALUES (?, ?, ?, ?, ?)''',
                         (user_id, absence_type, message_id, chat_id, group_chat_id))
-            conn.commit()
-        finally:
-            conn.close()
+        self._write(job)
+        self._absences_changed()
 
     def remove_active_absence(self, user_id):
         """Удалить пользователя из списка текущих отсутствующих"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+        def job(c):
             c.execute('''DELETE FROM active_absences WHERE user_id = ?''', (user_id,))
-            conn.commit()
-        finally:
-            conn.close()
+        self._write(job)
+        self._absences_changed()
 
     def remove_absence_from_today(self, user_id):
         """Удалить отсутствие пользователя из сегодняшних отсутствий"""
         today = date.today().isoformat()
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        try:
+
+        def job(c):
             c.execute('''DELETE FROM absences WHERE user_id = ? AND date = ?''', (user_id, today))
-            conn.commit()
-        finally:
-            conn.close()
+        self._write(job)
+        self._absences_changed()
 
     def get_active_absence(self, user_id):
         """Получить информацию об активном отсутствии пользователя"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT id, user_id, absence_type, message_id, chat_id, group_chat_id FROM active_absences WHERE user_id = ?''', (user_id,))
-        result = c.fetchone()
-        conn.close()
-        return result
+        with self.pool.cursor() as c:
+            c.execute('''SELECT id, user_id, absence_type, message_id, chat_id, group_chat_id FROM active_absences WHERE user_id = ?''', (user_id,))
+            return c.fetchone()
 
     def get_all_active_absences(self):
         """Получить всех людей в списке отсутствующих"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT aa.user_id, aa.absence_type, u.fio
-                    FROM active_absences aa
-                    LEFT JOIN users u ON aa.user_id = u.user_id''')
-        result = c.fetchall()
-        conn.close()
-        return result
+        with self.pool.cursor() as c:
+            c.execute('''SELECT aa.user_id, aa.absence_type, u.fio
+                        FROM active_absences aa
+                        LEFT JOIN users u ON aa.user_id = u.user_id''')
+            return c.fetchall()
+
+    # АТОМАРНЫЕ ОПЕРАЦИИ С ОТСУТСТВИЯМИ
+    # Каждая операция - одна транзакция: прервавшись на середине, она не
+    # оставит пользователя одновременно активным и без записи.
+
+    def _write_clearing_state(self, user_id, job):
+        """Выполнить задание записи и в той же транзакции очистить состояние пользователя"""
+        def full_job(c):
+            result = job(c)
+            c.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+            return result
+        return self.states.clear(user_id, lambda: self.submit_write(full_job)).result()
+
+    def mark_absent(self, user_id, absence_type, reason, group_chat_id=None):
+        """Заменить сегодняшние отметки пользователя новым отсутствием и очистить состояние"""
+        today = date.today().isoformat()
+
+        def job(c):
+            c.execute('''DELETE FROM absences WHERE user_id = ? AND date = ?''', (user_id, today))
+            c.execute('''DELETE FROM active_absences WHERE user_id = ?''', (user_id,))
+            c.execute('''INSERT INTO absences
+                         (user_id, absence_type, reason, date, group_chat_id)
+                         VALUES (?, ?, ?, ?, ?)''',
+                         (user_id, absence_type, reason, today, group_chat_id))
+        self._write_clearing_state(user_id, job)
+        self._absences_changed()
+
+    def start_active_absence(self, user_id, absence_type, group_chat_id=None, messages=None):
+        """Начать активное отсутствие (Болею/Отпуск) вместо сегодняшних отметок и очистить состояние
+
+        messages - сообщения для outbox (или функция от ID активного отсутствия),
+        они ставятся в очередь той же транзакцией. Сообщение с кнопкой 'Выхожу'
+        привязывается после доставки через set_active_absence_message.
+        Возвращает ID активного отсутствия."""
+        today = date.today().isoformat()
+        queued = []
+
+        def job(c):
+            c.execute('''DELETE FROM absences WHERE user_id = ? AND date = ?''', (user_id, today))
+            c.execute('''REPLACE INTO active_absences
+                        (user_id, absence_type, message_id, chat_id, group_chat_id)
+                        VALUES (?, ?, NULL, NULL, ?)''',
+                        (user_id, absence_type, group_chat_id))
+            absence_id = c.lastrowid
+            queued[:] = self._enqueue(c, self._resolve_messages(messages, absence_id))
+            return absence_id
+        absence_id = self._write_clearing_state(user_id, job)
+        self._absences_changed()
+        if queued:
+            self._outbox_changed()
+        return absence_id
+
+    def set_active_absence_message(self, user_id, message_id, chat_id, absence_id=None):
+        """Запомнить сообщение с кнопкой 'Выхожу' для активного отсутствия
+
+        Если указан absence_id, сообщение привязывается только к этому
+        отсутствию (а не к начатому позже)."""
+        def job(c):
+            if absence_id is None:
+                c.execute('''UPDATE active_absences SET message_id = ?, chat_id = ?
+                             WHERE user_id = ?''', (message_id, chat_id, user_id))
+            else:
+                c.execute('''UPDATE active_absences SET message_id = ?, chat_id = ?
+                             WHERE user_id = ? AND id = ?''', (message_id, chat_id, user_id, absence_id))
+        self._write(job)
+
+    def end_active_absence(self, user_id, messages=None):
+        """Завершить активное отсутствие и убрать сегодняшние отметки
+
+        messages - сообщения для outbox или функция от записи отсутствия.
+        Возвращает запись активного отсутствия (как get_active_absence)
+        или None, если пользователь не отсутствовал."""
+        today = date.today().isoformat()
+        queued = []
+
+        def job(c):
+            c.execute('''SELECT id, user_id, absence_type, message_id, chat_id, group_chat_id
+                         FROM active_absences WHERE user_id = ?''', (user_id,))
+            absence = c.fetchone()
+            if absence is None:
+                return None
+            c.execute('''DELETE FROM active_absences WHERE user_id = ?''', (user_id,))
+            c.execute('''DELETE FROM absences WHERE user_id = ? AND date = ?''', (user_id, today))
+            queued[:] = self._enqueue(c, self._resolve_messages(messages, absence))
+            return absence
+        absence = self._write(job)
+        if absence is not None:
+            self._absences_changed()
+        if queued:
+            self._outbox_changed()
+        return absence
+
+    def cancel_absence(self, user_id):
+        """Удалить сегодняшние отметки и активное отсутствие пользователя"""
+        today = date.today().isoformat()
+
+        def job(c):
+            c.execute('''DELETE FROM absences WHERE user_id = ? AND date = ?''', (user_id, today))
+            c.execute('''DELETE FROM active_absences WHERE user_id = ?''', (user_id,))
+        self._write(job)
+        self._absences_changed()
+
+    def submit_custom_reason(self, user_id, reason, group_chat_id=None, messages=None):
+        """Отправить причину 'Другое' на подтверждение и очистить состояние; вернуть ID запроса
+
+        messages - сообщения для outbox или функция от ID запроса."""
+        today = date.today().isoformat()
+        queued = []
+
+        def job(c):
+            c.execute('''INSERT INTO pending_absences (user_id, reason, date, group_chat_id)
+                         VALUES (?, ?, ?, ?)''', (user_id, reason, today, group_chat_id))
+            pending_id = c.lastrowid
+            queued[:] = self._enqueue(c, self._resolve_messages(messages, pending_id))
+            return pending_id
+        pending_id = self._write_clearing_state(user_id, job)
+        if queued:
+            self._outbox_changed()
+        return pending_id
+
+    def approve_pending(self, pending_id, absence_type):
+        """Утвердить причину: записать отсутствие и удалить запрос
+
+        Возвращает запись запроса (как get_pending_absence) или None,
+        если запрос уже обработан."""
+        today = date.today().isoformat()
+
+        def job(c):
+            c.execute('''SELECT pa.id, pa.user_id, pa.reason, pa.date, pa.group_chat_id, pa.created_at, u.fio
+                         FROM pending_absences pa
+                         LEFT JOIN users u ON pa.user_id = u.user_id
+                         WHERE pa.id = ?''', (pending_id,))
+            pending = c.fetchone()
+            if pending is None:
+                return None
+            user_id, reason, group_chat_id = pending[1], pending[2], pending[4]
+            c.execute('''DELETE FROM absences
+                         WHERE user_id = ? AND date = ? AND group_chat_id = ?''',
+                         (user_id, today, group_chat_id))
+            c.execute('''INSERT INTO absences
+                         (user_id, absence_type, reason, date, group_chat_id)
+                         VALUES (?, ?, ?, ?, ?)''',
+                         (user_id, absence_type, reason, today, group_chat_id))
+            c.execute('''DELETE FROM pending_absences WHERE id = ?''', (pending_id,))
+            return pending
+        pending = self._write(job)
+        if pending is not None:
+            self._absences_changed(pending[4])
+        return pending
+
+    # OUTBOX ИСХОДЯЩИХ СООБЩЕНИЙ
+    def _enqueue(self, c, messages):
+        """Поставить сообщения в outbox в текущей транзакции; вернуть добавленные
+
+        Сообщение с уже известным dedup_key пропускается. not_before - не
+        отправлять раньше этого времени (time.time()); flush_digest - отправить
+        накопленную сводку получателя сейчас же."""
+        queued = []
+        for message in messages:
+            c.execute('''INSERT OR IGNORE INTO outbox (chat_id, text, options, kind, payload, dedup_key, next_attempt_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (message['chat_id'], message['text'], json.dumps(message.get('options') or {}),
+                          message.get('kind'), json.dumps(message.get('payload') or {}), message.get('dedup_key'),
+                          message.get('not_before', 0)))
+            if c.rowcount:
+                queued.append(message)
+                if message.get('flush_digest'):
+                    c.execute('''UPDATE outbox SET next_attempt_at = 0
+                                 WHERE chat_id = ? AND kind = 'digest' AND status = 'pending' ''',
+                              (message['chat_id'],))
+        return queued
+
+    def enqueue_messages(self, messages):
+        """Поставить сообщения в outbox отдельной транзакцией; вернуть число добавленных"""
+        queued = self._write(lambda c: self._enqueue(c, messages))
+        if queued:
+            self._outbox_changed()
+        return len(queued)
+
+    def get_due_messages(self, limit=OUTBOX_BATCH_SIZE):
+        """Сообщения outbox, которые пора доставить, в порядке постановки"""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT id, chat_id, text, options, kind, payload, attempts
+                         FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+                         ORDER BY id LIMIT ?''', (time.time(), limit))
+            rows = c.fetchall()
+        return [{'id': row[0], 'chat_id': row[1], 'text': row[2], 'options': json.loads(row[3] or '{}'),
+                 'kind': row[4], 'payload': json.loads(row[5] or '{}'), 'attempts': row[6]}
+                for row in rows]
+
+    def record_deliveries(self, outcomes):
+        """Записать итоги доставки одной транзакцией
+
+        outcomes - список (id, error, permanent): error=None - доставлено,
+        иначе текст ошибки. Сообщение с постоянной ошибкой (permanent=True,
+        повтор не поможет) или исчерпавшее OUTBOX_MAX_ATTEMPTS попыток уходит
+        в dead-letter. Возвращает {id: 'sent' | 'pending' | 'dead'}."""
+        def job(c):
+            statuses = {}
+            for message_id, error, permanent in outcomes:
+                if error is None:
+                    c.execute('''UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL,
+                                 finished_at = CURRENT_TIMESTAMP WHERE id = ?''', (message_id,))
+                    statuses[message_id] = 'sent'
+                    continue
+                c.execute("SELECT attempts FROM outbox WHERE id = ?", (message_id,))
+                attempts = c.fetchone()[0] + 1
+                if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                    c.execute('''UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?,
+                                 finished_at = CURRENT_TIMESTAMP WHERE id = ?''', (attempts, error, message_id))
+                    statuses[message_id] = 'dead'
+                else:
+                    c.execute('''UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ?
+                                 WHERE id = ?''', (attempts, error, self._retry_at(attempts), message_id))
+                    statuses[message_id] = 'pending'
+            return statuses
+        return self._write(job)
+
+    def purge_outbox(self, days=OUTBOX_RETENTION_DAYS):
+        """Удалить доставленные и dead-letter сообщения старше days дней; вернуть число удалённых"""
+        def job(c):
+            c.execute('''DELETE FROM outbox WHERE status IN ('sent', 'dead')
+                         AND finished_at < datetime('now', ?)''', (f'-{days} days',))
+            return c.rowcount
+        return self._write(job)
+
+    # ЖИВОЙ ОТЧЁТ
+    def set_live_report(self, group_chat_id, enabled):
+        """Включить или выключить живой отчёт группы (сообщение дня сохраняется)"""
+        def job(c):
+            c.execute('''INSERT INTO live_reports (group_chat_id, enabled) VALUES (?, ?)
+                         ON CONFLICT(group_chat_id) DO UPDATE SET enabled = excluded.enabled''',
+                      (group_chat_id, int(enabled)))
+        self._write(job)
+
+    def get_live_report_groups(self):
+        """Группы, в которых включён живой отчёт"""
+        with self.pool.cursor() as c:
+            c.execute("SELECT group_chat_id FROM live_reports WHERE enabled = 1 ORDER BY group_chat_id")
+            return [row[0] for row in c.fetchall()]
+
+    def get_live_report_message(self, group_chat_id):
+        """Сообщение живого отчёта группы: (дата, message_id) или None"""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT report_date, message_id FROM live_reports
+                         WHERE group_chat_id = ? AND message_id IS NOT NULL''', (group_chat_id,))
+            return c.fetchone()
+
+    def set_live_report_message(self, group_chat_id, report_date, message_id):
+        """Запомнить сообщение живого отчёта группы за день"""
+        def job(c):
+            c.execute('''INSERT INTO live_reports (group_chat_id, report_date, message_id) VALUES (?, ?, ?)
+                         ON CONFLICT(group_chat_id) DO UPDATE
+                         SET report_date = excluded.report_date, message_id = excluded.message_id''',
+                      (group_chat_id, report_date, message_id))
+        self._write(job)
+
+    # АРХИВ И МЕСЯЧНЫЕ СВОДКИ
+    def archive_closed_days(self):
+        """Перенести закрытые дни из absences и старые запросы из pending_absences в архив
+
+        Архив - отдельный файл, а в режиме WAL транзакция над несколькими
+        файлами не атомарна. Поэтому строки сначала копируются в архив
+        (вместе с пересчётом сводок месяца) и фиксируются, затем копия
+        сверяется, и только после этого второй транзакцией из основной БД
+        удаляются строки, уже лежащие в архиве. Сбой на любом шаге не теряет
+        строк, а повтор не создаёт дублей. Возвращает {месяц: перенесено
+        строк absences}."""
+        today = date.today()
+        with self.pool.cursor() as c:
+            c.execute('''SELECT DISTINCT substr(date, 1, 7) FROM absences
+                         WHERE date < ? ORDER BY 1''', (today.isoformat(),))
+            months = [row[0] for row in c.fetchall()]
+
+        moved = {}
+        for month in months:
+            year, month_number = map(int, month.split('-'))
+            # Закрытые дни месяца: [начало месяца, min(начало следующего, сегодня))
+            bounds = (f"{month}-01", f"{year + month_number // 12:04d}-{month_number % 12 + 1:02d}-01",
+                      today.isoformat())
+            self._write(lambda c, month=month, bounds=bounds: self._copy_month_to_archive(c, month, bounds))
+            with self.pool.cursor() as c:
+                c.execute('''SELECT COUNT(*), COUNT(x.id) FROM main.absences a
+                             LEFT JOIN archive.absences_archive x ON x.id = a.id
+                             WHERE a.date >= ? AND a.date < ? AND a.date < ?''', bounds)
+                total, copied = c.fetchone()
+            if copied != total:
+                logging.error(f"❌ Архив месяца {month} неполон: скопировано {copied} из {total}, удаление пропущено")
+                continue
+
+            def delete_archived(c, bounds=bounds):
+                c.execute('''DELETE FROM main.absences
+                             WHERE date >= ? AND date < ? AND date < ?
+                               AND id IN (SELECT id FROM archive.absences_archive)''', bounds)
+                return c.rowcount
+
+            moved[month] = self._write(delete_archived)
+            logging.info(f"📦 Архивирован месяц {month}: перенесено записей {moved[month]}")
+
+        pending_cutoff = date.fromordinal(today.toordinal() - ARCHIVE_PENDING_DAYS).isoformat()
+
+        def copy_pending(c):
+            c.execute('''INSERT OR IGNORE INTO archive.pending_absences_archive
+                         (id, user_id, reason, date, month, group_chat_id, created_at)
+                         SELECT id, user_id, reason, date, substr(date, 1, 7), group_chat_id, created_at
+                         FROM main.pending_absences WHERE date < ?''', (pending_cutoff,))
+
+        def delete_pending(c):
+            c.execute('''DELETE FROM main.pending_absences
+                         WHERE date < ? AND id IN (SELECT id FROM archive.pending_absences_archive)''',
+                         (pending_cutoff,))
+            return c.rowcount
+
+        self._write(copy_pending)
+        pending_moved = self._write(delete_pending)
+        if pending_moved:
+            logging.info(f"📦 В архив перенесено неподтверждённых причин: {pending_moved}")
+        return moved
+
+    def _copy_month_to_archive(self, c, month, bounds):
+        """Скопировать закрытые дни месяца в архив и пересчитать его сводки (основная БД не меняется)"""
+        c.execute('''INSERT OR IGNORE INTO archive.absences_archive
+                     (id, user_id, absence_type, reason, date, month, group_chat_id, created_at)
+                     SELECT id, user_id, absence_type, reason, date, substr(date, 1, 7), group_chat_id, created_at
+                     FROM main.absences
+                     WHERE date >= ? AND date < ? AND date < ?''', bounds)
+
+        c.execute("DELETE FROM archive.rollup_user_month WHERE month = ?", (month,))
+        c.execute('''INSERT INTO archive.rollup_user_month
+                     (month, user_id, group_chat_id, absence_type, days)
+                     SELECT month, user_id, group_chat_id, absence_type, COUNT(DISTINCT date)
+                     FROM archive.absences_archive WHERE month = ?
+                     GROUP BY user_id, group_chat_id, absence_type''', (month,))
+        c.execute("DELETE FROM archive.rollup_group_month WHERE month = ?", (month,))
+        c.execute('''INSERT INTO archive.rollup_group_month
+                     (month, group_chat_id, absence_type, absences, users)
+                     SELECT month, group_chat_id, absence_type, COUNT(*), COUNT(DISTINCT user_id)
+                     FROM archive.absences_archive WHERE month = ?
+                     GROUP BY group_chat_id, absence_type''', (month,))
+        c.execute("DELETE FROM archive.rollup_reason_month WHERE month = ?", (month,))
+        c.execute('''INSERT INTO archive.rollup_reason_month
+                     (month, group_chat_id, reason, absences)
+                     SELECT month, group_chat_id, reason, COUNT(*)
+                     FROM archive.absences_archive WHERE month = ?
+                     GROUP BY group_chat_id, reason''', (month,))
+
+    def get_group_month_stats(self, group_chat_id, month):
+        """Сводка группы за месяц из архива: (по типам, по причинам)
+
+        По типам - список (absence_type, absences, users), по причинам -
+        список (reason, absences) по убыванию."""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT absence_type, absences, users FROM archive.rollup_group_month
+                         WHERE month = ? AND group_chat_id = ? ORDER BY absence_type''',
+                         (month, group_chat_id))
+            by_type = c.fetchall()
+            c.execute('''SELECT reason, absences FROM archive.rollup_reason_month
+                         WHERE month = ? AND group_chat_id = ? ORDER BY absences DESC, reason''',
+                         (month, group_chat_id))
+            by_reason = c.fetchall()
+        return by_type, by_reason
+
+    def get_user_month_stats(self, group_chat_id, month):
+        """Дни отсутствия пользователей группы за месяц: список (user_id, fio, absence_type, days)"""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT r.user_id, u.fio, r.absence_type, r.days
+                         FROM archive.rollup_user_month r
+                         LEFT JOIN users u ON r.user_id = u.user_id
+                         WHERE r.month = ? AND r.group_chat_id = ?
+                         ORDER BY r.days DESC, u.fio''', (month, group_chat_id))
+            return c.fetchall()
+
+    # ГРУППЫ И КЛЮЧИ АКТИВАЦИИ
+    def add_pending_bind(self, chat_id, requester_id, group_name):
+        """Сохранить запрос на привязку группы"""
+        def job(c):
+            c.execute('''INSERT INTO pending_binds (chat_id, requester_id, group_name)
+                         VALUES (?, ?, ?)''', (chat_id, requester_id, group_name))
+            return c.lastrowid
+        return self._write(job)
+
+    def add_activation_key(self, key, chat_id, target_admin_id):
+        """Сохранить ключ активации"""
+        def job(c):
+            c.execute('''INSERT INTO activation_keys
+                        (key, chat_id, target_admin_id)
+                        VALUES (?, ?, ?)''',
+                        (key, chat_id, target_admin_id))
+        self._write(job)
+
+    def get_activation_key(self, key):
+        """Получить ключ активации: (chat_id, target_admin_id, used)"""
+        with self.pool.cursor() as c:
+            c.execute('''SELECT chat_id, target_admin_id, used
+                        FROM activation_keys
+                        WHERE key = ?''', (key,))
+            return c.fetchone()
+
+    def use_activation_key(self, key, chat_id):
+        """Отметить ключ использованным и сохранить группу с названием из /start_bind
+
+        Возвращает название группы."""
+        def job(c):
+            c.execute('''UPDATE activation_keys
+                        SET used = 1, used_at = CURRENT_TIMESTAMP
+                        WHERE key = ?''', (key,))
+
+            # Получаем название группы из pending_binds
+            c.execute('''SELECT group_name FROM pending_binds WHERE chat_id = ? ORDER BY requested_at DESC LIMIT 1''', (chat_id,))
+            group_name_result = c.fetchone()
+
+            if group_name_result and group_name_result[0]:
+                group_name = group_name_result[0]
+                logging.info(f"📋 Найдено название из /start_bind: '{group_name}'")
+            else:
+                logging.warning(f"⚠️ Название группы из /start_bind не найдено для chat_id={chat_id}")
+                group_name = "название группы не указано"
+
+            # Добавляем или обновляем группу (с названием ИЗ /start_bind, а НЕ из Telegram)
+            c.execute('''INSERT OR REPLACE INTO groups
+                        (chat_id, name, verified)
+                        VALUES (?, ?, 1)''', (chat_id, group_name))
+            return group_name
+        group_name = self._write(job)
+        self.groups.set_name(chat_id, group_name)
+        self._absences_changed(chat_id)
+        return group_name
+
+    def update_group_name(self, chat_id, name):
+        """Обновить название группы"""
+        def job(c):
+            c.execute('''UPDATE groups SET name = ? WHERE chat_id = ?''', (name, chat_id))
+            return c.rowcount
+        # UPDATE не создаёт группу, поэтому и в индексе меняем только известные
+        if self._write(job):
+            self.groups.set_name(chat_id, name)
+            # Название группы выводится в заголовке отчёта
+            self._absences_changed(chat_id)
+
+    def _exercise_queries(self):
+        """Вызвать каждый метод с пробными данными, чтобы выполнились все запросы
+
+        Используется explain_database_queries на временной копии схемы."""
+        user_id, chat_id = 1, -1
+        self.set_user_state(user_id, 'waiting_for_reason', {'probe': True})
+        self.get_user_state(user_id)
+        self.clear_user_state(user_id)
+        self.save_last_update_id(1)
+        self.get_last_update_id()
+        self.register_user(user_id, 'Проверка')
+        self.get_user_fio(user_id)
+        self.profiles.invalidate(user_id)
+        self.get_user_fios([user_id, user_id + 1])
+        self.update_username('probe', user_id)
+        self.usernames.flush()
+        self.get_user_id_by_username('probe')
+        self.add_absence(user_id, 'уважительно', 'проверка', chat_id)
+        self.get_today_absences(chat_id)
+        self.get_today_absences()
+        self.get_today_absences_for_groups([chat_id, chat_id - 1])
+        self.remove_absence_from_today(user_id)
+        self.set_admin(user_id)
+        self.get_admin_ids()
+        self.set_admin_report_time(user_id, '09:00')
+        self.set_group_report_time(chat_id, '09:00')
+        self.set_group_report_time(chat_id, None)
+        self.get_report_schedule()
+        self.set_bot_state('probe', 1)
+        self.get_bot_state('probe')
+        self.remove_admin(user_id)
+        self.add_pending_bind(chat_id, user_id, 'Проверка')
+        self.add_activation_key('probe', chat_id, user_id)
+        self.get_activation_key('probe')
+        self.use_activation_key('probe', chat_id)
+        self.get_group_name(chat_id)
+        self.update_group_name(chat_id, 'Проверка')
+        self.add_group_admin(chat_id, user_id)
+        self.get_group_admins(chat_id)
+        self.is_group_admin(chat_id, user_id)
+        self.get_admin_groups(user_id)
+        self.get_all_group_admins()
+        self.remove_group_admin(chat_id, user_id)
+        pending_id = self.add_pending_absence(user_id, 'проверка', chat_id)
+        self.get_pending_absence(pending_id)
+        self.delete_pending_absence(pending_id)
+        self.add_active_absence(user_id, '🤒 Болею', 1, user_id, chat_id)
+        self.get_active_absence(user_id)
+        self.get_all_active_absences()
+        self.remove_active_absence(user_id)
+        self.mark_absent(user_id, 'уважительно', 'проверка', chat_id)
+        self.start_active_absence(user_id, '🤒 Болею', chat_id)
+        self.set_active_absence_message(user_id, 1, user_id)
+        self.end_active_absence(user_id)
+        self.cancel_absence(user_id)
+        self.approve_pending(self.submit_custom_reason(user_id, 'проверка', chat_id), 'уважительно')
+        self._write(lambda c: c.execute('''INSERT INTO absences
+                                           (user_id, absence_type, reason, date, group_chat_id)
+                                           VALUES (?, 'уважительно', 'проверка', '2000-01-01', ?)''',
+                                           (user_id, chat_id)))
+        self.archive_closed_days()
+        self.get_group_month_stats(chat_id, date.today().strftime('%Y-%m'))
+        self.get_user_month_stats(chat_id, date.today().strftime('%Y-%m'))
+        self.enqueue_messages([{'chat_id': user_id, 'text': 'проверка', 'dedup_key': 'probe'}])
+        message_id = self.get_due_messages()[0]['id']
+        self.record_deliveries([(message_id, 'ошибка', False)])
+        self.record_deliveries([(message_id, None, False)])
+        self.set_active_absence_message(user_id, 1, user_id, absence_id=1)
+        self.purge_outbox()
+        self.enqueue_messages([{'chat_id': user_id, 'text': 'проверка', 'kind': 'digest', 'flush_digest': True}])
+        self.set_notify_mode(user_id, 'digest')
+        self.set_live_report(chat_id, True)
+        self.set_live_report_message(chat_id, '2000-01-01', 1)
+        self.get_live_report_groups()
+        self.get_live_report_message(chat_id)
+
+class MemoryDatabase(Storage):
+    """Хранилище в памяти процесса: словари и индексы вместо таблиц SQLite
+
+    Повторяет поведение Database, но ничего не сохраняет между запусками.
+    Все операции выполняются под одной блокировкой, поэтому составные
+    операции так же атомарны, как транзакции в SQLite."""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._states = {}
+        self._bot_state = {}
+        self._users = {}  # user_id -> ФИО
+        self._usernames = {}  # username (в нижнем регистре) -> user_id
+        self._admins = {}  # admin_id -> report_time, в порядке добавления
+        self._group_report_times = {}  # chat_id -> report_time
+        # absences: id -> строка; индексы по дате и по (пользователь, дата)
+        self._absences = {}
+        self._absences_by_date = {}
+        self._absences_by_user_date = {}
+        self._pending = {}  # id -> строка pending_absences
+        self._active = {}  # user_id -> строка active_absences
+        self._group_rows = {}  # chat_id -> {'name', 'verified'}
+        self._pending_binds = []
+        self._activation_keys = {}  # key -> [chat_id, target_admin_id, used]
+        self._absences_archive = {}
+        self._pending_archive = {}
+        self._outbox = {}  # id -> сообщение outbox
+        self._outbox_keys = set()  # dedup_key уже поставленных сообщений
+        self._live_reports = {}  # group_chat_id -> {'enabled', 'report_date', 'message_id'}
+        self._next_id = {}
+
+    def _new_id(self, table):
+        self._next_id[table] = self._next_id.get(table, 0) + 1
+        return self._next_id[table]
+
+    @staticmethod
+    def _now():
+        # Тот же формат и часовой пояс (UTC), что у CURRENT_TIMESTAMP в SQLite
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    # Состояния и служебные значения
+    def set_user_state(self, user_id, state, data=None):
+        """Установить состояние пользователя"""
+        data_json = json.dumps(data) if data else None
+        with self._lock:
+            self._states[user_id] = (state, json.loads(data_json) if data_json else None)
+
+    def get_user_state(self, user_id):
+        """Получить состояние пользователя"""
+        return self._states.get(user_id, (None, None))
+
+    def clear_user_state(self, user_id):
+        """Очистить состояние пользователя"""
+        with self._lock:
+            self._states.pop(user_id, None)
+
+    def get_last_update_id(self):
+        """Получить последний обработанный update_id"""
+        return int(self._bot_state.get('last_update_id', 0))
+
+    def save_last_update_id(self, update_id):
+        """Сохранить последний update_id"""
+        with self._lock:
+            self._bot_state['last_update_id'] = str(update_id)
+
+    def get_bot_state(self, key):
+        """Получить служебное значение (строка или None)"""
+        return self._bot_state.get(key)
+
+    def set_bot_state(self, key, value):
+        """Сохранить служебное значение"""
+        with self._lock:
+            self._bot_state[key] = str(value)
+
+    # Пользователи
+    def register_user(self, user_id, fio):
+        """Зарегистрировать пользователя с ФИО"""
+        with self._lock:
+            self._users[user_id] = fio
+        self._absences_changed()
+
+    def get_user_fio(self, user_id):
+        """Получить ФИО пользователя"""
+        return self._users.get(user_id)
+
+    def update_username(self, username, user_id):
+        """Обновить username -> user_id; вернуть True, если соответствие изменилось"""
+        if not username:
+            return False
+        username = username.lower()
+        with self._lock:
+            if self._usernames.get(username) == user_id:
+                return False
+            self._usernames[username] = user_id
+        return True
+
+    def get_user_id_by_username(self, username):
+        """Получить user_id по username"""
+        return self._usernames.get(username.lower())
+
+    # Отсутствия
+    def _insert_absence(self, user_id, absence_type, reason, day, group_chat_id):
+        absence_id = self._new_id('absences')
+        self._absences[absence_id] = {
+            'id': absence_id, 'user_id': user_id, 'absence_type': absence_type, 'reason': reason,
+            'date': day, 'group_chat_id': group_chat_id, 'created_at': self._now(),
+        }
+        self._absences_by_date.setdefault(day, set()).add(absence_id)
+        self._absences_by_user_date.setdefault((user_id, day), set()).add(absence_id)
+
+    def _delete_absences(self, absence_ids):
+        for absence_id in list(absence_ids):
+            row = self._absences.pop(absence_id)
+            self._absences_by_date[row['date']].discard(absence_id)
+            self._absences_by_user_date[(row['user_id'], row['date'])].discard(absence_id)
+
+    def _delete_user_absences(self, user_id, day, group_chat_id=None):
+        ids = self._absences_by_user_date.get((user_id, day), set())
+        if group_chat_id is not None:
+            ids = {i for i in ids if self._absences[i]['group_chat_id'] == group_chat_id}
+        self._delete_absences(ids)
+
+    def _insert_active(self, user_id, absence_type, message_id, chat_id, group_chat_id):
+        # REPLACE в SQLite выдаёт новой строке новый id
+        self._active[user_id] = {
+            'id': self._new_id('active_absences'), 'user_id': user_id, 'absence_type': absence_type,
+            'message_id': message_id, 'chat_id': chat_id, 'group_chat_id': group_chat_id,
+        }
+
+    @staticmethod
+    def _active_tuple(row):
+        return (row['id'], row['user_id'], row['absence_type'], row['message_id'], row['chat_id'], row['group_chat_id'])
+
+    def add_absence(self, user_id, absence_type, reason="", group_chat_id=None):
+        """Добавить запись об отсутствии"""
+        today = date.today().isoformat()
+        with self._lock:
+            # Как DELETE в Database: прежняя запись на сегодня в этой группе заменяется
+            # (group_chat_id = NULL в SQL не совпадает ни с чем)
+            if group_chat_id is not None:
+                self._delete_user_absences(user_id, today, group_chat_id)
+            self._insert_absence(user_id, absence_type, reason, today, group_chat_id)
+        self._absences_changed(group_chat_id)
+
+    def get_today_absences(self, group_chat_id=None):
+        """Получить отсутствия за сегодня для конкретной группы"""
+        today = date.today().isoformat()
+        with self._lock:
+            rows = []
+            for absence_id in sorted(self._absences_by_date.get(today, ())):
+                row = self._absences[absence_id]
+                if group_chat_id and row['group_chat_id'] != group_chat_id:
+                    continue
+                rows.append((self._users.get(row['user_id']), row['absence_type'], row['reason'], row['user_id']))
+            for row in sorted(self._active.values(), key=lambda r: r['id']):
+                if (row['group_chat_id'] == group_chat_id) if group_chat_id else row['group_chat_id'] is not None:
+                    rows.append((self._users.get(row['user_id']), row['absence_type'], row['absence_type'], row['user_id']))
+        return [self._format_absence_row(*row) for row in rows]
+
+    def remove_absence_from_today(self, user_id):
+        """Удалить отсутствие пользователя из сегодняшних отсутствий"""
+        with self._lock:
+            self._delete_user_absences(user_id, date.today().isoformat())
+        self._absences_changed()
+
+    # Администраторы
+    def set_admin(self, admin_id):
+        """Добавить администратора"""
+        with self._lock:
+            self._admins.setdefault(admin_id, '09:00')
+
+    def get_admin_ids(self):
+        """Получить список всех администраторов"""
+        return list(self._admins)
+
+    def remove_admin(self, admin_id):
+        """Удалить администратора"""
+        with self._lock:
+            self._admins.pop(admin_id, None)
+
+    def get_report_schedule(self):
+        """Расписание ежедневных отчётов: список ('admin' | 'group', ID, 'ЧЧ:ММ')"""
+        with self._lock:
+            return ([('admin', admin_id, report_time) for admin_id, report_time in self._admins.items()
+                     if report_time is not None] +
+                    [('group', chat_id, report_time) for chat_id, report_time in self._group_report_times.items()])
+
+    def set_admin_report_time(self, admin_id, report_time):
+        """Установить время ежедневного отчёта администратора (добавляет его в администраторы)"""
+        with self._lock:
+            self._admins[admin_id] = report_time
+
+    def set_group_report_time(self, chat_id, report_time):
+        """Установить время ежедневного отчёта в группу; None - не отправлять"""
+        with self._lock:
+            if report_time is None:
+                self._group_report_times.pop(chat_id, None)
+            else:
+                self._group_report_times[chat_id] = report_time
+
+    def add_group_admin(self, chat_id, admin_id):
+        """Добавить администратора к группе"""
+        self.groups.add_admin(chat_id, admin_id)
+        logging.info(f"✅ Администратор {admin_id} добавлен к группе {chat_id}")
+        return True
+
+    def remove_group_admin(self, chat_id, admin_id):
+        """Удалить администратора из группы"""
+        self.groups.remove_admin(chat_id, admin_id)
+        logging.info(f"✅ Администратор {admin_id} удален из группы {chat_id}")
+        return True
+
+    # Причины "Другое" и активные отсутствия
+    def add_pending_absence(self, user_id, reason, group_chat_id=None):
+        """Добавить ожидающую подтверждения причину"""
+        with self._lock:
+            pending_id = self._new_id('pending_absences')
+            self._pending[pending_id] = {
+                'id': pending_id, 'user_id': user_id, 'reason': reason, 'date': date.today().isoformat(),
+                'group_chat_id': group_chat_id, 'created_at': self._now(),
+            }
+            return pending_id
+
+    def get_pending_absence(self, pending_id):
+        """Получить ожидающую причину по ID"""
+        with self._lock:
+            row = self._pending.get(pending_id)
+            if row is None:
+                return None
+            return (row['id'], row['user_id'], row['reason'], row['date'], row['group_chat_id'],
+                    row['created_at'], self._users.get(row['user_id']))
+
+    def delete_pending_absence(self, pending_id):
+        """Удалить ожидающую причину"""
+        with self._lock:
+            self._pending.pop(pending_id, None)
+
+    def add_active_absence(self, user_id, absence_type, message_id=None, chat_id=None, group_chat_id=None):
+        """Добавить пользователя в список текущих отсутствующих (Болею/Отпуск)"""
+        with self._lock:
+            self._insert_active(user_id, absence_type, message_id, chat_id, group_chat_id)
+        self._absences_changed()
+
+    def remove_active_absence(self, user_id):
+        """Удалить пользователя из списка текущих отсутствующих"""
+        with self._lock:
+            self._active.pop(user_id, None)
+        self._absences_changed()
+
+    def get_active_absence(self, user_id):
+        """Получить информацию об активном отсутствии пользователя"""
+        with self._lock:
+            row = self._active.get(user_id)
+            return self._active_tuple(row) if row else None
+
+    def get_all_active_absences(self):
+        """Получить всех людей в списке отсутствующих"""
+        with self._lock:
+            return [(row['user_id'], row['absence_type'], self._users.get(row['user_id']))
+                    for row in sorted(self._active.values(), key=lambda r: r['id'])]
+
+    # Атомарные операции с отсутствиями (см. одноимённые методы Database)
+    def mark_absent(self, user_id, absence_type, reason, group_chat_id=None):
+        """Заменить сегодняшние отметки пользователя новым отсутствием и очистить состояние"""
+        today = date.today().isoformat()
+        with self._lock:
+            self._delete_user_absences(user_id, today)
+            self._active.pop(user_id, None)
+            self._insert_absence(user_id, absence_type, reason, today, group_chat_id)
+            self._states.pop(user_id, None)
+        self._absences_changed()
+
+    def start_active_absence(self, user_id, absence_type, group_chat_id=None, messages=None):
+        """Начать активное отсутствие (Болею/Отпуск) вместо сегодняшних отметок и очистить состояние"""
+        with self._lock:
+            self._delete_user_absences(user_id, date.today().isoformat())
+            self._insert_active(user_id, absence_type, None, None, group_chat_id)
+            self._states.pop(user_id, None)
+            absence_id = self._active[user_id]['id']
+            queued = self._enqueue(self._resolve_messages(messages, absence_id))
+        self._absences_changed()
+        if queued:
+            self._outbox_changed()
+        return absence_id
+
+    def set_active_absence_message(self, user_id, message_id, chat_id, absence_id=None):
+        """Запомнить сообщение с кнопкой 'Выхожу' для активного отсутствия"""
+        with self._lock:
+            row = self._active.get(user_id)
+            if row and absence_id in (None, row['id']):
+                row['message_id'], row['chat_id'] = message_id, chat_id
+
+    def end_active_absence(self, user_id, messages=None):
+        """Завершить активное отсутствие и убрать сегодняшние отметки; вернуть запись или None"""
+        with self._lock:
+            row = self._active.pop(user_id, None)
+            if row is None:
+                return None
+            self._delete_user_absences(user_id, date.today().isoformat())
+            absence = self._active_tuple(row)
+            queued = self._enqueue(self._resolve_messages(messages, absence))
+        self._absences_changed()
+        if queued:
+            self._outbox_changed()
+        return absence
+
+    def cancel_absence(self, user_id):
+        """Удалить сегодняшние отметки и активное отсутствие пользователя"""
+        with self._lock:
+            self._delete_user_absences(user_id, date.today().isoformat())
+            self._active.pop(user_id, None)
+        self._absences_changed()
+
+    def submit_custom_reason(self, user_id, reason, group_chat_id=None, messages=None):
+        """Отправить причину 'Другое' на подтверждение и очистить состояние; вернуть ID запроса"""
+        with self._lock:
+            pending_id = self.add_pending_absence(user_id, reason, group_chat_id)
+            self._states.pop(user_id, None)
+            queued = self._enqueue(self._resolve_messages(messages, pending_id))
+        if queued:
+            self._outbox_changed()
+        return pending_id
+
+    def approve_pending(self, pending_id, absence_type):
+        """Утвердить причину: записать отсутствие и удалить запрос; None, если запрос уже обработан"""
+        today = date.today().isoformat()
+        with self._lock:
+            pending = self.get_pending_absence(pending_id)
+            if pending is None:
+                return None
+            user_id, reason, group_chat_id = pending[1], pending[2], pending[4]
+            self._delete_user_absences(user_id, today, group_chat_id)
+            self._insert_absence(user_id, absence_type, reason, today, group_chat_id)
+            del self._pending[pending_id]
+        self._absences_changed(group_chat_id)
+        return pending
+
+    # Outbox исходящих сообщений
+    def _enqueue(self, messages):
+        queued = []
+        for message in messages:
+            if message.get('dedup_key') is not None:
+                if message['dedup_key'] in self._outbox_keys:
+                    continue
+                self._outbox_keys.add(message['dedup_key'])
+            message_id = self._new_id('outbox')
+            self._outbox[message_id] = {
+                'id': message_id, 'chat_id': message['chat_id'], 'text': message['text'],
+                'options': json.loads(json.dumps(message.get('options') or {})), 'kind': message.get('kind'),
+                'payload': json.loads(json.dumps(message.get('payload') or {})), 'dedup_key': message.get('dedup_key'),
+                'status': 'pending', 'attempts': 0, 'next_attempt_at': message.get('not_before', 0),
+                'last_error': None, 'finished_at': None,
+            }
+            queued.append(message)
+            if message.get('flush_digest'):
+                for row in self._outbox.values():
+                    if row['chat_id'] == message['chat_id'] and row['kind'] == 'digest' and row['status'] == 'pending':
+                        row['next_attempt_at'] = 0
+        return queued
+
+    def enqueue_messages(self, messages):
+        """Поставить сообщения в outbox; вернуть число добавленных"""
+        with self._lock:
+            queued = self._enqueue(messages)
+        if queued:
+            self._outbox_changed()
+        return len(queued)
+
+    def get_due_messages(self, limit=OUTBOX_BATCH_SIZE):
+        """Сообщения outbox, которые пора доставить, в порядке постановки"""
+        now = time.time()
+        with self._lock:
+            due = [row for row in self._outbox.values() if row['status'] == 'pending' and row['next_attempt_at'] <= now]
+            return [{key: row[key] for key in ('id', 'chat_id', 'text', 'options', 'kind', 'payload', 'attempts')}
+                    for row in sorted(due, key=lambda r: r['id'])[:limit]]
+
+    def record_deliveries(self, outcomes):
+        """Записать итоги доставки; вернуть {id: 'sent' | 'pending' | 'dead'}"""
+        statuses = {}
+        with self._lock:
+            for message_id, error, permanent in outcomes:
+                row = self._outbox[message_id]
+                row['attempts'] += 1
+                row['last_error'] = error
+                if error is None:
+                    row['status'], row['finished_at'] = 'sent', time.time()
+                elif permanent or row['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                    row['status'], row['finished_at'] = 'dead', time.time()
+                else:
+                    row['next_attempt_at'] = self._retry_at(row['attempts'])
+                statuses[message_id] = row['status']
+        return statuses
+
+    def purge_outbox(self, days=OUTBOX_RETENTION_DAYS):
+        """Удалить доставленные и dead-letter сообщения старше days дней; вернуть число удалённых"""
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            old = [message_id for message_id, row in self._outbox.items()
+                   if row['finished_at'] is not None and row['finished_at'] < cutoff]
+            for message_id in old:
+                self._outbox_keys.discard(self._outbox.pop(message_id)['dedup_key'])
+        return len(old)
+
+    def set_notify_mode(self, admin_id, mode):
+        """Сохранить режим уведомлений администратора ('instant' или 'digest')"""
+        with self._lock:
+            self._notify_modes[admin_id] = mode
+
+    # Живой отчёт
+    def _live_report_row(self, group_chat_id):
+        return self._live_reports.setdefault(group_chat_id, {'enabled': 1, 'report_date': None, 'message_id': None})
+
+    def set_live_report(self, group_chat_id, enabled):
+        """Включить или выключить живой отчёт группы (сообщение дня сохраняется)"""
+        with self._lock:
+            self._live_report_row(group_chat_id)['enabled'] = int(enabled)
+
+    def get_live_report_groups(self):
+        """Группы, в которых включён живой отчёт"""
+        with self._lock:
+            return sorted(chat_id for chat_id, row in self._live_reports.items() if row['enabled'])
+
+    def get_live_report_message(self, group_chat_id):
+        """Сообщение живого отчёта группы: (дата, message_id) или None"""
+        row = self._live_reports.get(group_chat_id)
+        if row is None or row['message_id'] is None:
+            return None
+        return (row['report_date'], row['message_id'])
+
+    def set_live_report_message(self, group_chat_id, report_date, message_id):
+        """Запомнить сообщение живого отчёта группы за день"""
+        with self._lock:
+            row = self._live_report_row(group_chat_id)
+            row['report_date'], row['message_id'] = report_date, message_id
+
+    # Архив и месячные сводки
+    def archive_closed_days(self):
+        """Перенести закрытые дни и старые запросы в архив; вернуть {месяц: перенесено строк}"""
+        today = date.today()
+        pending_cutoff = date.fromordinal(today.toordinal() - ARCHIVE_PENDING_DAYS).isoformat()
+        moved = {}
+        with self._lock:
+            for day in sorted(d for d in self._absences_by_date if d < today.isoformat()):
+                ids = list(self._absences_by_date[day])
+                for absence_id in ids:
+                    row = self._absences[absence_id]
+                    self._absences_archive[absence_id] = dict(row, month=day[:7])
+                    moved[day[:7]] = moved.get(day[:7], 0) + 1
+                self._delete_absences(ids)
+                del self._absences_by_date[day]
+            for pending_id in [i for i, row in self._pending.items() if row['date'] < pending_cutoff]:
+                row = self._pending.pop(pending_id)
+                self._pending_archive[pending_id] = dict(row, month=row['date'][:7])
+        for month, count in sorted(moved.items()):
+            logging.info(f"📦 Архивирован месяц {month}: перенесено записей {count}")
+        return dict(sorted(moved.items()))
+
+    def _archived(self, group_chat_id, month):
+        return [row for row in self._absences_archive.values()
+                if row['month'] == month and row['group_chat_id'] == group_chat_id]
+
+    def get_group_month_stats(self, group_chat_id, month):
+        """Сводка группы за месяц из архива: (по типам, по причинам)"""
+        by_type, by_reason = {}, {}
+        with self._lock:
+            for row in self._archived(group_chat_id, month):
+                entry = by_type.setdefault(row['absence_type'], [0, set()])
+                entry[0] += 1
+                entry[1].add(row['user_id'])
+                by_reason[row['reason']] = by_reason.get(row['reason'], 0) + 1
+        return ([(absence_type, count, len(users)) for absence_type, (count, users) in sorted(by_type.items())],
+                sorted(by_reason.items(), key=lambda item: (-item[1], item[0])))
+
+    def get_user_month_stats(self, group_chat_id, month):
+        """Дни отсутствия пользователей группы за месяц: список (user_id, fio, absence_type, days)"""
+        days = {}
+        with self._lock:
+            for row in self._archived(group_chat_id, month):
+                days.setdefault((row['user_id'], row['absence_type']), set()).add(row['date'])
+            rows = [(user_id, self._users.get(user_id), absence_type, len(dates))
+                    for (user_id, absence_type), dates in days.items()]
+        # ORDER BY days DESC, fio: в SQLite NULL идёт раньше строк
+        return sorted(rows, key=lambda row: (-row[3], row[1] is not None, row[1] or ''))
+
+    # Группы и ключи активации
+    def add_pending_bind(self, chat_id, requester_id, group_name):
+        """Сохранить запрос на привязку группы"""
+        with self._lock:
+            bind_id = self._new_id('pending_binds')
+            self._pending_binds.append((bind_id, chat_id, requester_id, group_name))
+            return bind_id
+
+    def add_activation_key(self, key, chat_id, target_admin_id):
+        """Сохранить ключ активации"""
+        with self._lock:
+            if key in self._activation_keys:
+                raise ValueError(f"Ключ активации {key} уже существует")
+            self._activation_keys[key] = [chat_id, target_admin_id, 0]
+
+    def get_activation_key(self, key):
+        """Получить ключ активации: (chat_id, target_admin_id, used)"""
+        row = self._activation_keys.get(key)
+        return tuple(row) if row else None
+
+    def use_activation_key(self, key, chat_id):
+        """Отметить ключ использованным и сохранить группу с названием из /start_bind; вернуть название"""
+        with self._lock:
+            if key in self._activation_keys:
+                self._activation_keys[key][2] = 1
+            names = [bind[3] for bind in self._pending_binds if bind[1] == chat_id]
+            group_name = names[-1] if names and names[-1] else "название группы не указано"
+            self._group_rows[chat_id] = {'name': group_name, 'verified': 1}
+            self.groups.set_name(chat_id, group_name)
+        self._absences_changed(chat_id)
+        return group_name
+
+    def update_group_name(self, chat_id, name):
+        """Обновить название группы"""
+        with self._lock:
+            if chat_id not in self._group_rows:
+                return
+            self._group_rows[chat_id]['name'] = name
+            self.groups.set_name(chat_id, name)
+        self._absences_changed(chat_id)
+
+def create_storage(backend=None):
+    """Создать хранилище по настройке STORAGE_BACKEND: sqlite или memory"""
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        return Database()
+    if backend == 'memory':
+        logging.warning("⚠️ Данные хранятся только в памяти и пропадут при перезапуске")
+        return MemoryDatabase()
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={backend!r} (ожидается sqlite или memory)")
+
+class ArchiveJob:
+    """Ежедневный перенос закрытых дней в архив и очистка outbox (вскоре после полуночи)"""
+
+    def __init__(self, database, run_at_minutes=5):
+        self.database = database
+        self.run_at_minutes = run_at_minutes  # минут после полуночи
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='archive-job', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _seconds_until_next_run(self):
+        now = datetime.now()
+        next_run = datetime.combine(date.fromordinal(now.date().toordinal() + 1), datetime.min.time())
+        next_run = next_run.replace(minute=self.run_at_minutes)
+        return (next_run - now).total_seconds()
+
+    def _run(self):
+        # Первый проход сразу при старте - догоняем дни, пропущенные во время простоя
+        while True:
+            try:
+                self.database.archive_closed_days()
+            except Exception as e:
+                logging.error(f"❌ Ошибка архивации: {e}")
+            try:
+                self.database.purge_outbox()
+            except Exception as e:
+                logging.error(f"❌ Ошибка очистки outbox: {e}")
+            if self._stop_event.wait(self._seconds_until_next_run()):
+                return
+
+def explain_database_queries(db_path=DB_PATH):
+    """Получить EXPLAIN QUERY PLAN для каждого запроса, который выполняет Database
+
+    Запросы собираются трассировкой на временной БД с той же схемой, а планы
+    строятся по рабочей БД (EXPLAIN ничего не выполняет и не меняет данные).
+    Возвращает список (sql, [строки плана])."""
+    import tempfile
+
+    statements = []
+    seen = set()
+
+    def trace(sql):
+        normalized = ' '.join(sql.split())
+        if normalized.split(' ', 1)[0].upper() in ('SELECT', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE') \
+                and normalized not in seen:
+            seen.add(normalized)
+            statements.append(normalized)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        probe_db = Database(os.path.join(tmp_dir, 'probe.db'), trace=trace)
+        try:
+            probe_db._exercise_queries()
+        finally:
+            probe_db.close()
+
+    # Схема рабочей БД должна быть актуальной, иначе планы будут без новых индексов
+    target = Database(db_path)
+    try:
+        conn = target.pool.get_connection()
+        plans = []
+        for sql in statements:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            plans.append((sql, [row[-1] for row in rows]))
+        return plans
+    finally:
+        target.close()
+
+def print_query_plans(db_path=DB_PATH):
+    """Напечатать планы выполнения всех запросов Database"""
+    for sql, plan in explain_database_queries(db_path):
+        print(sql)
+        for line in plan:
+            print(f"    {line}")
+        print()
 
 # Инициализация базы данных
-db = Database()
+db = create_storage()
+atexit.register(db.close)
 
 def create_attendance_keyboard():
     """Создать клавиатуру для отметки отсутствия"""
@@ -592,96 +2765,580 @@ def create_exit_absence_keyboard():
     keyboard.add(btn)
     return keyboard
 
-def send_absence_notification_to_private(user_id, absence_type, username, fio, group_chat_id=None):
-    """Отправить уведомление об отсутствии в личные сообщения и администраторам группы"""
-    try:
-        keyboard = create_exit_absence_keyboard()
-
-        pm_message = bot.send_message(
-            user_id,
-            f"📢 Вы отмечены как отсутствующий:\n\n"
-            f"{absence_type}\n\n"
-            f"Нажмите кнопку ниже, когда вернётесь/выздоровеете.",
-            reply_markup=keyboard
-        )
-
-        # Сохраняем информацию о сообщении с ID группы
-        db.add_active_absence(
-            user_id,
-            absence_type,
-            pm_message.message_id,
-            user_id,
-            group_chat_id=group_chat_id  # Сохраняем реальный group_chat_id
-        )
-        logging.info(f"📬 Сообщение с кнопкой выхода отправлено @{username}")
-
-        # ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ АДМИНИСТРАТОРАМ ГРУППЫ
-        if group_chat_id:
-            send_notification_to_group_admins(
-                group_chat_id=group_chat_id,
-                user_id=user_id,
-                fio=fio,
-                absence_type=absence_type,
-                event_type="added"  # Пользователь добавился в активное отсутствие
-            )
-
-        return True
-
-    except Exception as e:
-        error_msg = str(e)
-        logging.warning(f"⚠️ Ошибка отправки ЛС пользователю @{username}: {error_msg}")
-        return False
-
-
-def send_notification_to_group_admins(group_chat_id, user_id, fio, absence_type, event_type="added"):
-    """Отправить уведомление администраторам группы о статусе отсутствия пользователя"""
-    try:
-        admin_ids = db.get_group_admins(group_chat_id)
-
-        if not admin_ids:
-            logging.info(f"ℹ️ Нет администраторов для группы {group_chat_id}, уведомления не отправляются")
-            return
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # пауза после 429
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до свободного токена"""
+        self._refill(now)
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def is_idle(self, now):
+        """Корзина полна и не на паузе - её можно удалить и создать заново"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+def create_http_session(retry_reads, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    """HTTP-сессия для Bot API с пулом keep-alive соединений
+
+    Ошибки установки соединения повторяются всегда: запрос ещё не ушёл.
+    Обрыв после отправки (сброс соединения, таймаут ответа) повторяется
+    только при retry_reads - для идемпотентных методов; иначе сообщение
+    могло уже дойти и повтор его продублирует. Ответы 429 здесь не
+    повторяются - ими занимается TelegramRateLimiter."""
+    retry = Retry(total=retries, connect=retries, read=retries if retry_reads else 0,
+                  status=0, other=0, allowed_methods=None, backoff_factor=0.2,
+                  respect_retry_after_header=False, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class TelegramRateLimiter:
+    """Ограничение частоты запросов к Bot API
+
+    Каждый запрос берёт токен из общей корзины (TELEGRAM_GLOBAL_RATE в
+    секунду), а запрос с chat_id - ещё из корзины чата (TELEGRAM_CHAT_RATE
+    в секунду, подряд до TELEGRAM_CHAT_BURST) и, для групп, из корзины группы
+    (TELEGRAM_GROUP_PER_MINUTE в минуту). Ответы на нажатия и правка уже
+    отправленных сообщений - не отправка в чат и берут только общий токен.
+    Поток ждёт, пока токены есть во всех нужных корзинах. На ответ
+    429 чат (или весь бот) ставится на паузу retry_after, и запрос
+    повторяется. Подключается как apihelper.CUSTOM_REQUEST_SENDER."""
+
+    # Служебные методы не отправляют сообщений и не ограничиваются
+    UNLIMITED_METHODS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo'}
+    # Методы, которые не отправляют сообщение в чат: корзины чата и группы не нужны
+    CHAT_EXEMPT_METHODS = {'answerCallbackQuery', 'editMessageText', 'editMessageReplyMarkup',
+                           'editMessageCaption', 'editMessageMedia'}
+    # Методы, повтор которых после обрыва соединения ничего не дублирует
+    IDEMPOTENT_METHODS = {'getUpdates', 'getMe', 'getChat', 'getChatMember', 'getChatAdministrators',
+                          'getChatMemberCount', 'getFile', 'getWebhookInfo', 'setWebhook', 'deleteWebhook',
+                          'editMessageText', 'editMessageReplyMarkup', 'deleteMessage',
+                          'pinChatMessage', 'unpinChatMessage', 'setMyCommands'}
+    # Сколько корзин чатов держать, прежде чем удалять неиспользуемые
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 group_per_minute=TELEGRAM_GROUP_PER_MINUTE, max_retries=TELEGRAM_MAX_RETRIES,
+                 chat_burst=TELEGRAM_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+        # Общие для всех потоков сессии: соединения переиспользуются, а не
+        # открываются заново (с TLS-рукопожатием) в каждом потоке
+        self._http = create_http_session(retry_reads=False)
+        self._http_idempotent = create_http_session(retry_reads=True)
+        # Метрики
+        self.waiting = 0
+        self.max_waiting = 0
+        self.requests = 0
+        self.delayed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.retries = 0
+
+    def _buckets(self, chat_id, now):
+        buckets = [self._global]
+        if chat_id is None:
+            return buckets
+        if len(self._chats) > self.MAX_IDLE_BUCKETS:
+            for table in (self._chats, self._groups):
+                for key in [key for key, bucket in table.items() if bucket.is_idle(now)]:
+                    del table[key]
+        buckets.append(self._chats.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst)))
+        if str(chat_id).startswith('-'):
+            buckets.append(self._groups.setdefault(
+                chat_id, TokenBucket(self.group_per_minute / 60, self.group_per_minute)))
+        return buckets
+
+    def _try_acquire(self, chat_id, start, queued):
+        """Взять токены, если они есть во всех корзинах
+
+        Возвращает (сколько ещё ждать, стоит ли запрос в очереди); 0 - токены взяты."""
+        with self._lock:
+            now = time.monotonic()
+            buckets = self._buckets(chat_id, now)
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                self.requests += 1
+                if queued:
+                    waited = now - start
+                    self.waiting -= 1
+                    self.delayed += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                return 0.0, queued
+            if not queued:
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+            return wait, True
+
+    def acquire(self, chat_id=None):
+        """Дождаться разрешения на запрос в чат; вернуть время ожидания (сек)"""
+        start = time.monotonic()
+        queued = False
+        while True:
+            wait, queued = self._try_acquire(chat_id, start, queued)
+            if wait <= 0:
+                return time.monotonic() - start
+            time.sleep(wait)
+
+    async def acquire_async(self, chat_id=None):
+        """То же, что acquire, но ожидание идёт в событийном цикле, а не во сне потока"""
+        start = time.monotonic()
+        queued = False
+        while True:
+            wait, queued = self._try_acquire(chat_id, start, queued)
+            if wait <= 0:
+                return time.monotonic() - start
+            await asyncio.sleep(wait)
+
+    def record_retry(self, method_name, chat_id, retry_after, attempt):
+        """Учесть ответ 429: пауза для чата (или всего бота) перед повтором"""
+        with self._lock:
+            self.retries += 1
+        logging.warning(f"⏳ Telegram 429 для {method_name} (чат {chat_id}): "
+                        f"пауза {retry_after} сек, повтор {attempt}/{self.max_retries}")
+        self.block(chat_id, retry_after)
+
+    def block(self, chat_id, seconds):
+        """Поставить чат (или весь бот, если chat_id нет) на паузу"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if chat_id is None:
+                self._global.block(until)
+            else:
+                for bucket in self._buckets(chat_id, time.monotonic())[1:]:
+                    bucket.block(until)
 
-        if event_type == "added":
-            title = "🔔 НОВОЕ ОТСУТСТВИЕ"
-            event_text = f"добавлен в список отсутствующих"
-        elif event_type == "removed":
-            title = "✅ ВОЗВРАЩЕНИЕ"
-            event_text = f"вышел из списка отсутствующих"
-        else:
-            title = "📢 УВЕДОМЛЕНИЕ"
-            event_text = "изменил статус отсутствия"
+    def _session(self, method_name):
+        return self._http_idempotent if method_name in self.IDEMPOTENT_METHODS else self._http
 
-        message_text = (
-            f"{title}\n\n"
-            f"👤 {fio}\n"
-            f"📋 {event_text}\n"
-            f"📌 Тип: {absence_type}"
-        )
+    @staticmethod
+    def _timeout(method_name, params):
+        """(соединение, ответ): getUpdates ждёт ответа дольше своего long polling"""
+        if method_name == 'getUpdates':
+            return HTTP_CONNECT_TIMEOUT, float((params or {}).get('timeout', 0)) + HTTP_POLL_READ_MARGIN
+        return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
 
-        logging.info(f"📢 Отправляем уведомления администраторам группы {group_chat_id}. "
-                    f"Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}. "
-                    f"Пользователь: {fio}, Событие: {event_text}")
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.json().get('parameters', {}).get('retry_after', 1))
+        except ValueError:
+            return 1.0
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """Выполнить HTTP-запрос к Bot API с учётом лимитов (сигнатура CUSTOM_REQUEST_SENDER)"""
+        method_name = url.rsplit('/', 1)[-1]
+        chat_id = (params or {}).get('chat_id')
+        attempt = 0
+        while True:
+            if method_name in self.CHAT_EXEMPT_METHODS:
+                self.acquire()
+            elif method_name not in self.UNLIMITED_METHODS:
+                self.acquire(chat_id)
+            # Таймауты telebot привязаны к таймауту polling, поэтому берём свои
+            response = self._session(method_name).request(method, url, params=params, files=files,
+                                                          timeout=self._timeout(method_name, params),
+                                                          proxies=proxies)
+            # Файлы уже прочитаны при первой отправке, такой запрос не повторяем
+            if response.status_code != 429 or attempt >= self.max_retries or files:
+                return response
+            attempt += 1
+            self.record_retry(method_name, chat_id, self._retry_after(response), attempt)
+
+    def stats(self):
+        """Метрики: очередь ожидающих запросов и время ожидания"""
+        with self._lock:
+            return {
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'requests': self.requests,
+                'delayed': self.delayed,
+                'avg_wait': self.wait_total / self.delayed if self.delayed else 0.0,
+                'max_wait': self.wait_max,
+                'retries_429': self.retries,
+                'chats': len(self._chats),
+            }
 
-        success_count = 0
-        failed_count = 0
+rate_limiter = TelegramRateLimiter()
+apihelper.CUSTOM_REQUEST_SENDER = rate_limiter.request
+
+# Ошибки Bot API: синхронный bot и AsyncTeleBot бросают разные, не связанные классы
+try:
+    from telebot import asyncio_helper
+    TELEGRAM_API_ERRORS = (apihelper.ApiTelegramException, asyncio_helper.ApiTelegramException)
+except ImportError:  # нет aiohttp - asyncio-транспорт недоступен
+    TELEGRAM_API_ERRORS = (apihelper.ApiTelegramException,)
+
+class FanOut:
+    """Результат одной рассылки: получатель -> None (доставлено) или исключение
+
+    Заполняется по мере отправки; по завершении пишет итог в лог и
+    вызывает on_done(fan_out)."""
+
+    def __init__(self, recipients, description, on_done=None):
+        self.recipients = list(recipients)
+        self.description = description
+        self.results = {}
+        self._remaining = len(self.recipients)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._on_done = on_done
+        if not self._remaining:
+            self._finish()
+
+    @property
+    def delivered(self):
+        return [recipient for recipient, error in self.results.items() if error is None]
+
+    @property
+    def failed(self):
+        return {recipient: error for recipient, error in self.results.items() if error is not None}
+
+    def wait(self, timeout=None):
+        """Дождаться окончания рассылки; вернуть False по таймауту"""
+        return self._done.wait(timeout)
+
+    def _record(self, recipient, error):
+        with self._lock:
+            self.results[recipient] = error
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        logging.info(f"📊 {self.description}: успешно {len(self.delivered)}/{len(self.recipients)}, "
+                     f"ошибок: {len(self.failed)}")
+        self._done.set()
+        if self._on_done:
+            try:
+                self._on_done(self)
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработки итогов рассылки '{self.description}': {e}")
+
+class NotificationDispatcher:
+    """Параллельная рассылка одного сообщения нескольким получателям
+
+    Отправки выполняются пулом из NOTIFY_WORKERS потоков, поэтому обработчик
+    не ждёт HTTP-запрос к каждому администратору. Очередь ограничена
+    NOTIFY_MAX_PENDING сообщениями: при переполнении fan_out ждёт
+    освобождения места, а не копит сообщения без предела."""
+
+    def __init__(self, send, workers=NOTIFY_WORKERS, max_pending=NOTIFY_MAX_PENDING):
+        self._send = send  # send(chat_id, text, **kwargs), например bot.send_message
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notify')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def fan_out(self, recipients, text, description, on_done=None, **kwargs):
+        """Разослать text получателям; вернуть FanOut с результатами по каждому"""
+        fan_out = FanOut(dict.fromkeys(recipients), description, on_done)
+        for recipient in fan_out.recipients:
+            self._slots.acquire()
+            try:
+                self._executor.submit(self._deliver, fan_out, recipient, text, kwargs)
+            except Exception as e:
+                self._slots.release()
+                fan_out._record(recipient, e)
+        return fan_out
 
-        for admin_id in admin_ids:
+    def _deliver(self, fan_out, recipient, text, kwargs):
+        error = None
+        try:
+            self._send(recipient, text, **kwargs)
+            logging.debug(f"✅ {fan_out.description}: отправлено {recipient}")
+        except Exception as e:
+            error = e
+            logging.error(f"❌ {fan_out.description}: ошибка отправки {recipient}: {e}")
+        finally:
+            self._slots.release()
+        fan_out._record(recipient, error)
+
+    def stop(self):
+        """Дослать поставленные в очередь сообщения и остановить пул"""
+        self._executor.shutdown(wait=True)
+
+notifier = NotificationDispatcher(bot.send_message)
+atexit.register(notifier.stop)
+
+class OutboxWorker:
+    """Доставка сообщений из outbox
+
+    Сообщения ставятся в outbox той же транзакцией, что и изменение данных,
+    поэтому не теряются при падении процесса или таймауте Telegram. Отдельный
+    поток забирает те, которые пора отправить, рассылает пачку параллельно и
+    записывает итоги. Неудачная попытка повторяется с экспоненциальной
+    задержкой; постоянная ошибка (бот заблокирован, чат не найден) или
+    исчерпанные попытки - dead-letter. После доставки и после dead-letter
+    вызываются обработчики по виду сообщения (kind). Недоставленное до
+    перезапуска уходит после старта, не задерживая обработку обновлений."""
+
+    def __init__(self, storage, send, workers=NOTIFY_WORKERS, batch_size=OUTBOX_BATCH_SIZE):
+        self.storage = storage
+        self.batch_size = batch_size
+        self._send = send  # send(chat_id, text, **options), например bot.send_message
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self._on_sent = {}
+        self._on_dead = {}
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        storage.add_outbox_listener(self.wake)
+
+    def on_sent(self, kind, callback):
+        """callback(message, sent) после доставки сообщения вида kind"""
+        self._on_sent[kind] = callback
+
+    def on_dead(self, kind, callback):
+        """callback(message, error) после dead-letter сообщения вида kind"""
+        self._on_dead[kind] = callback
+
+    def wake(self):
+        self._wake_event.set()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Остановить доставку; недоставленное останется в outbox до следующего запуска"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
             try:
-                bot.send_message(
-                    admin_id,
-                    message_text
-                )
-                logging.info(f"✅ Уведомление {event_type} отправлено администратору {admin_id}")
-                success_count += 1
+                delivered = self.deliver_due()
             except Exception as e:
-                logging.error(f"❌ Ошибка отправки уведомления администратору {admin_id}: {e}")
-                failed_count += 1
+                logging.error(f"❌ Ошибка доставки outbox: {e}")
+                delivered = 0
+            # Полная пачка - сразу берём следующую, иначе ждём новых сообщений или повторов
+            if delivered < self.batch_size:
+                self._wake_event.wait(OUTBOX_POLL_INTERVAL)
+
+    def deliver_due(self):
+        """Доставить пачку сообщений, которые пора отправить; вернуть их число"""
+        messages = self.storage.get_due_messages(self.batch_size)
+        if not messages:
+            return 0
+        results = []
+        for future in [self._executor.submit(self._deliver, *delivery) for delivery in self.plan(messages)]:
+            results.extend(future.result())
+        self.finish(results)
+        return len(messages)
+
+    @staticmethod
+    def plan(messages):
+        """Разложить сообщения по отправкам: (сообщения, chat_id, текст, options)
+
+        Накопленные уведомления одного администратора (kind='digest') уходят
+        одним сообщением-сводкой и получают общий итог доставки."""
+        deliveries, digests = [], {}
+        for message in messages:
+            if message['kind'] == 'digest':
+                digests.setdefault(message['chat_id'], []).append(message)
+            else:
+                deliveries.append(([message], message['chat_id'], message['text'], message['options']))
+        for chat_id, digest in digests.items():
+            text = digest[0]['text'] if len(digest) == 1 else render_digest(digest)
+            deliveries.append((digest, chat_id, text, {}))
+        return deliveries
+
+    def finish(self, results):
+        """Записать итоги доставки [(message, sent, error, permanent)] и вызвать обработчики"""
+        statuses = self.storage.record_deliveries(
+            [(message['id'], error, permanent) for message, _, error, permanent in results])
+
+        for message, sent, error, _ in results:
+            status = statuses[message['id']]
+            if status == 'sent':
+                callback, argument = self._on_sent.get(message['kind']), sent
+            elif status == 'dead':
+                logging.error(f"☠️ Сообщение outbox {message['id']} ({message['kind']}) для {message['chat_id']} "
+                              f"не доставлено после {message['attempts'] + 1} попыток: {error}")
+                callback, argument = self._on_dead.get(message['kind']), error
+            else:
+                continue
+            if callback:
+                try:
+                    callback(message, argument)
+                except Exception as e:
+                    logging.error(f"❌ Ошибка обработчика outbox ({message['kind']}): {e}")
+
+    @staticmethod
+    def failure(messages, chat_id, error):
+        """Итоги неудачной отправки: [(message, None, error, permanent)]"""
+        # 400/403: чат не найден, бот заблокирован - повтор не поможет
+        permanent = isinstance(error, TELEGRAM_API_ERRORS) and error.error_code in (400, 403)
+        logging.warning(f"⚠️ Не удалось доставить сообщения outbox "
+                        f"{', '.join(str(message['id']) for message in messages)} для {chat_id}: {error}")
+        return [(message, None, str(error), permanent) for message in messages]
+
+    def _deliver(self, messages, chat_id, text, options):
+        """Выполнить одну отправку: [(message, sent, error, permanent)]"""
+        try:
+            sent = self._send(chat_id, text, **options)
+        except Exception as e:
+            return self.failure(messages, chat_id, e)
+        return [(message, sent, None, False) for message in messages]
+
+def absence_started_messages(user_id, absence_type, fio, group_chat_id=None):
+    """Сообщения outbox о начале активного отсутствия (для Database.start_active_absence)
+
+    Возвращает функцию от ID отсутствия: сообщение в ЛС с кнопкой выхода и
+    уведомления администраторам группы. Сообщение с кнопкой привязывается к
+    отсутствию после доставки (handle_exit_prompt_sent), а если ЛС доставить
+    нельзя - в группу уходит инструкция (handle_exit_prompt_dead)."""
+    def build(absence_id):
+        exit_prompt = {
+            'chat_id': user_id,
+            'text': f"📢 Вы отмечены как отсутствующий:\n\n"
+                    f"{absence_type}\n\n"
+                    f"Нажмите кнопку ниже, когда вернётесь/выздоровеете.",
+            'options': {'reply_markup': create_exit_absence_keyboard().to_json()},
+            'kind': 'exit_prompt',
+            'dedup_key': f"exit_prompt:{absence_id}",
+            'payload': {'user_id': user_id, 'absence_id': absence_id, 'group_chat_id': group_chat_id,
+                        'fio': fio, 'absence_type': absence_type},
+        }
+        notices = group_admin_messages(group_chat_id, fio, absence_type, "added", absence_id) if group_chat_id else []
+        return [exit_prompt] + notices
+    return build
+
+def digest_flush_at(admin_id, now=None):
+    """Конец текущего окна сводки администратора (time.time())
+
+    Окна сдвинуты на admin_id % DIGEST_WINDOW, чтобы сводки разных
+    администраторов не уходили в одну и ту же секунду."""
+    now = time.time() if now is None else now
+    offset = admin_id % DIGEST_WINDOW
+    return ((now - offset) // DIGEST_WINDOW + 1) * DIGEST_WINDOW + offset
+
+def admin_notice(admin_id, text, dedup_key, event, group_chat_id, line):
+    """Уведомление outbox администратору: сразу или в сводку (режим 'digest')
+
+    В сводке сообщение ждёт конца окна администратора, и все накопленные за
+    окно уведомления уходят одним сообщением (см. OutboxWorker.plan);
+    line - строка события в сводке. Событие из DIGEST_URGENT_EVENTS уходит
+    сразу и забирает с собой накопленное."""
+    message = {'chat_id': admin_id, 'text': text, 'kind': 'admin_notice', 'dedup_key': dedup_key}
+    if db.get_notify_mode(admin_id) != 'digest':
+        return message
+    message['kind'] = 'digest'
+    message['payload'] = {'group': db.get_group_name(group_chat_id) or str(group_chat_id), 'line': line}
+    if event in DIGEST_URGENT_EVENTS:
+        message['flush_digest'] = True
+    else:
+        message['not_before'] = digest_flush_at(admin_id)
+    return message
+
+def render_digest(messages):
+    """Текст сводки из накопленных уведомлений администратору"""
+    events_by_group = {}
+    for message in messages:
+        events_by_group.setdefault(message['payload'].get('group'), []).append(message['payload'].get('line'))
+    text = f"🗂 Сводка уведомлений ({len(messages)})\n"
+    for group, events in events_by_group.items():
+        text += f"\n📋 {group}\n" + "".join(f"• {event}\n" for event in events)
+    return text.strip()
+
+def group_admin_messages(group_chat_id, fio, absence_type, event_type, event_id):
+    """Сообщения outbox администраторам группы о статусе отсутствия пользователя
+
+    event_id (ID отсутствия) входит в ключ дедупликации, чтобы одно событие
+    не дошло до администратора дважды."""
+    admin_ids = db.get_group_admins(group_chat_id)
 
-        logging.info(f"📊 Уведомления отправлены: успешно {success_count}/{len(admin_ids)} администраторам, ошибок: {failed_count}")
+    if not admin_ids:
+        logging.info(f"ℹ️ Нет администраторов для группы {group_chat_id}, уведомления не отправляются")
+        return []
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка при отправке уведомлений администраторам группы {group_chat_id}: {e}")
+    if event_type == "added":
+        title = "🔔 НОВОЕ ОТСУТСТВИЕ"
+        event_text = f"добавлен в список отсутствующих"
+    elif event_type == "removed":
+        title = "✅ ВОЗВРАЩЕНИЕ"
+        event_text = f"вышел из списка отсутствующих"
+    else:
+        title = "📢 УВЕДОМЛЕНИЕ"
+        event_text = "изменил статус отсутствия"
+
+    message_text = (
+        f"{title}\n\n"
+        f"👤 {fio}\n"
+        f"📋 {event_text}\n"
+        f"📌 Тип: {absence_type}"
+    )
+
+    logging.info(f"📢 Ставим в outbox уведомления администраторам группы {group_chat_id}. "
+                f"Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}. "
+                f"Пользователь: {fio}, Событие: {event_text}")
+
+    line = f"{'➕' if event_type == 'added' else '✅'} {fio} {event_text} ({absence_type})"
+    return [admin_notice(admin_id, message_text, f"{event_type}:{event_id}:{admin_id}", event_type, group_chat_id, line)
+            for admin_id in admin_ids]
+
+def handle_exit_prompt_sent(message, sent):
+    """Привязать доставленное сообщение с кнопкой 'Выхожу' к активному отсутствию"""
+    payload = message['payload']
+    db.set_active_absence_message(payload['user_id'], sent.message_id, message['chat_id'],
+                                  absence_id=payload['absence_id'])
+    logging.info(f"📬 Сообщение с кнопкой выхода доставлено пользователю {payload['user_id']}")
+
+def handle_exit_prompt_dead(message, error):
+    """ЛС с кнопкой выхода не доставлено - отправить инструкцию в группу"""
+    payload = message['payload']
+    if not payload.get('group_chat_id'):
+        return
+    logging.info(f"📬 Не удалось отправить ЛС пользователю {payload['user_id']}, отправляем инструкцию в группу")
+    db.enqueue_messages([{
+        'chat_id': payload['group_chat_id'],
+        'text': f"👤 {payload['fio']}\n"
+                f"📋 Отметил: {payload['absence_type']}\n\n"
+                f"⚠️ *Внимание:*\n"
+                f"Если вы не получили уведомление в личке, напишите /start боту.\n"
+                f"Это нужно сделать один раз, чтобы получить кнопку выхода.",
+        'options': {'parse_mode': 'Markdown'},
+        'kind': 'exit_prompt_instruction',
+        'dedup_key': f"exit_prompt_instruction:{payload['absence_id']}",
+    }])
+
+outbox = OutboxWorker(db, bot.send_message)
+outbox.on_sent('exit_prompt', handle_exit_prompt_sent)
+outbox.on_dead('exit_prompt', handle_exit_prompt_dead)
 
 def create_admin_keyboard(user_id=None):
     """Создать клавиатуру для администратора в ЛС"""
@@ -701,9 +3358,119 @@ def create_admin_keyboard(user_id=None):
 
     return keyboard
 
+# ===== МАРШРУТИЗАЦИЯ ОБНОВЛЕНИЙ =====
+
+class UpdateRouter:
+    """Таблица маршрутов для текстовых сообщений и нажатий inline-кнопок
+
+    Вместо цепочки предикатов telebot, которые проверяются по порядку
+    (часть - с чтением состояния из хранилища), обработчик выбирается
+    поиском в словарях: команда, точный текст кнопки, состояние
+    пользователя, данные или префикс данных нажатия. Состояние читается
+    не больше одного раза на сообщение.
+
+    Порядок для сообщения: команда (неизвестные команды игнорируются);
+    кнопка - в ЛС любая, в группе только с клавиатуры группы; обработчик
+    состояния (в группе None - обычное сообщение); остальные кнопки."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._commands = {}          # команда -> обработчик
+        self._buttons = {}           # текст -> (обработчик, кнопка клавиатуры группы)
+        self._states = {}            # ('group' | 'private', состояние) -> обработчик
+        self._callbacks = {}         # данные нажатия -> обработчик
+        self._callback_prefixes = {} # 'префикс_' -> обработчик
+
+    def command(self, *names):
+        def decorator(handler):
+            for name in names:
+                self._commands[name] = handler
+            return handler
+        return decorator
+
+    def button(self, text, group_keyboard=False):
+        """Кнопка reply-клавиатуры; group_keyboard - она есть на клавиатуре группы
+        и в группе важнее ввода, которого ждёт состояние пользователя"""
+        def decorator(handler):
+            self._buttons[text] = (handler, group_keyboard)
+            return handler
+        return decorator
+
+    def state(self, state, chat):
+        """Сообщение пользователя в состоянии state в чате chat ('group' или 'private')"""
+        def decorator(handler):
+            self._states[(chat, state)] = handler
+            return handler
+        return decorator
+
+    def callback(self, data):
+        def decorator(handler):
+            self._callbacks[data] = handler
+            return handler
+        return decorator
+
+    def callback_prefix(self, prefix):
+        """Нажатие с данными вида '<prefix><...>'; prefix заканчивается на '_'"""
+        def decorator(handler):
+            self._callback_prefixes[prefix] = handler
+            return handler
+        return decorator
+
+    def resolve_message(self, message):
+        """Обработчик текстового сообщения или None"""
+        text = message.text
+        if text.startswith('/'):
+            return self._commands.get(telebot.util.extract_command(text))
+        group = message.chat.type in ['group', 'supergroup']
+        button = self._buttons.get(text)
+        if button is not None and (button[1] or not group):
+            return button[0]
+        state, _ = self.storage.get_user_state(message.from_user.id)
+        handler = self._states.get(('group' if group else 'private', state))
+        if handler is not None:
+            return handler
+        return button[0] if button is not None else None
+
+    def resolve_callback(self, call):
+        """Обработчик нажатия inline-кнопки или None"""
+        data = call.data or ''
+        handler = self._callbacks.get(data)
+        if handler is None:
+            prefix, separator, _ = data.partition('_')
+            handler = self._callback_prefixes.get(prefix + separator)
+        return handler
+
+    def route_message(self, message):
+        handler = self.resolve_message(message)
+        if handler is not None:
+            handler(message)
+
+    def route_callback(self, call):
+        handler = self.resolve_callback(call)
+        if handler is not None:
+            handler(call)
+
+    def attach(self, telegram_bot):
+        """Зарегистрировать маршрутизатор в боте единственными обработчиками текста и нажатий"""
+        telegram_bot.message_handler(content_types=['text'])(self.route_message)
+        telegram_bot.callback_query_handler(func=lambda call: True)(self.route_callback)
+
+    def with_handler(self, handler, storage=None):
+        """Копия таблицы с одним обработчиком на всех маршрутах (для bench-routing)"""
+        copy = UpdateRouter(storage or self.storage)
+        copy._commands = dict.fromkeys(self._commands, handler)
+        copy._buttons = {text: (handler, group_keyboard) for text, (_, group_keyboard) in self._buttons.items()}
+        copy._states = dict.fromkeys(self._states, handler)
+        copy._callbacks = dict.fromkeys(self._callbacks, handler)
+        copy._callback_prefixes = dict.fromkeys(self._callback_prefixes, handler)
+        return copy
+
+router = UpdateRouter(db)
+router.attach(bot)
+
 # ===== ОБРАБОТЧИКИ КОМАНД =====
 
-@bot.message_handler(commands=['start'])
+@router.command('start')
 def handle_start(message):
     """Обработка /start для ЛС и групп
 
@@ -769,7 +3536,7 @@ def handle_start(message):
         except Exception as e:
             logging.error(f"Ошибка отправки сообщения в группу: {e}")
 
-@bot.message_handler(commands=['help'])
+@router.command('help')
 def handle_help(message):
     """Обработка /help для ЛС и групп"""
     if message.chat.type == 'private' and not is_user_allowed(message.from_user.id):
@@ -799,7 +3566,7 @@ def handle_help(message):
         except Exception as e:
             logging.error(f"Ошибка отправки помощи в группу: {e}")
 
-@bot.message_handler(commands=['keyboard'])
+@router.command('keyboard')
 def handle_keyboard(message):
     """Показать клавиатуру (только в группах)"""
     if message.chat.type in ['group', 'supergroup']:
@@ -813,7 +3580,7 @@ def handle_keyboard(message):
         except Exception as e:
             logging.error(f"Ошибка отправки клавиатуры: {e}")
 
-@bot.message_handler(commands=['list'])
+@router.command('list')
 def handle_list(message):
     """Показать список (только в группах)"""
     if message.chat.type in ['group', 'supergroup']:
@@ -840,7 +3607,7 @@ def handle_new_chat_member(message):
             )
             return
 
-@bot.message_handler(commands=['start_bind', 'bind_group'])
+@router.command('start_bind', 'bind_group')
 def handle_bind_group(message):
     """Обработчик команды привязки группы"""
     if message.chat.type not in ['group', 'supergroup']:
@@ -878,33 +3645,23 @@ def handle_bind_group(message):
         return
 
     # Добавляем запрос в pending_binds
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute('''INSERT INTO pending_binds (chat_id, requester_id, group_name)
-                     VALUES (?, ?, ?)''', (chat_id, user_id, group_name))
-        conn.commit()
-        pending_id = c.lastrowid
+        pending_id = db.add_pending_bind(chat_id, user_id, group_name)
     except Exception as e:
         logging.error(f"Ошибка сохранения запроса на привязку: {e}")
         bot.reply_to(message, "❌ Ошибка обработки запроса")
         return
-    finally:
-        conn.close()
 
     # Отправляем уведомление супер-админам
-    for admin_id in ALLOWED_USER_IDS:
-        try:
-            bot.send_message(
-                admin_id,
-                f"📢 Новый запрос на привязку группы:\n\n"
-                f"👤 Запросил: @{username} (ID: {user_id})\n"
-                f"💬 Группа: {group_name}\n"
-                f"🆔 ID группы: {chat_id}\n\n"
-                f"Для подтверждения используйте команду /gen_key {chat_id} @{username}"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+    notifier.fan_out(
+        ALLOWED_USER_IDS,
+        f"📢 Новый запрос на привязку группы:\n\n"
+        f"👤 Запросил: @{username} (ID: {user_id})\n"
+        f"💬 Группа: {group_name}\n"
+        f"🆔 ID группы: {chat_id}\n\n"
+        f"Для подтверждения используйте команду /gen_key {chat_id} @{username}",
+        f"Запрос на привязку группы {chat_id} супер-админам"
+    )
 
     # Отправляем подтверждение в группу
     bot.reply_to(message,
@@ -919,7 +3676,7 @@ def generate_activation_key(length=16):
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-@bot.message_handler(commands=['gen_key'])
+@router.command('gen_key')
 def handle_gen_key(message):
     """Обработчик генерации ключа активации"""
     if message.chat.type != 'private':
@@ -959,22 +3716,14 @@ def handle_gen_key(message):
     key = generate_activation_key()
 
     # Сохраняем ключ в базу
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
         logging.info(f"📝 Сохраняем ключ: key={key}, chat_id={chat_id} (тип: {type(chat_id)}), target_admin_id={target_user_id}")
-        c.execute('''INSERT INTO activation_keys
-                    (key, chat_id, target_admin_id)
-                    VALUES (?, ?, ?)''',
-                    (key, chat_id, target_user_id))
-        conn.commit()
+        db.add_activation_key(key, chat_id, target_user_id)
         logging.info(f"✅ Ключ {key} сохранён в БД для группы {chat_id} и пользователя {target_user_id}")
     except Exception as e:
         logging.error(f"Ошибка сохранения ключа активации: {e}")
         bot.reply_to(message, "❌ Ошибка генерации ключа")
         return
-    finally:
-        conn.close()
 
     # Отправляем ключ целевому пользователю
     try:
@@ -992,7 +3741,7 @@ def handle_gen_key(message):
 
     bot.reply_to(message, f"✅ Ключ активации для @{target_username} успешно сгенерирован и отправлен")
 
-@bot.message_handler(commands=['activate_key'])
+@router.command('activate_key')
 def handle_activate_key(message):
     """Обработчик активации ключа"""
     if message.chat.type != 'private':
@@ -1013,14 +3762,9 @@ def handle_activate_key(message):
     key = parts[1].strip()
 
     # Проверяем ключ в базе
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
         logging.info(f"🔍 Ищем ключ: {key}")
-        c.execute('''SELECT chat_id, target_admin_id, used
-                    FROM activation_keys
-                    WHERE key = ?''', (key,))
-        key_data = c.fetchone()
+        key_data = db.get_activation_key(key)
 
         if not key_data:
             logging.warning(f"⚠️ Ключ {key} не найден в базе")
@@ -1042,43 +3786,19 @@ def handle_activate_key(message):
 
         logging.info(f"✅ Проверки пройдены. Активируем админа {user_id} для группы {chat_id}")
 
-        # Обновляем статус ключа
-        c.execute('''UPDATE activation_keys
-                    SET used = 1, used_at = CURRENT_TIMESTAMP
-                    WHERE key = ?''', (key,))
+        # Отмечаем ключ использованным и сохраняем группу одной транзакцией
+        group_name = db.use_activation_key(key, chat_id)
         logging.info(f"✅ Ключ {key} отмечен как использованный")
-
-        # Получаем название группы из pending_binds
-        c.execute('''SELECT group_name FROM pending_binds WHERE chat_id = ? ORDER BY requested_at DESC LIMIT 1''', (chat_id,))
-        group_name_result = c.fetchone()
-
-        if group_name_result and group_name_result[0]:
-            group_name = group_name_result[0]
-            logging.info(f"📋 Найдено название из /start_bind: '{group_name}'")
-        else:
-            logging.warning(f"⚠️ Название группы из /start_bind не найдено для chat_id={chat_id}")
-            group_name = "название группы не указано"
-
         logging.info(f"📋 Используем название группы: '{group_name}'")
-
-        # Добавляем или обновляем группу (с названием ИЗ /start_bind, а НЕ из Telegram)
-        c.execute('''INSERT OR REPLACE INTO groups
-                    (chat_id, name, verified)
-                    VALUES (?, ?, 1)''', (chat_id, group_name))
         logging.info(f"✅ Группа {chat_id} сохранена с названием: '{group_name}' (из команды /start_bind, а не из Telegram)")
 
-        conn.commit()
-        logging.info(f"✅ Предварительные изменения закоммичены в БД")
-        conn.close()
-
-        # Добавляем администратора группы (используя метод класса с отдельным подключением)
+        # Добавляем администратора группы
         logging.info(f"📝 Добавляем администратора {target_admin_id} к группе {chat_id}...")
         success = db.add_group_admin(chat_id, target_admin_id)
 
         if success:
             # Проверяем, что админ действительно добавлен
-            group_admins = db.get_group_admins(chat_id)
-            if target_admin_id in group_admins:
+            if db.is_group_admin(chat_id, target_admin_id):
                 logging.info(f"✅ Администратор {target_admin_id} успешно добавлен и подтвержден в группе {chat_id}")
             else:
                 logging.error(f"❌ ОШИБКА: Администратор {target_admin_id} добавлен, но не найден при проверке в группе {chat_id}!")
@@ -1094,27 +3814,22 @@ def handle_activate_key(message):
         )
 
         # Уведомляем супер-админов
-        for admin_id in ALLOWED_USER_IDS:
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"📢 Ключ активации использован:\n\n"
-                    f"👤 Активировал: @{message.from_user.username or user_id}\n"
-                    f"💬 Группа: {group_name}\n"
-                    f"🆔 ID группы: {chat_id}"
-                )
-            except Exception as e:
-                logging.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        notifier.fan_out(
+            ALLOWED_USER_IDS,
+            f"📢 Ключ активации использован:\n\n"
+            f"👤 Активировал: @{message.from_user.username or user_id}\n"
+            f"💬 Группа: {group_name}\n"
+            f"🆔 ID группы: {chat_id}",
+            f"Активация ключа для группы {chat_id} супер-админам"
+        )
 
     except Exception as e:
         logging.error(f"Ошибка активации ключа: {e}")
         bot.reply_to(message, "❌ Ошибка активации ключа")
-    finally:
-        conn.close()
 
 # ===== КОМАНДЫ ТОЛЬКО ДЛЯ ЛИЧНЫХ СООБЩЕНИЙ =====
 
-@bot.message_handler(commands=['set_fio'])
+@router.command('set_fio')
 def handle_set_fio(message):
     """Регистрация ФИО (только в ЛС)"""
     if message.chat.type == 'private':
@@ -1123,7 +3838,7 @@ def handle_set_fio(message):
             return
         process_set_fio_command(message)
 
-@bot.message_handler(commands=['set_admin'])
+@router.command('set_admin')
 def handle_set_admin(message):
     """Назначение администратора (только в ЛС)"""
     if message.chat.type == 'private':
@@ -1145,7 +3860,7 @@ def handle_set_admin(message):
         except Exception as e:
             logging.error(f"Ошибка отправки назначения админа: {e}")
 
-@bot.message_handler(commands=['report'])
+@router.command('report')
 def handle_report(message):
     """Получить отчёт (работает везде)"""
     try:
@@ -1160,11 +3875,12 @@ def handle_report(message):
             if groups:
                 # Если администратор привязан к группам - отправляем отчеты по всем группам
                 logging.info(f"📨 Отправляем отчёты администратору @{admin_username} по {len(groups)} группам")
+                # Отчёты всех групп одним запросом
+                reports = get_daily_reports(chat_id for chat_id, _ in groups)
 
                 for chat_id, group_name in groups:
                     try:
-                        # Получаем отчет для группы
-                        report = get_group_report(chat_id)
+                        report = reports[chat_id]['text'] if reports[chat_id]['absences'] else None
                         if report:
                             bot.send_message(
                                 message.chat.id,
@@ -1199,24 +3915,220 @@ def handle_report(message):
     except Exception as e:
         logging.error(f"❌ Ошибка отправки отчёта: {e}")
 
+@router.command('stats')
+def handle_stats(message):
+    """Статистика отсутствий за месяц по группам администратора (из архивных сводок)"""
+    if message.chat.type != 'private':
+        bot.reply_to(message, "⛔ Эта команда доступна только в личных сообщениях")
+        return
+
+    admin_id = message.from_user.id
+    groups = db.get_admin_groups(admin_id)
+    if not groups:
+        bot.reply_to(message, "ℹ️ Вы не привязаны ни к одной группе как администратор")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    month = parts[1].strip() if len(parts) > 1 else date.today().strftime('%Y-%m')
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        bot.reply_to(message,
+            "❌ Неверный формат!\n\n"
+            "✅ Правильно:\n"
+            "/stats ГГГГ-ММ\n\n"
+            "Пример:\n"
+            "/stats 2025-10")
+        return
+
+    try:
+        text = f"📈 Статистика отсутствий за {month}\n"
+        if month == date.today().strftime('%Y-%m'):
+            text += "(текущий месяц - по вчерашний день включительно)\n"
+
+        for chat_id, group_name in groups:
+            by_type, by_reason = db.get_group_month_stats(chat_id, month)
+            text += f"\n📋 {group_name or chat_id}\n"
+            if not by_type:
+                text += "Нет данных\n"
+                continue
+            for absence_type, absences, users in by_type:
+                text += f"• {format_absence_type(absence_type)}: {absences} (человек: {users})\n"
+            text += "Причины:\n"
+            for reason, absences in by_reason:
+                text += f"• {format_reason_for_report(reason)} - {absences}\n"
+
+        bot.send_message(message.chat.id, text)
+        logging.info(f"📈 Статистика за {month} отправлена администратору {admin_id}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка получения статистики: {e}")
+        bot.reply_to(message, "❌ Ошибка при получении статистики")
+
+@router.command('live_report')
+def handle_live_report(message):
+    """Включить или выключить живой отчёт в группе (для администраторов группы)"""
+    if message.chat.type not in ['group', 'supergroup']:
+        bot.reply_to(message, "⛔ Эта команда доступна только в группах")
+        return
+
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    if user_id not in SUPER_ADMINS and not db.is_group_admin(chat_id, user_id):
+        bot.reply_to(message, "⛔ Эта функция доступна только администраторам группы")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    mode = parts[1].strip().lower() if len(parts) > 1 else ''
+    if mode not in ('on', 'off'):
+        status = "включён" if live_reports.is_enabled(chat_id) else "выключен"
+        bot.reply_to(message,
+            f"📌 Живой отчёт сейчас {status}\n\n"
+            "Бот держит одно закреплённое сообщение с отчётом за день и обновляет его при изменениях "
+            "вместо новых сообщений.\n\n"
+            "✅ Правильно:\n"
+            "/live_report on\n"
+            "/live_report off")
+        return
+
+    try:
+        live_reports.set_enabled(chat_id, mode == 'on')
+        logging.info(f"📌 Живой отчёт в группе {chat_id} {'включён' if mode == 'on' else 'выключен'} пользователем {user_id}")
+        bot.reply_to(message, "✅ Живой отчёт включён" if mode == 'on' else "✅ Живой отчёт выключен")
+    except Exception as e:
+        logging.error(f"❌ Ошибка переключения живого отчёта в группе {chat_id}: {e}")
+        bot.reply_to(message, "❌ Ошибка при переключении живого отчёта")
+
+@router.command('digest')
+def handle_digest(message):
+    """Включить или выключить сводку уведомлений (для администраторов групп)"""
+    if message.chat.type != 'private':
+        bot.reply_to(message, "⛔ Эта команда доступна только в личных сообщениях")
+        return
+
+    admin_id = message.from_user.id
+    if admin_id not in SUPER_ADMINS and not db.get_admin_groups(admin_id):
+        bot.reply_to(message, "ℹ️ Вы не привязаны ни к одной группе как администратор")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    mode = parts[1].strip().lower() if len(parts) > 1 else ''
+    window_minutes = round(DIGEST_WINDOW / 60)
+    if mode not in ('on', 'off'):
+        status = "включена" if db.get_notify_mode(admin_id) == 'digest' else "выключена"
+        bot.reply_to(message,
+            f"🗂 Сводка уведомлений сейчас {status}\n\n"
+            f"Уведомления о новых отсутствиях и возвращениях собираются за {window_minutes} мин "
+            "и приходят одним сообщением. Запросы на подтверждение причин приходят сразу.\n\n"
+            "✅ Правильно:\n"
+            "/digest on\n"
+            "/digest off")
+        return
+
+    try:
+        db.set_notify_mode(admin_id, 'digest' if mode == 'on' else 'instant')
+        logging.info(f"🗂 Администратор {admin_id} {'включил' if mode == 'on' else 'выключил'} сводку уведомлений")
+        bot.reply_to(message,
+            f"✅ Сводка включена: уведомления будут приходить раз в {window_minutes} мин" if mode == 'on'
+            else "✅ Сводка выключена: уведомления будут приходить сразу")
+    except Exception as e:
+        logging.error(f"❌ Ошибка переключения сводки уведомлений для {admin_id}: {e}")
+        bot.reply_to(message, "❌ Ошибка при переключении сводки уведомлений")
+
+@router.command('report_time')
+def handle_report_time(message):
+    """Время ежедневного отчёта: в ЛС - для себя, в группе - для группы"""
+    user_id = message.from_user.id
+    is_group = message.chat.type in ['group', 'supergroup']
+    if is_group:
+        if user_id not in SUPER_ADMINS and not db.is_group_admin(message.chat.id, user_id):
+            bot.reply_to(message, "⛔ Эта функция доступна только администраторам группы")
+            return
+    elif user_id not in SUPER_ADMINS and not db.get_admin_groups(user_id):
+        bot.reply_to(message, "ℹ️ Вы не привязаны ни к одной группе как администратор")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    value = parts[1].strip().lower() if len(parts) > 1 else ''
+    report_time = parse_report_time(value)
+    if not report_time and not (is_group and value == 'off'):
+        bot.reply_to(message,
+            "❌ Неверный формат!\n\n"
+            "✅ Правильно:\n"
+            "/report_time ЧЧ:ММ\n" +
+            ("/report_time off - не присылать отчёт в группу\n" if is_group else "") +
+            "\nПример:\n"
+            "/report_time 08:30")
+        return
+
+    try:
+        if is_group:
+            db.set_group_report_time(message.chat.id, report_time)
+        else:
+            db.set_admin_report_time(user_id, report_time)
+        report_scheduler.reload()
+        if report_time:
+            logging.info(f"⏰ Время отчёта {report_time} установлено для {'группы ' + str(message.chat.id) if is_group else 'администратора ' + str(user_id)}")
+            bot.reply_to(message, f"✅ Ежедневный отчёт будет приходить в {report_time}")
+        else:
+            logging.info(f"⏰ Ежедневный отчёт в группу {message.chat.id} отключён")
+            bot.reply_to(message, "✅ Ежедневный отчёт в группу отключён")
+    except Exception as e:
+        logging.error(f"❌ Ошибка установки времени отчёта: {e}")
+        bot.reply_to(message, "❌ Ошибка при установке времени отчёта")
+
+@router.command('limits')
+def handle_limits(message):
+    """Метрики ограничителя запросов к Telegram (для супер-админов)"""
+    if message.from_user.id not in SUPER_ADMINS:
+        bot.reply_to(message, "⛔ Эта функция доступна только супер-администраторам")
+        return
+
+    stats = rate_limiter.stats()
+    bot.reply_to(message,
+        f"🚦 Ограничение запросов к Telegram\n\n"
+        f"Ждут отправки сейчас: {stats['waiting']} (максимум: {stats['max_waiting']})\n"
+        f"Запросов: {stats['requests']}, из них ждали: {stats['delayed']}\n"
+        f"Ожидание: среднее {stats['avg_wait']:.2f} сек, максимальное {stats['max_wait']:.2f} сек\n"
+        f"Повторов после 429: {stats['retries_429']}\n"
+        f"Чатов с лимитом: {stats['chats']}"
+    )
+
+@router.command('queues')
+def handle_queues(message):
+    """Метрики очередей обработки обновлений (для супер-админов)"""
+    if message.from_user.id not in SUPER_ADMINS:
+        bot.reply_to(message, "⛔ Эта функция доступна только супер-администраторам")
+        return
+
+    stats = update_executor.stats()
+    lines = [f"#{index}: в очереди {queue_stats['depth']}, задержка {queue_stats['lag']:.2f} сек "
+             f"(макс. {queue_stats['max_lag']:.2f}), обработано {queue_stats['processed']}"
+             for index, queue_stats in enumerate(stats)]
+    bot.reply_to(message,
+        f"🧵 Очереди обработки обновлений\n\n"
+        f"Всего в очереди: {sum(queue_stats['depth'] for queue_stats in stats)}\n\n" +
+        "\n".join(lines)
+    )
+
 # ===== ОБРАБОТЧИК ДЛЯ РЕГИСТРАЦИИ USERNAME ОТ ЛЮБОГО СООБЩЕНИЯ =====
 
-@bot.message_handler(func=lambda message:
-                     message.chat.type in ['group', 'supergroup'] and
-                     message.text and
-                     not message.text.startswith('/') and
-                     message.text not in ['❌ Отсутствую', '📊 Получить отчёт'] and
-                     db.get_user_state(message.from_user.id)[0] is None,
-                     content_types=['text'])
+@router.state(None, chat='group')
 def register_user_from_message(message):
     """Регистрировать username пользователя от любого сообщения в группе"""
     if message.from_user and message.from_user.username:
-        db.update_username(message.from_user.username, message.from_user.id)
-        logging.info(f"Username зарегистрирован: @{message.from_user.username} (ID: {message.from_user.id})")
+        if db.update_username(message.from_user.username, message.from_user.id):
+            logging.info(f"Username зарегистрирован: @{message.from_user.username} (ID: {message.from_user.id})")
+
+def is_plain_group_message(message):
+    """Обычное сообщение в группе: не команда, не кнопка и пользователь ничего не вводит
+
+    Такое сообщение только регистрирует username (register_user_from_message)."""
+    return (message.content_type == 'text' and bool(message.text) and
+            router.resolve_message(message) is register_user_from_message)
 
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ КНОПОК =====
 
-@bot.message_handler(func=lambda message: message.text == '❌ Отсутствую')
+@router.button('❌ Отсутствую', group_keyboard=True)
 def handle_absence(message):
     """Обработчик кнопки отсутствия"""
     user_id = message.from_user.id
@@ -1238,9 +4150,115 @@ def handle_absence(message):
         except Exception as e:
             logging.error(f"❌ Ошибка отправки клавиатуры причин пользователю @{username}: {e}")
 
+# ===== ИДЕМПОТЕНТНОСТЬ НАЖАТИЙ INLINE КНОПОК =====
+
+class IdempotencyCache:
+    """Недавние результаты операций по ключам с ограниченным временем жизни
+
+    На время операции ключи захватываются (claim), после неё хранят
+    результат ttl секунд (finish). Повтор с любым из ключей получает
+    сохранённый результат, а пока операция идёт - IN_PROGRESS. Операция,
+    не давшая результата (ошибка), освобождает ключи (release)."""
+
+    IN_PROGRESS = object()
+
+    def __init__(self, ttl=CALLBACK_RESULT_TTL):
+        self.ttl = ttl
+        self._items = {}  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self._next_purge = 0
+        self.hits = 0
+
+    def claim(self, keys):
+        """Захватить ключи: (True, None) или (False, результат первого занятого ключа)"""
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_purge:
+                self._items = {key: item for key, item in self._items.items() if item[0] > now}
+                self._next_purge = now + 1
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None and item[0] > now:
+                    self.hits += 1
+                    return False, item[1]
+            for key in keys:
+                self._items[key] = (float('inf'), self.IN_PROGRESS)
+            return True, None
+
+    def finish(self, keys, result):
+        """Запомнить результат операции на ttl секунд"""
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._items[key] = (expires_at, result)
+
+    def release(self, keys):
+        """Освободить ключи операции, не записавшей результат"""
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None and item[1] is self.IN_PROGRESS:
+                    del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+callback_results = IdempotencyCache()
+
+class CallbackAnswer:
+    """Ответ обработчика inline-кнопки, обёрнутого idempotent_callback
+
+    final - итог операции: он запоминается и отдаётся повторным нажатиям
+    (с текстом repeat_text, если для повтора нужен другой). Ответ с
+    final=False (ошибка, невыполненное условие, нет прав) только
+    отправляется, и следующее нажатие выполнит операцию заново."""
+
+    def __init__(self, text=None, final=True, repeat_text=None):
+        self.text = text
+        self.final = final
+        self.repeat_text = repeat_text
+
+def idempotent_callback(operation_key):
+    """Декоратор обработчика inline-кнопки: повторы отвечаются из callback_results
+
+    Ключи - id нажатия (повторная доставка того же обновления) и логическая
+    операция operation_key(call), например запрос pending_id: второй
+    администратор или двойное нажатие получают ответ первого без обращений
+    к БД и повторных уведомлений. Обработчик возвращает CallbackAnswer, а
+    отвечает на нажатие декоратор; ключи операции без итога освобождаются."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(call):
+            keys = [f"call:{call.id}"]
+            operation = operation_key(call)
+            if operation is not None:
+                keys.append(operation)
+            claimed, result = callback_results.claim(keys)
+            if not claimed:
+                text = "⏳ Уже обрабатывается" if result is IdempotencyCache.IN_PROGRESS else result
+                logging.info(f"🔁 Повторное нажатие {call.data} от {call.from_user.id}: ответ из кэша")
+                try:
+                    bot.answer_callback_query(call.id, text)
+                except Exception as e:
+                    logging.warning(f"⚠️ Не удалось ответить на повторное нажатие {call.id}: {e}")
+                return
+            try:
+                answer = handler(call)
+                if answer.final:
+                    callback_results.finish(keys, answer.repeat_text or answer.text)
+            finally:
+                callback_results.release(keys)
+            try:
+                bot.answer_callback_query(call.id, answer.text)
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось ответить на нажатие {call.id}: {e}")
+        return wrapper
+    return decorator
+
 # ===== ОБРАБОТЧИКИ INLINE КНОПОК =====
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('reason_'))
+@router.callback_prefix('reason_')
+@idempotent_callback(lambda call: f"reason:{call.from_user.id}:{call.message.chat.id}:{call.message.message_id}:{call.data}")
 def handle_reason_selection(call):
     """Обработчик выбора причины через inline-кнопки"""
     try:
@@ -1256,8 +4274,7 @@ def handle_reason_selection(call):
 
         if state not in valid_states:
             logging.warning(f"⚠️ Пользователь @{username} не в нужном состоянии (state: {state})")
-            bot.answer_callback_query(call.id, "❌ Сначала нажмите '❌ Отсутствую'")
-            return
+            return CallbackAnswer("❌ Сначала нажмите '❌ Отсутствую'", final=False)
 
         if reason_type == 'reason_cancel':
             # Отмена - очищаем состояние
@@ -1268,8 +4285,7 @@ def handle_reason_selection(call):
                 call.message.message_id
             )
             logging.info(f"❌ Пользователь @{username} отменил выбор причины")
-            bot.answer_callback_query(call.id)
-            return
+            return CallbackAnswer()
 
         elif reason_type == 'reason_other':
             # Для "Другого" просим ввести причину
@@ -1310,20 +4326,19 @@ def handle_reason_selection(call):
                         call.message.message_id
                     )
                     db.clear_user_state(user_id)
-                    bot.answer_callback_query(call.id, "❌ Вы уже отмечены как отсутствующий")
-                    return
+                    return CallbackAnswer("❌ Вы уже отмечены как отсутствующий")
 
             is_active_type = reason_type in ['reason_boleyu', 'reason_otpusk']
             group_chat_id = call.message.chat.id if call.message.chat.type in ['group', 'supergroup'] else None
 
-            # Удаляем старые записи об отсутствии этого пользователя на сегодня
-            db.remove_absence_from_today(user_id)
-            # Удаляем активное отсутствие если было
-            db.remove_active_absence(user_id)
-
-            if not is_active_type:
-                db.add_absence(user_id, 'уважительно', reason_text, group_chat_id)
-            db.clear_user_state(user_id)
+            # Одной транзакцией заменяем прежние отметки на новую и очищаем состояние;
+            # для "Болею"/"Отпуск" туда же ставятся ЛС с кнопкой выхода и уведомления админам
+            if is_active_type:
+                fio = db.get_user_fio(user_id) or (f"@{username}" if username and username != f"ID: {user_id}" else f"ID: {user_id}")
+                db.start_active_absence(user_id, reason_text, group_chat_id,
+                                        messages=absence_started_messages(user_id, reason_text, fio, group_chat_id))
+            else:
+                db.mark_absent(user_id, 'уважительно', reason_text, group_chat_id)
             logging.info(f"💾 Отсутствие записано для @{username}: {reason_text}")
 
             # Обновляем сообщение с подтверждением
@@ -1343,48 +4358,18 @@ def handle_reason_selection(call):
                 call.message.message_id
             )
 
-            # Если это "Болею" или "Отпуск", отправляем в ЛС (там уже добавится в активный список)
-            if reason_type in ['reason_boleyu', 'reason_otpusk']:
-                logging.info(f"⏳ Пользователь @{username} будет добавлен в список активных отсутствующих через ЛС: {reason_text}")
-
-                # Получаем ФИО пользователя
-                fio = db.get_user_fio(user_id) or (f"@{username}" if username and username != f"ID: {user_id}" else f"ID: {user_id}")
-
-                # Пытаемся отправить уведомление в личные сообщения И администраторам группы
-                pm_sent = send_absence_notification_to_private(user_id, reason_text, username, fio, group_chat_id=group_chat_id)
-
-                # Если не удалось отправить в ЛС, отправляем инструкцию в группу
-                if not pm_sent:
-                    logging.info(f"📬 Не удалось отправить ЛС, отправляем инструкцию в группу для @{username}")
-                    try:
-                        instruction_text = (
-                            f"👤 {fio}\n"
-                            f"📋 Отметил: {reason_text}\n\n"
-                            f"⚠️ *Внимание:*\n"
-                            f"Если вы не получили уведомление в личке, напишите /start боту.\n"
-                            f"Это нужно сделать один раз, чтобы получить кнопку выхода."
-                        )
-                        bot.send_message(
-                            call.message.chat.id,
-                            instruction_text,
-                            parse_mode='Markdown'
-                        )
-                        logging.info(f"✅ Инструкция отправлена в группу для @{username}")
-                    except Exception as e:
-                        logging.error(f"❌ Ошибка отправки инструкции в группу: {e}")
+            if is_active_type:
+                logging.info(f"📨 ЛС с кнопкой выхода для @{username} поставлено в outbox: {reason_text}")
 
-        bot.answer_callback_query(call.id)
+        return CallbackAnswer()
 
     except Exception as e:
         logging.error(f"❌ Ошибка обработки выбора причины: {e}")
-        bot.answer_callback_query(call.id, "Ошибка обработки")
+        return CallbackAnswer("Ошибка обработки", final=False)
 
 # ===== ОБРАБОТЧИК ТЕКСТОВЫХ СООБЩЕНИЙ ДЛЯ ПРИЧИНЫ "ДРУГОЕ" =====
 
-@bot.message_handler(func=lambda message:
-                     message.chat.type in ['group', 'supergroup'] and
-                     message.text != '📊 Получить отчёт' and
-                     db.get_user_state(message.from_user.id)[0] == 'waiting_for_custom_reason')
+@router.state('waiting_for_custom_reason', chat='group')
 def handle_custom_reason_input(message):
     """Обработчик ввода пользовательской причины"""
     user_id = message.from_user.id
@@ -1394,39 +4379,31 @@ def handle_custom_reason_input(message):
 
     logging.info(f"📝 Пользователь @{username} ввёл причину: {reason} в группе {group_chat_id}")
 
-    # Добавляем в ожидающие подтверждения
-    pending_id = db.add_pending_absence(user_id, reason, group_chat_id)
-    db.clear_user_state(user_id)
-    logging.info(f"⏳ Причина добавлена в очередь на подтверждение. ID запроса: {pending_id}, группа: {group_chat_id}")
-
-    # Отправляем админам конкретной группы на подтверждение
+    # Запросы админам конкретной группы ставятся в outbox той же транзакцией
     admin_ids = db.get_group_admins(group_chat_id)
-    if admin_ids:
-        fio = db.get_user_fio(user_id) or f"ID: {user_id}"
-        keyboard = create_admin_decision_keyboard(pending_id)
-
-        logging.info(f"📨 Отправляем запрос на подтверждение причины администраторам группы {group_chat_id}. Причина: '{reason}', ФИО: {fio}, Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}")
+    fio = db.get_user_fio(user_id) or f"ID: {user_id}"
 
-        success_count = 0
-        failed_count = 0
-
-        for admin_id in admin_ids:
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"📢 Запрос на подтверждение причины:\n\n"
+    def approval_requests(pending_id):
+        keyboard = create_admin_decision_keyboard(pending_id).to_json()
+        return [{
+            'chat_id': admin_id,
+            'text': f"📢 Запрос на подтверждение причины:\n\n"
                     f"👤 {fio}\n"
                     f"📝 Причина: {reason}\n\n"
                     f"Выберите тип отсутствия:",
-                    reply_markup=keyboard
-                )
-                logging.info(f"✅ Запрос на подтверждение (ID {pending_id}) успешно отправлен администратору {admin_id} группы {group_chat_id}")
-                success_count += 1
-            except Exception as e:
-                logging.error(f"❌ Ошибка отправки запроса (ID {pending_id}) администратору {admin_id}: {e}")
-                failed_count += 1
+            'options': {'reply_markup': keyboard},
+            'kind': 'approval_request',
+            'dedup_key': f"approval_request:{pending_id}:{admin_id}",
+            # Запрос ждёт решения - заодно отправляем накопленную сводку
+            'flush_digest': 'approval' in DIGEST_URGENT_EVENTS,
+        } for admin_id in admin_ids]
+
+    # Добавляем в ожидающие подтверждения и очищаем состояние
+    pending_id = db.submit_custom_reason(user_id, reason, group_chat_id, messages=approval_requests)
+    logging.info(f"⏳ Причина добавлена в очередь на подтверждение. ID запроса: {pending_id}, группа: {group_chat_id}")
 
-        logging.info(f"✅ Запрос на подтверждение причины отправлен: успешно {success_count}/{len(admin_ids)} администраторам группы {group_chat_id}, ошибок: {failed_count}")
+    if admin_ids:
+        logging.info(f"📨 Запрос на подтверждение причины поставлен в outbox для администраторов группы {group_chat_id}. Причина: '{reason}', ФИО: {fio}, Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}")
     else:
         logging.error(f"❌ Администраторы для группы {group_chat_id} не назначены. Запрос не может быть обработан")
 
@@ -1439,7 +4416,7 @@ def handle_custom_reason_input(message):
 
 # ===== ОБРАБОТЧИКИ КНОПОК В ЛС =====
 
-@bot.message_handler(func=lambda message: message.text == '📊 Получить отчёт')
+@router.button('📊 Получить отчёт', group_keyboard=True)
 def handle_get_report(message):
     """Обработчик кнопки отчёта"""
     try:
@@ -1452,10 +4429,11 @@ def handle_get_report(message):
             admin_groups = db.get_admin_groups(user_id)
             logging.info(f"📊 Получены группы администратора: {admin_groups}")
             if admin_groups:
-                # Отправляем отчет для каждой группы администратора
+                # Отчёты всех групп одним запросом, отправляем по сообщению на группу
+                reports = get_daily_reports(chat_id for chat_id, _ in admin_groups)
                 for chat_id, group_name in admin_groups:
                     logging.info(f"📊 Отправляем отчет администратору {user_id} для группы {chat_id} (название из БД: '{group_name}')")
-                    send_today_report_to_chat(message.chat.id, group_chat_id=chat_id)
+                    send_today_report_to_chat(message.chat.id, group_chat_id=chat_id, report=reports[chat_id])
             else:
                 # Если администратор не привязан ни к какой группе, показываем все отсутствия
                 logging.info(f"📊 Администратор {user_id} не привязан к группам, показываем все отсутствия")
@@ -1467,7 +4445,7 @@ def handle_get_report(message):
         logging.error(f"❌ Ошибка обработки отчёта: {e}")
         bot.reply_to(message, "❌ Ошибка при получении отчёта.")
 
-@bot.message_handler(func=lambda message: message.text == '📋 Текущие болеющие/в отпуске')
+@router.button('📋 Текущие болеющие/в отпуске')
 def handle_active_list_button(message):
     """Обработчик кнопки списка текущих отсутствующих"""
     if message.chat.type != 'private':
@@ -1495,7 +4473,7 @@ def handle_active_list_button(message):
         logging.error(f"Ошибка отправки списка активных: {e}")
         bot.reply_to(message, "❌ Ошибка при получении списка")
 
-@bot.message_handler(func=lambda message: message.text == '📝 Регистрация')
+@router.button('📝 Регистрация')
 def handle_private_registration(message):
     if message.chat.type == 'private':
         user_id = message.from_user.id
@@ -1523,7 +4501,7 @@ def handle_private_registration(message):
         except Exception as e:
             logging.error(f"Ошибка отправки подсказки регистрации: {e}")
 
-@bot.message_handler(func=lambda message: message.text == 'ℹ️ Информация')
+@router.button('ℹ️ Информация')
 def handle_private_info(message):
     if message.chat.type == 'private':
         user_id = message.from_user.id
@@ -1576,7 +4554,7 @@ def handle_private_info(message):
         except Exception as e:
             logging.error(f"Ошибка в информации в ЛС: {e}")
 
-@bot.message_handler(func=lambda message: message.text == '🗑️ Удалить админа из группы')
+@router.button('🗑️ Удалить админа из группы')
 def handle_remove_group_admin(message):
     """Обработчик кнопки удаления админа из группы"""
     if message.chat.type != 'private':
@@ -1597,8 +4575,9 @@ def handle_remove_group_admin(message):
 
         # Формируем список
         text = "🗑️ **Администраторы групп:**\n\n"
+        admin_fios = db.get_user_fios(admin_id for _, _, admin_id in all_admins)
         for i, (chat_id, group_name, admin_id) in enumerate(all_admins, 1):
-            admin_fio = db.get_user_fio(admin_id) or f"ID: {admin_id}"
+            admin_fio = admin_fios[admin_id] or f"ID: {admin_id}"
             text += f"`{i}. {group_name} - {admin_fio} (ID: {admin_id})`\n"
 
         text += f"\n📝 Введите номер администратора для удаления (1-{len(all_admins)}):"
@@ -1612,9 +4591,7 @@ def handle_remove_group_admin(message):
         logging.error(f"❌ Ошибка при получении списка администраторов: {e}")
         bot.reply_to(message, "❌ Ошибка при получении списка администраторов")
 
-@bot.message_handler(func=lambda message:
-                     message.chat.type == 'private' and
-                     db.get_user_state(message.from_user.id)[0] == 'waiting_for_admin_removal')
+@router.state('waiting_for_admin_removal', chat='private')
 def handle_admin_removal_input(message):
     """Обработчик ввода номера администратора для удаления"""
     try:
@@ -1657,28 +4634,36 @@ def handle_admin_removal_input(message):
 
 # ===== ОБРАБОТЧИК ВЫХОДА ИЗ ОТСУТСТВИЯ =====
 
-@bot.callback_query_handler(func=lambda call: call.data == 'exit_absence')
+@router.callback('exit_absence')
+@idempotent_callback(lambda call: f"exit:{call.from_user.id}:{call.message.chat.id}:{call.message.message_id}")
 def handle_exit_absence(call):
     """Обработчик нажатия кнопки 'Выхожу'"""
     try:
         user_id = call.from_user.id
         fio = db.get_user_fio(user_id) or f"ID: {user_id}"
 
-        # Получаем информацию об отсутствии
-        absence_info = db.get_active_absence(user_id)
+        def returned_notices(absence):
+            group_chat_id = absence[5]
+            admin_ids = db.get_group_admins(group_chat_id) if group_chat_id else []
+            logging.info(f"📢 Ставим в outbox уведомление о возвращении администраторам группы {group_chat_id}. ФИО: {fio}, Причина: {absence[2]}, Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}")
+            text = (f"📢 Уведомление о возвращении:\n\n"
+                    f"👤 {fio}\n"
+                    f"📋 Причина: {absence[2]}\n"
+                    f"✅ Вышел из списка отсутствующих")
+            return [admin_notice(admin_id, text, f"returned:{absence[0]}:{admin_id}", "removed", group_chat_id,
+                                 f"✅ {fio} вышел из списка отсутствующих ({absence[2]})")
+                    for admin_id in admin_ids]
+
+        # Завершаем отсутствие одной транзакцией: убираем из активного
+        # списка и из записей на сегодня, уведомления администраторам
+        # группы ставятся в outbox там же
+        absence_info = db.end_active_absence(user_id, messages=returned_notices)
 
         if not absence_info:
-            bot.answer_callback_query(call.id, "❌ Вы не в списке отсутствующих")
-            return
+            return CallbackAnswer("❌ Вы не в списке отсутствующих", final=False)
 
         absence_type = absence_info[2]  # получаем тип отсутствия (Болею/Отпуск)
 
-        # Удаляем из активного списка отсутствующих
-        db.remove_active_absence(user_id)
-
-        # Удаляем из записей отсутствий на сегодня
-        db.remove_absence_from_today(user_id)
-
         # Обновляем сообщение с подтверждением
         bot.edit_message_text(
             f"✅ Вернулся грызть гранит науки!\n\n"
@@ -1688,44 +4673,16 @@ def handle_exit_absence(call):
             call.message.message_id
         )
 
-        # Уведомляем администраторов группы
-        group_chat_id = absence_info[5]
-        if group_chat_id:
-            admin_ids = db.get_group_admins(group_chat_id)
-        else:
-            admin_ids = []
-
-        logging.info(f"📢 Отправляем уведомление о возвращении администраторам группы {group_chat_id}. ФИО: {fio}, Причина: {absence_type}, Всего админов: {len(admin_ids)}, Admin IDs: {admin_ids}")
-
-        success_count = 0
-        failed_count = 0
-
-        for admin_id in admin_ids:
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"📢 Уведомление о возвращении:\n\n"
-                    f"👤 {fio}\n"
-                    f"📋 Причина: {absence_type}\n"
-                    f"✅ Вышел из списка отсутствующих"
-                )
-                logging.info(f"✅ Уведомление о возвращении успешно отправлено администратору {admin_id}")
-                success_count += 1
-            except Exception as e:
-                logging.error(f"❌ Ошибка отправки уведомления администратору {admin_id}: {e}")
-                failed_count += 1
-
-        logging.info(f"✅ Уведомление о возвращении отправлено: успешно {success_count}/{len(admin_ids)} администраторам, ошибок: {failed_count}")
-
-        bot.answer_callback_query(call.id, "✅ Вы удалены из списка отсутствующих")
+        return CallbackAnswer("✅ Вы удалены из списка отсутствующих")
 
     except Exception as e:
         logging.error(f"Ошибка обработки выхода из отсутствия: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка обработки")
+        return CallbackAnswer("❌ Ошибка обработки", final=False)
 
 # ===== ОБРАБОТЧИК РЕШЕНИЙ АДМИНИСТРАТОРА =====
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('approve_'))
+@router.callback_prefix('approve_')
+@idempotent_callback(lambda call: f"pending:{call.data.split('_')[2]}" if call.data.count('_') >= 2 else None)
 def handle_admin_decision(call):
     """Обработчик решения администратора"""
     try:
@@ -1740,8 +4697,7 @@ def handle_admin_decision(call):
         pending_data = db.get_pending_absence(pending_id)
         if not pending_data:
             logging.warning(f"⚠️ Запрос {pending_id} уже обработан или не найден")
-            bot.answer_callback_query(call.id, "Запрос уже обработан")
-            return
+            return CallbackAnswer("Запрос уже обработан")
 
         user_id = pending_data[1]
         reason = pending_data[2]
@@ -1755,27 +4711,21 @@ def handle_admin_decision(call):
         # Проверяем, является ли администратор администратором этой группы
         if group_chat_id is None:
             logging.error(f"❌ group_chat_id is None для pending_id {pending_id}")
-            bot.answer_callback_query(call.id, "❌ Ошибка: не указана группа для этой причины")
-            return
-
-        group_admins = db.get_group_admins(group_chat_id)
-        logging.info(f"📋 Admin {admin_id} checking against group {group_chat_id} admins: {group_admins}")
+            return CallbackAnswer("❌ Ошибка: не указана группа для этой причины", final=False)
 
-        if admin_id not in group_admins:
+        if not db.is_group_admin(group_chat_id, admin_id):
             logging.warning(f"❌ Администратор {admin_id} не является админом группы {group_chat_id}")
-            bot.answer_callback_query(call.id, "❌ У вас нет прав на подтверждение причин для этой группы")
-            return
+            return CallbackAnswer("❌ У вас нет прав на подтверждение причин для этой группы", final=False)
 
         # Определяем тип отсутствия
         absence_type = 'уважительно' if decision == 'respectful' else 'неуважительно'
 
-        # Добавляем в основную таблицу
-        db.add_absence(user_id, absence_type, reason, group_chat_id)
+        # Добавляем в основную таблицу и удаляем из ожидающих одной транзакцией
+        if not db.approve_pending(pending_id, absence_type):
+            logging.warning(f"⚠️ Запрос {pending_id} уже обработан другим администратором")
+            return CallbackAnswer("Запрос уже обработан")
         logging.info(f"✅ Запись об отсутствии добавлена: {fio}, тип: {absence_type}, причина: {reason}, группа: {group_chat_id}")
 
-        # Удаляем из ожидающих
-        db.delete_pending_absence(pending_id)
-
         # Обновляем сообщение админу
         bot.edit_message_text(
             f"✅ Причина подтверждена:\n\n"
@@ -1800,12 +4750,13 @@ def handle_admin_decision(call):
         except Exception as e:
             logging.warning(f"⚠️ Не удалось отправить уведомление пользователю {user_id}: {e}")
 
-        bot.answer_callback_query(call.id, f"Статус установлен: {absence_type}")
         logging.info(f"✅ Запрос {pending_id} успешно обработан администратором {admin_id}")
+        return CallbackAnswer(f"Статус установлен: {absence_type}",
+                              repeat_text=f"Запрос уже обработан: {absence_type}")
 
     except Exception as e:
         logging.error(f"❌ Ошибка обработки решения админа: {e}")
-        bot.answer_callback_query(call.id, "Ошибка обработки")
+        return CallbackAnswer("Ошибка обработки", final=False)
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 
@@ -1836,12 +4787,7 @@ def process_set_fio_command(message):
                     )
                     return
 
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute('''REPLACE INTO users (user_id, fio)
-                         VALUES (?, ?)''', (user_id, fio))
-            conn.commit()
-            conn.close()
+            db.register_user(user_id, fio)
 
             print(f"✅ Успешно зарегистрирован: {fio} (ID: {user_id})")
             bot.reply_to(message, f"✅ Зарегистрирован: {fio} (ID: {user_id})")
@@ -1860,7 +4806,7 @@ def process_set_fio_command(message):
         print(f"💥 Ошибка регистрации: {e}")
         bot.reply_to(message, f"❌ Ошибка: {e}")
 
-@bot.message_handler(commands=['update_group_name'])
+@router.command('update_group_name')
 def handle_update_group_name(message):
     """Обновить название группы в БД"""
     user_id = message.from_user.id
@@ -1892,11 +4838,7 @@ def handle_update_group_name(message):
         new_name = parts[2]
 
         # Обновляем название в БД
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''UPDATE groups SET name = ? WHERE chat_id = ?''', (new_name, chat_id))
-        conn.commit()
-        conn.close()
+        db.update_group_name(chat_id, new_name)
 
         logging.info(f"✅ Супер-админ {user_id} обновил название группы {chat_id} на '{new_name}'")
 
@@ -1910,7 +4852,7 @@ def handle_update_group_name(message):
         logging.error(f"❌ Ошибка обновления названия группы: {e}")
         bot.reply_to(message, f"❌ Ошибка: {e}")
 
-@bot.message_handler(commands=['delete'])
+@router.command('delete')
 def handle_delete_absence(message):
     """Обработчик команды /delete для удаления отсутствия"""
     user_id = message.from_user.id
@@ -1947,11 +4889,8 @@ def handle_delete_absence(message):
         # Получаем ФИО удаляемого пользователя
         target_fio = db.get_user_fio(target_user_id) or f"ID: {target_user_id}"
 
-        # Удаляем отсутствие из таблицы absences (сегодняшние отсутствия)
-        db.remove_absence_from_today(target_user_id)
-
-        # Удаляем из активных отсутствующих если там есть
-        db.remove_active_absence(target_user_id)
+        # Удаляем сегодняшние отсутствия и активное отсутствие одной транзакцией
+        db.cancel_absence(target_user_id)
 
         logging.info(f"🗑️ Администратор {user_id} удалил отсутствие пользователя @{target} ({target_fio})")
 
@@ -1993,92 +4932,182 @@ def format_reason_for_report(reason):
     else:
         return reason
 
+class ReportCache:
+    """Кэш дневных отчётов: (group_chat_id, дата) -> строки отсутствий и готовый текст
+
+    Сбрасывается подписчиком Database.add_absence_listener после каждой
+    операции, меняющей сегодняшние отсутствия, и целиком при смене даты.
+    Ключ None - отчёт по всем группам (для ЛС админа), он сбрасывается
+    вместе с любой группой."""
+
+    def __init__(self):
+        self._entries = {}
+        self._date = None
+        self._lock = threading.Lock()
+        # Счётчик сбросов: отчёт, собранный до сброса, в кэш не кладём
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, group_chat_id, build):
+        """Вернуть отчёт из кэша или собрать его функцией build()"""
+        today = date.today().isoformat()
+        with self._lock:
+            if self._date != today:
+                self._entries.clear()
+                self._date = today
+            report = self._entries.get(group_chat_id)
+            if report is not None:
+                self.hits += 1
+                return report
+            self.misses += 1
+            generation = self._generation
+
+        report = build()
+        with self._lock:
+            if generation == self._generation and self._date == today:
+                self._entries[group_chat_id] = report
+        return report
+
+    def get_many(self, group_chat_ids, build_many):
+        """Вернуть отчёты по нескольким группам; недостающие собрать одним вызовом build_many(ids)"""
+        today = date.today().isoformat()
+        reports, missing = {}, []
+        with self._lock:
+            if self._date != today:
+                self._entries.clear()
+                self._date = today
+            for group_chat_id in group_chat_ids:
+                report = self._entries.get(group_chat_id)
+                if report is None:
+                    missing.append(group_chat_id)
+                else:
+                    reports[group_chat_id] = report
+            self.hits += len(reports)
+            self.misses += len(missing)
+            generation = self._generation
+
+        if missing:
+            built = build_many(missing)
+            reports.update(built)
+            with self._lock:
+                if generation == self._generation and self._date == today:
+                    self._entries.update(built)
+        return reports
+
+    def invalidate(self, group_chat_id=None):
+        with self._lock:
+            self._generation += 1
+            if group_chat_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(group_chat_id, None)
+                self._entries.pop(None, None)
+
+report_cache = ReportCache()
+db.add_absence_listener(report_cache.invalidate)
+
+def build_daily_report(group_chat_id):
+    """Собрать отчёт за сегодня: отсортированные строки, текст и счётчики по причинам"""
+    return render_daily_report(group_chat_id, db.get_today_absences(group_chat_id))
+
+def build_daily_reports(group_chat_ids):
+    """Собрать отчёты по нескольким группам из одного запроса к БД"""
+    absences_by_group = db.get_today_absences_for_groups(group_chat_ids)
+    return {group_chat_id: render_daily_report(group_chat_id, absences)
+            for group_chat_id, absences in absences_by_group.items()}
+
+def render_daily_report(group_chat_id, absences):
+    """Отформатировать строки отсутствий группы в отчёт (см. build_daily_report)"""
+    absences = sorted(absences, key=lambda x: (x[0] or f"ID: {x[3]}").lower())
+    today_formatted = date.today().strftime('%d.%m')
+
+    body = ""
+    ill_count = 0
+    vacation_count = 0
+    other_count = 0
+    for i, (fio, absence_type, reason, user_id) in enumerate(absences, 1):
+        display_name = fio if fio else f"ID: {user_id}"
+        formatted_reason = format_reason_for_report(reason)
+        formatted_type = format_absence_type(absence_type)
+        body += f"{i}. {display_name}\n({formatted_reason}/ {formatted_type})\n\n"
+
+        # Подсчитываем по типам для логирования
+        if 'более' in formatted_reason.lower() or 'болею' in formatted_reason.lower():
+            ill_count += 1
+        elif 'отпуск' in formatted_reason.lower():
+            vacation_count += 1
+        else:
+            other_count += 1
+
+    # Название группы нужно для отчета в личном сообщении админа
+    group_name = db.get_group_name(group_chat_id) if group_chat_id and group_chat_id < 0 else None
+    text = f"На {today_formatted} отсутствуют:\n\n{body}"
+    return {
+        'absences': absences,
+        'group_name': group_name or "",
+        'text': text.strip(),
+        'titled_text': f"📋 **{group_name}**\n{text}" if group_name else text,
+        'counts': (ill_count, vacation_count, other_count),
+    }
+
+def get_daily_report(group_chat_id):
+    """Получить отчёт за сегодня из кэша (см. ReportCache)"""
+    return report_cache.get(group_chat_id, lambda: build_daily_report(group_chat_id))
+
+def get_daily_reports(group_chat_ids):
+    """Получить отчёты за сегодня по нескольким группам: словарь group_chat_id -> отчёт"""
+    return report_cache.get_many(group_chat_ids, build_daily_reports)
+
 def get_group_report(chat_id):
     """Сформировать отчет по группе"""
     try:
-        absences = db.get_today_absences(chat_id)
-        if not absences:
+        report = get_daily_report(chat_id)
+        if not report['absences']:
             return None
-
-        today_formatted = date.today().strftime('%d.%m')
-        message = f"На {today_formatted} отсутствуют:\n\n"
-        absences = sorted(absences, key=lambda x: (x[0] or f"ID: {x[3]}").lower())
-
-        for i, (fio, absence_type, reason, user_id) in enumerate(absences, 1):
-            display_name = fio if fio else f"ID: {user_id}"
-            formatted_reason = format_reason_for_report(reason)
-            formatted_type = format_absence_type(absence_type)
-            message += f"{i}. {display_name}\n({formatted_reason}/ {formatted_type})\n\n"
-
-        return message.strip()
+        return report['text']
     except Exception as e:
         logging.error(f"Ошибка формирования отчёта для группы {chat_id}: {e}")
         return None
 
-def send_today_report_to_chat(chat_id, group_chat_id=None):
-    """Отправить отчёт об отсутствующих в указанный чат"""
+def report_message(report):
+    """Текст сообщения с отчётом и его parse_mode"""
+    if not report['absences']:
+        return "✅ На сегодня отсутствующих нет", None
+    return report['titled_text'], 'Markdown'
+
+def send_today_report_to_chat(chat_id, group_chat_id=None, report=None):
+    """Отправить отчёт об отсутствующих в указанный чат
+
+    report - уже собранный отчёт (из get_daily_reports), если он есть.
+    В группе с живым отчётом вместо нового сообщения обновляется закреплённое."""
     try:
         logging.info(f"📊 Начинаем подготовку отчёта для чата {chat_id}")
         # Если группа не передана явно, определяем по типу chat_id
         if group_chat_id is None:
             group_chat_id = chat_id if chat_id < 0 else None
-        absences = db.get_today_absences(group_chat_id)
+        if chat_id == group_chat_id and live_reports.is_enabled(chat_id):
+            live_reports.schedule(chat_id, delay=0)
+            logging.info(f"📌 Запрошен отчёт в группе {chat_id} с живым отчётом - обновляем закреплённое сообщение")
+            return
+        if report is None:
+            report = get_daily_report(group_chat_id)
+        absences = report['absences']
 
         logging.info(f"📊 Получено {len(absences)} отсутствующих для отчёта")
 
+        message, parse_mode = report_message(report)
         if not absences:
-            bot.send_message(chat_id, "✅ На сегодня отсутствующих нет")
+            bot.send_message(chat_id, message)
             logging.info(f"✅ Отправлен пустой отчёт в чат {chat_id}")
             return
 
-        # Получаем название группы для отчета в личном сообщении админа
-        group_name = ""
-        if group_chat_id and group_chat_id < 0:  # Это ID группы
-            try:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("SELECT name FROM groups WHERE chat_id = ?", (group_chat_id,))
-                result = c.fetchone()
-                conn.close()
-                if result and result[0]:
-                    group_name = result[0]
-                    logging.info(f"📋 Найдено название группы {group_chat_id}: '{group_name}'")
-                else:
-                    logging.warning(f"⚠️ Название группы {group_chat_id} не найдено в БД")
-            except Exception as e:
-                logging.warning(f"⚠️ Ошибка получения названия группы {group_chat_id}: {e}")
-
-        # Новый формат отчета
-        today_formatted = date.today().strftime('%d.%m')
-        if group_name:
-            message = f"📋 **{group_name}**\nНа {today_formatted} отсутствуют:\n\n"
-        else:
-            message = f"На {today_formatted} отсутствуют:\n\n"
-
-        # Сортируем по ФИО в алфавитном порядке
-        absences = sorted(absences, key=lambda x: (x[0] or f"ID: {x[3]}").lower())
-
-        # Логируем информацию о болеющих и отпускных в отчёте
-        ill_count = 0
-        vacation_count = 0
-        other_count = 0
-
-        for i, (fio, absence_type, reason, user_id) in enumerate(absences, 1):
-            display_name = fio if fio else f"ID: {user_id}"
-            formatted_reason = format_reason_for_report(reason)
-            formatted_type = format_absence_type(absence_type)
-
-            message += f"{i}. {display_name}\n({formatted_reason}/ {formatted_type})\n\n"
-
-            # Подсчитываем по типам для логирования
-            if 'более' in formatted_reason.lower() or 'болею' in formatted_reason.lower():
-                ill_count += 1
-            elif 'отпуск' in formatted_reason.lower():
-                vacation_count += 1
-            else:
-                other_count += 1
+        group_name = report['group_name']
+        if group_chat_id and group_chat_id < 0 and not group_name:
+            logging.warning(f"⚠️ Название группы {group_chat_id} не найдено в БД")
+        ill_count, vacation_count, other_count = report['counts']
 
-        bot.send_message(chat_id, message, parse_mode='Markdown')
+        bot.send_message(chat_id, message, parse_mode=parse_mode)
         if group_name:
             logging.info(f"📤 Отчёт для группы '{group_name}' отправлен в чат {chat_id}. Всего: {len(absences)} (болеют: {ill_count}, в отпуске: {vacation_count}, другое: {other_count})")
         else:
@@ -2092,9 +5121,268 @@ def send_today_report_to_chat(chat_id, group_chat_id=None):
             logging.error(f"❌ Не удалось отправить сообщение об ошибке в чат {chat_id}")
 
 
+class LiveReportUpdater:
+    """Живой отчёт: одно закреплённое сообщение на группу в день, которое правится на месте
+
+    Подписан на изменения отсутствий, но правит сообщение не сразу, а через
+    LIVE_REPORT_DEBOUNCE секунд тишины: пачка нажатий превращается в один
+    edit_message_text. Чтобы непрерывный поток изменений не откладывал
+    обновление бесконечно, правка идёт не позже LIVE_REPORT_MAX_DELAY после
+    первого изменения. Первое обновление за день (или если сообщение удалили)
+    отправляет новое сообщение и закрепляет его. Текст берётся из того же
+    кэша отчётов, что и send_today_report_to_chat."""
+
+    def __init__(self, storage, debounce=LIVE_REPORT_DEBOUNCE, max_delay=LIVE_REPORT_MAX_DELAY):
+        self.storage = storage
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._enabled = set(storage.get_live_report_groups())
+        self._due = {}  # group_chat_id -> (время первого изменения, срок правки)
+        self._shown = {}  # group_chat_id -> (дата, текст) последнего показанного отчёта
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='live-report', daemon=True)
+        storage.add_absence_listener(self.on_absences_changed)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def is_enabled(self, group_chat_id):
+        return group_chat_id in self._enabled
+
+    def set_enabled(self, group_chat_id, enabled):
+        """Включить или выключить живой отчёт группы"""
+        self.storage.set_live_report(group_chat_id, enabled)
+        with self._lock:
+            if enabled:
+                self._enabled.add(group_chat_id)
+            else:
+                self._enabled.discard(group_chat_id)
+                self._due.pop(group_chat_id, None)
+        if enabled:
+            self.schedule(group_chat_id, delay=0)
+
+    def on_absences_changed(self, group_chat_id=None):
+        groups = list(self._enabled) if group_chat_id is None else [group_chat_id]
+        for chat_id in groups:
+            if chat_id in self._enabled:
+                self.schedule(chat_id)
+
+    def schedule(self, group_chat_id, delay=None):
+        """Запланировать обновление отчёта группы через delay секунд (по умолчанию debounce)"""
+        now = time.monotonic()
+        with self._lock:
+            first_change = self._due.get(group_chat_id, (now, None))[0]
+            deadline = min(now + (self.debounce if delay is None else delay), first_change + self.max_delay)
+            self._due[group_chat_id] = (first_change, deadline)
+        self._wake_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            now = time.monotonic()
+            with self._lock:
+                due = [chat_id for chat_id, (_, deadline) in self._due.items() if deadline <= now]
+                for chat_id in due:
+                    del self._due[chat_id]
+                next_deadline = min((deadline for _, deadline in self._due.values()), default=None)
+            for chat_id in due:
+                try:
+                    self.refresh(chat_id)
+                except Exception as e:
+                    logging.error(f"❌ Ошибка обновления живого отчёта группы {chat_id}: {e}")
+            if not due:
+                self._wake_event.wait(None if next_deadline is None else max(0, next_deadline - now))
+
+    def refresh(self, group_chat_id):
+        """Привести закреплённое сообщение группы к текущему отчёту"""
+        today = date.today().isoformat()
+        text, parse_mode = report_message(get_daily_report(group_chat_id))
+        if self._shown.get(group_chat_id) == (today, text):
+            return
+        live_text = f"{text}\n\n🔄 Обновлено в {datetime.now().strftime('%H:%M')}"
+
+        stored = self.storage.get_live_report_message(group_chat_id)
+        if stored and stored[0] == today:
+            try:
+                bot.edit_message_text(live_text, group_chat_id, stored[1], parse_mode=parse_mode)
+                self._shown[group_chat_id] = (today, text)
+                logging.info(f"📌 Живой отчёт группы {group_chat_id} обновлён")
+                return
+            except TELEGRAM_API_ERRORS as e:
+                if 'message is not modified' in str(e):
+                    self._shown[group_chat_id] = (today, text)
+                    return
+                logging.warning(f"⚠️ Не удалось обновить живой отчёт группы {group_chat_id}, отправляем новый: {e}")
+
+        sent = bot.send_message(group_chat_id, live_text, parse_mode=parse_mode, disable_notification=True)
+        self.storage.set_live_report_message(group_chat_id, today, sent.message_id)
+        self._shown[group_chat_id] = (today, text)
+        logging.info(f"📌 Отправлен живой отчёт группы {group_chat_id} за {today}")
+        try:
+            if stored:
+                bot.unpin_chat_message(group_chat_id, stored[1])
+            bot.pin_chat_message(group_chat_id, sent.message_id, disable_notification=True)
+        except TELEGRAM_API_ERRORS as e:
+            logging.warning(f"⚠️ Не удалось закрепить живой отчёт в группе {group_chat_id} (нужны права администратора): {e}")
+
+live_reports = LiveReportUpdater(db)
+
+def parse_report_time(value):
+    """'9:00' -> '09:00'; None, если это не время ЧЧ:ММ"""
+    try:
+        return datetime.strptime(value.strip(), '%H:%M').strftime('%H:%M')
+    except ValueError:
+        return None
+
+class ReportScheduler:
+    """Ежедневная рассылка отчётов по расписанию
+
+    Время берётся из admin_settings.report_time (отчёт в ЛС администратору
+    по всем его группам) и group_report_times (отчёт в саму группу). Задания
+    лежат в куче по времени следующего запуска, поток спит до ближайшего.
+    Задания, наступившие одновременно, обрабатываются вместе: отчёт каждой
+    группы считается один раз на всех её администраторов. Сообщения уходят
+    через outbox с интервалом 1/REPORT_SEND_RATE, чтобы рассылка не занимала
+    весь лимит Telegram; ключ дедупликации не даст отправить слот дважды.
+    Последний отработанный слот сохраняется в bot_state, и пропущенные за
+    время простоя сегодняшние слоты отправляются сразу после запуска."""
+
+    STATE_KEY = 'report_scheduler_watermark'
+
+    def __init__(self, storage, send_rate=REPORT_SEND_RATE):
+        self.storage = storage
+        self.send_rate = send_rate
+        self._heap = []  # (время запуска, порядковый номер, 'admin' | 'group', ID, 'ЧЧ:ММ')
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='report-scheduler', daemon=True)
+
+    def start(self):
+        self.reload(catch_up=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    @staticmethod
+    def _slot(day, report_time):
+        """Момент отправки отчёта report_time в день day (time.time())"""
+        return datetime.combine(day, datetime.strptime(report_time, '%H:%M').time()).timestamp()
+
+    def reload(self, catch_up=False):
+        """Перечитать расписание из хранилища
+
+        catch_up - отправить сегодняшние слоты, пропущенные после последнего
+        отработанного (при запуске); при изменении расписания на ходу уже
+        прошедшее сегодня время переносится на завтра."""
+        now = time.time()
+        watermark = now
+        if catch_up:
+            stored = self.storage.get_bot_state(self.STATE_KEY)
+            watermark = float(stored) if stored else now
+        today = date.today()
+        tomorrow = date.fromordinal(today.toordinal() + 1)
+
+        heap = []
+        for kind, target_id, report_time in self.storage.get_report_schedule():
+            if not parse_report_time(report_time or ''):
+                logging.warning(f"⚠️ Неверное время отчёта '{report_time}' для {kind} {target_id}")
+                continue
+            fire_at = self._slot(today, report_time)
+            if fire_at <= watermark:
+                fire_at = self._slot(tomorrow, report_time)
+            elif fire_at <= now:
+                logging.info(f"⏰ Пропущенный отчёт {report_time} для {kind} {target_id} будет отправлен сейчас")
+            self._sequence += 1
+            heap.append((fire_at, self._sequence, kind, target_id, report_time))
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+        self._wake_event.set()
+        logging.info(f"⏰ Расписание отчётов загружено: заданий {len(heap)}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            now = time.time()
+            due = []
+            with self._lock:
+                while self._heap and self._heap[0][0] <= now:
+                    fire_at, _, kind, target_id, report_time = heapq.heappop(self._heap)
+                    due.append((fire_at, kind, target_id, report_time))
+                    next_day = date.fromordinal(datetime.fromtimestamp(fire_at).date().toordinal() + 1)
+                    self._sequence += 1
+                    heapq.heappush(self._heap, (self._slot(next_day, report_time), self._sequence,
+                                                kind, target_id, report_time))
+                next_fire = self._heap[0][0] if self._heap else None
+            if due:
+                try:
+                    self.dispatch(due)
+                    self.storage.set_bot_state(self.STATE_KEY, max(fire_at for fire_at, *_ in due))
+                except Exception as e:
+                    logging.error(f"❌ Ошибка рассылки отчётов по расписанию: {e}")
+                continue
+            self._wake_event.wait(None if next_fire is None else max(0, next_fire - now))
+
+    @staticmethod
+    def _message(chat_id, text, parse_mode, dedup_key):
+        return {'chat_id': chat_id, 'text': text, 'kind': 'daily_report', 'dedup_key': dedup_key,
+                'options': {'parse_mode': parse_mode} if parse_mode else {}}
+
+    def dispatch(self, due):
+        """Поставить в outbox отчёты для наступивших заданий [(время, вид, ID, 'ЧЧ:ММ')]"""
+        today = date.today().isoformat()
+        admin_groups = {target_id: self.storage.get_admin_groups(target_id)
+                        for _, kind, target_id, _ in due if kind == 'admin'}
+        group_ids = {chat_id for groups in admin_groups.values() for chat_id, _ in groups}
+        group_ids.update(target_id for _, kind, target_id, _ in due if kind == 'group')
+        # Один расчёт отчёта на группу для всех её администраторов
+        reports = get_daily_reports(group_ids) if group_ids else {}
+
+        messages = []
+        for _, kind, target_id, report_time in due:
+            slot = f"report:{today}:{report_time}:{target_id}"
+            if kind == 'group':
+                if live_reports.is_enabled(target_id):
+                    live_reports.schedule(target_id, delay=0)
+                    continue
+                text, parse_mode = report_message(reports[target_id])
+                messages.append(self._message(target_id, text, parse_mode, slot))
+                continue
+            groups = admin_groups[target_id]
+            if not groups:
+                # Администратор без групп получает все отсутствия, как по кнопке отчёта
+                text, parse_mode = report_message(get_daily_report(None))
+                messages.append(self._message(target_id, text, parse_mode, slot))
+            for chat_id, group_name in groups:
+                report = reports[chat_id]
+                if report['absences']:
+                    text, parse_mode = f"📊 Отчёт для группы {group_name or chat_id}:\n\n{report['text']}", 'Markdown'
+                else:
+                    text, parse_mode = f"ℹ️ В группе {group_name or chat_id} отсутствующих нет", None
+                messages.append(self._message(target_id, text, parse_mode, f"{slot}:{chat_id}"))
+
+        # Рассылка растягивается во времени, чтобы не занимать весь лимит отправки
+        start = time.time()
+        for index, message in enumerate(messages):
+            message['not_before'] = start + index / self.send_rate
+        queued = self.storage.enqueue_messages(messages)
+        logging.info(f"⏰ Отчёты по расписанию: заданий {len(due)}, групп {len(group_ids)}, "
+                     f"сообщений поставлено {queued} из {len(messages)}")
+
+report_scheduler = ReportScheduler(db)
 
-def run_bot_with_restart():
-    """Запуск бота с авто-перезапуском"""
+def run_bot_with_restart(transport=None):
+    """Запуск бота с авто-перезапуском; transport - AsyncTransport для BOT_ENGINE=asyncio"""
     import requests
 
     # Временно отключено удаление webhook из-за проблем с подключением
@@ -2107,27 +5395,568 @@ def run_bot_with_restart():
     #     print(f"⚠️ Не удалось удалить webhook: {e}")
 
     restart_count = 0
+    transport_name = 'asyncio' if transport is not None else 'threaded'
 
     while True:
         try:
-            print(f"🟢 Запуск бота (попытка {restart_count + 1})...")
+            print(f"🟢 Запуск бота (попытка {restart_count + 1}, транспорт {transport_name}, режим {UPDATE_MODE})...")
             restart_count += 1
 
-            bot.polling(none_stop=True, interval=0, timeout=20)
+            if transport is not None:
+                transport.run()
+            elif UPDATE_MODE == 'webhook':
+                run_webhook()
+            else:
+                run_polling(timeout=20)
 
         except Exception as e:
             print(f"🔴 Бот упал: {e}")
             print("🔄 Перезапуск через 10 секунд...")
             time.sleep(10)
 
+# ===== ОБРАБОТКА ОБНОВЛЕНИЙ =====
+
+def update_key(update):
+    """Ключ упорядочивания обновления: чат, иначе пользователь, иначе само обновление"""
+    for event in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                  update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event is not None:
+            return event.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for event in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                  update.pre_checkout_query, update.poll_answer):
+        user = event and (getattr(event, 'from_user', None) or getattr(event, 'user', None))
+        if user is not None:
+            return user.id
+    return update.update_id
+
+class UpdateExecutor:
+    """Пул обработки обновлений с последовательной очередью на каждый ключ
+
+    Ключ (чат или пользователь) хэшируется в один из потоков, у каждого своя
+    очередь: обновления одного чата обрабатываются строго по порядку (два
+    быстрых нажатия не гоняются за user_states), а разные чаты - параллельно,
+    и медленная группа задерживает только чаты, попавшие в её поток.
+    Очереди ограничены: при переполнении submit ждёт, притормаживая приём."""
+
+    def __init__(self, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        # Время постановки задачи, которую поток выполняет сейчас (None - простаивает)
+        self._busy_since = [None] * workers
+        self._processed = [0] * workers
+        self._max_lag = [0.0] * workers
+        self._threads = [threading.Thread(target=self._run, args=(index,), name=f'updates-{index}', daemon=True)
+                         for index in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, fn, *args):
+        """Поставить fn(*args) в очередь ключа key"""
+        self._queues[hash(key) % len(self._queues)].put((time.monotonic(), fn, args))
+
+    def stop(self, timeout=10):
+        """Дообработать поставленное и остановить потоки"""
+        for work_queue in self._queues:
+            work_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def _run(self, index):
+        work_queue = self._queues[index]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            enqueued_at, fn, args = item
+            lag = time.monotonic() - enqueued_at
+            self._busy_since[index] = enqueued_at
+            if lag > self._max_lag[index]:
+                self._max_lag[index] = lag
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработки обновления: {e}")
+            finally:
+                self._busy_since[index] = None
+                self._processed[index] += 1
+
+    def stats(self):
+        """Метрики по очередям: глубина, текущая задержка, максимальная задержка, обработано
+
+        Текущая задержка - сколько ждёт задача, которую поток выполняет сейчас."""
+        now = time.monotonic()
+        return [{
+            'depth': work_queue.qsize(),
+            'lag': now - busy_since if busy_since is not None else 0.0,
+            'max_lag': max_lag,
+            'processed': processed,
+        } for work_queue, busy_since, max_lag, processed
+            in zip(self._queues, list(self._busy_since), self._max_lag, self._processed)]
+
+update_executor = UpdateExecutor()
+atexit.register(update_executor.stop)
+
+def submit_update(update):
+    """Передать обновление в очередь его чата"""
+    update_executor.submit(update_key(update), dispatch_update, update)
+
+class UpdateCheckpoint:
+    """Отметка обработанных обновлений для long polling
+
+    Обновления обрабатываются параллельно и завершаются не по порядку.
+    Отметка - наибольший update_id, до которого включительно всё обработано.
+    Telegram подтверждается (offset в getUpdates) только до неё, поэтому
+    принятое, но не обработанное при падении обновление придёт снова, а не
+    потеряется. Отметка сохраняется в bot_state раз за цикл опроса, и после
+    перезапуска опрос продолжается с неё. Отметка старше CHECKPOINT_MAX_AGE
+    не используется: после недели без обновлений Telegram может начать
+    нумерацию заново.
+
+    Пока медленный обработчик держит отметку, getUpdates возвращает и уже
+    принятые обновления; они отбрасываются по last_accepted (is_new), а новые
+    идут в очереди своих чатов. Приём новых встаёт, только если за
+    незавершённым обновлением принята целая страница (UPDATE_PAGE_SIZE): тогда
+    опрос ждёт, пока обработка продвинется (wait_for_progress)."""
+
+    STATE_KEY = 'last_update_at'
+    CHECKPOINT_MAX_AGE = 6 * 24 * 3600
+
+    def __init__(self, storage):
+        self.storage = storage
+        saved_at = float(storage.get_bot_state(self.STATE_KEY) or 0)
+        saved = storage.get_last_update_id() if time.time() - saved_at < self.CHECKPOINT_MAX_AGE else 0
+        self.saved = saved
+        self.watermark = saved
+        self.last_accepted = saved
+        self._in_flight = set()
+        self._condition = threading.Condition()
+
+    def next_offset(self):
+        """offset для getUpdates: подтверждает только обработанное"""
+        return self.watermark + 1 if self.watermark else None
+
+    def is_new(self, update_id):
+        """Обновление ещё не принималось (getUpdates повторяет необработанные)"""
+        return update_id > self.last_accepted
+
+    def accept(self, update_id, skip=False):
+        """Принять обновление в обработку; skip - обработка не нужна"""
+        with self._condition:
+            self.last_accepted = max(self.last_accepted, update_id)
+            if not skip:
+                self._in_flight.add(update_id)
+            self._advance()
+
+    def done(self, update_id):
+        with self._condition:
+            self._in_flight.discard(update_id)
+            self._advance()
+            self._condition.notify_all()
+
+    def _advance(self):
+        self.watermark = min(self._in_flight) - 1 if self._in_flight else self.last_accepted
+
+    def wait_for_progress(self, timeout):
+        """Дождаться завершения какого-нибудь обновления (не дольше timeout)"""
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def save(self):
+        """Сохранить отметку, если она сдвинулась"""
+        watermark = self.watermark
+        if watermark != self.saved:
+            self.storage.save_last_update_id(watermark)
+            self.storage.set_bot_state(self.STATE_KEY, time.time())
+            self.saved = watermark
+
+update_checkpoint = UpdateCheckpoint(db)
+
+def coalesce_updates(updates):
+    """Отбросить избыточные обновления из накопившейся очереди: (обработать, пропустить)
+
+    - обычные сообщения в группе (is_plain_group_message) только обновляют
+      username - от пользователя остаётся последнее, если других обновлений
+      от него в пачке нет;
+    - повторные нажатия одной кнопки одного сообщения одним пользователем -
+      остаётся первое."""
+    plain_by_user = {}
+    other_users = set()
+    seen_callbacks = set()
+    keep, skip = [], []
+    for update in updates:
+        if update.message is not None and is_plain_group_message(update.message):
+            plain_by_user.setdefault(update.message.from_user.id, []).append(update)
+            continue
+        if update.callback_query is not None and update.callback_query.message is not None:
+            query = update.callback_query
+            key = (query.from_user.id, query.message.chat.id, query.message.message_id, query.data)
+            if key in seen_callbacks:
+                skip.append(update)
+                continue
+            seen_callbacks.add(key)
+        user = getattr(update.message or update.callback_query, 'from_user', None)
+        if user is not None:
+            other_users.add(user.id)
+        keep.append(update)
+    for user_id, plain in plain_by_user.items():
+        if user_id in other_users:
+            keep.extend(plain)
+        else:
+            keep.append(plain[-1])
+            skip.extend(plain[:-1])
+    keep.sort(key=lambda update: update.update_id)
+    return keep, skip
+
+def process_polled_update(update):
+    """Обработать обновление из getUpdates и отметить его обработанным"""
+    try:
+        dispatch_update(update)
+    finally:
+        update_checkpoint.done(update.update_id)
+
+def accept_polled_updates(updates, catch_up=False):
+    """Разложить ответ getUpdates по очередям чатов и сохранить отметку; вернуть число новых
+
+    catch_up - разбор накопившейся очереди: избыточные обновления пропускаются (coalesce_updates)."""
+    new = [update for update in updates if update_checkpoint.is_new(update.update_id)]
+    keep, skip = coalesce_updates(new) if catch_up else (new, [])
+    for update in skip:
+        update_checkpoint.accept(update.update_id, skip=True)
+    for update in keep:
+        update_checkpoint.accept(update.update_id)
+        update_executor.submit(update_key(update), process_polled_update, update)
+    if skip:
+        logging.info(f"⏩ Разбор очереди обновлений: принято {len(keep)}, пропущено избыточных {len(skip)}")
+    update_checkpoint.save()
+    # Пришли только уже принятые обновления: повторный опрос вернул бы их же
+    # сразу, поэтому ждём, пока обработка продвинется
+    if updates and not new:
+        update_checkpoint.wait_for_progress(1)
+    return len(new)
+
+def run_polling(timeout=20):
+    """Long polling: получать обновления и раскладывать их по очередям чатов
+
+    После запуска накопившаяся очередь разбирается без ожидания, страницами
+    по UPDATE_PAGE_SIZE (UPDATE_CATCH_UP); затем - обычный long polling."""
+    catch_up = UPDATE_CATCH_UP
+    while True:
+        try:
+            updates = bot.get_updates(offset=update_checkpoint.next_offset(), limit=UPDATE_PAGE_SIZE,
+                                      timeout=timeout, long_polling_timeout=0 if catch_up else timeout)
+        except Exception as e:
+            logging.error(f"❌ Ошибка получения обновлений: {e}")
+            time.sleep(3)
+            continue
+        accept_polled_updates(updates, catch_up)
+        if catch_up and len(updates) < UPDATE_PAGE_SIZE:
+            catch_up = False
+            logging.info("⏩ Очередь обновлений разобрана, переходим к long polling")
+
+# ===== ASYNCIO-ТРАНСПОРТ =====
+
+class AsyncTransport:
+    """asyncio-приём обновлений и доставка outbox на AsyncTeleBot (BOT_ENGINE=asyncio)
+
+    Асинхронны только getUpdates и отправка сообщений outbox: они идут через
+    aiohttp-сессию AsyncTeleBot в одном событийном цикле, и тысячи отправок
+    в полёте не занимают по потоку. Обработчики остаются синхронными: они
+    выполняются в UpdateExecutor и отвечают через синхронный bot. Итоги и
+    обработчики outbox - те же, что у OutboxWorker, а обращения к хранилищу
+    идут в отдельном пуле потоков, чтобы SQLite не блокировал цикл. Нужен
+    пакет aiohttp."""
+
+    def __init__(self, outbox_worker, db_workers=ASYNC_DB_WORKERS):
+        from telebot.async_telebot import AsyncTeleBot
+
+        self.bot = AsyncTeleBot(str(os.getenv('BOT_TOKEN')))
+        self.outbox = outbox_worker
+        self._db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='async-db')
+        self._loop = None
+        self._outbox_event = None
+        outbox_worker.storage.add_outbox_listener(self._wake_outbox)
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._outbox_event = asyncio.Event()
+        # В режиме webhook HTTP-сервер остаётся синхронным и работает в отдельном потоке
+        intake = asyncio.to_thread(run_webhook) if UPDATE_MODE == 'webhook' else self._poll()
+        try:
+            await asyncio.gather(intake, self._deliver_outbox())
+        finally:
+            await self.bot.close_session()
+
+    async def storage(self, fn, *args):
+        """Выполнить обращение к хранилищу в пуле потоков хранилища"""
+        return await self._loop.run_in_executor(self._db_executor, fn, *args)
+
+    async def send_message(self, chat_id, text, **options):
+        """Отправить сообщение с учётом лимитов Telegram и повтором после 429"""
+        attempt = 0
+        while True:
+            await rate_limiter.acquire_async(chat_id)
+            try:
+                return await self.bot.send_message(chat_id, text, **options)
+            except TELEGRAM_API_ERRORS as e:
+                if e.error_code != 429 or attempt >= rate_limiter.max_retries:
+                    raise
+                attempt += 1
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                rate_limiter.record_retry('sendMessage', chat_id, retry_after, attempt)
+
+    async def _poll(self, timeout=20):
+        catch_up = UPDATE_CATCH_UP
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=update_checkpoint.next_offset(), limit=UPDATE_PAGE_SIZE,
+                                                     timeout=0 if catch_up else timeout,
+                                                     request_timeout=timeout + 10)
+            except Exception as e:
+                logging.error(f"❌ Ошибка получения обновлений: {e}")
+                await asyncio.sleep(3)
+                continue
+            # Постановка ждёт при переполненной очереди чата, а сохранение отметки - записи в БД:
+            # обе не в цикле событий
+            await asyncio.to_thread(accept_polled_updates, updates, catch_up)
+            if catch_up and len(updates) < UPDATE_PAGE_SIZE:
+                catch_up = False
+                logging.info("⏩ Очередь обновлений разобрана, переходим к long polling")
+
+    def _wake_outbox(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._outbox_event.set)
+
+    async def _deliver_one(self, messages, chat_id, text, options):
+        try:
+            sent = await self.send_message(chat_id, text, **options)
+        except Exception as e:
+            return OutboxWorker.failure(messages, chat_id, e)
+        return [(message, sent, None, False) for message in messages]
+
+    async def _deliver_outbox(self):
+        while True:
+            self._outbox_event.clear()
+            delivered = 0
+            try:
+                messages = await self.storage(self.outbox.storage.get_due_messages, self.outbox.batch_size)
+                if messages:
+                    deliveries = await asyncio.gather(*(self._deliver_one(*delivery)
+                                                        for delivery in self.outbox.plan(messages)))
+                    await self.storage(self.outbox.finish, [result for results in deliveries for result in results])
+                    delivered = len(messages)
+            except Exception as e:
+                logging.error(f"❌ Ошибка доставки outbox: {e}")
+            if delivered < self.outbox.batch_size:
+                try:
+                    await asyncio.wait_for(self._outbox_event.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+def create_async_transport():
+    """AsyncTransport для BOT_ENGINE=asyncio или None, если aiohttp не установлен"""
+    try:
+        return AsyncTransport(outbox)
+    except ImportError as e:
+        logging.error(f"❌ BOT_ENGINE=asyncio требует пакет aiohttp ({e}); работаем в потоковом режиме")
+        return None
+
+# ===== WEBHOOK =====
+
+def webhook_secret():
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+
+    Если WEBHOOK_SECRET не задан, он выводится из токена бота: так секрет
+    одинаков между перезапусками и не хранится отдельно."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{os.getenv('BOT_TOKEN')}".encode()).hexdigest()
+
+def dispatch_update(update):
+    """Передать обновление обработчикам бота (вызывается в потоке UpdateExecutor)"""
+    bot.process_new_updates([update])
+
+def create_webhook_app(secret, path=WEBHOOK_PATH, submit=None):
+    """WSGI-приложение, принимающее обновления Telegram
+
+    Проверяет секретный заголовок, разбирает обновление и сразу отвечает 200:
+    обработка идёт в очереди чата (UpdateExecutor), и медленный обработчик не задерживает
+    ответ (иначе Telegram повторит доставку). GET / - проверка живости для
+    балансировщика платформы."""
+    from werkzeug.wrappers import Request, Response
+
+    @Request.application
+    def app(request):
+        if request.path == '/' and request.method in ('GET', 'HEAD'):
+            return Response('ok')
+        if request.path != path:
+            return Response('not found', status=404)
+        if request.method != 'POST':
+            return Response('method not allowed', status=405)
+
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, secret):
+            logging.warning(f"⚠️ Webhook: запрос с неверным секретом от {request.remote_addr}")
+            return Response('forbidden', status=403)
+
+        if (request.content_length or 0) > WEBHOOK_MAX_BODY:
+            return Response('payload too large', status=413)
+        try:
+            update = types.Update.de_json(request.get_data(as_text=True))
+        except Exception as e:
+            logging.error(f"❌ Webhook: не удалось разобрать обновление: {e}")
+            return Response('bad request', status=400)
+
+        (submit or submit_update)(update)
+        return Response('ok')
+
+    return app
+
+def run_webhook():
+    """Зарегистрировать webhook и обслуживать его встроенным HTTP-сервером"""
+    from werkzeug.serving import make_server
+
+    if not WEBHOOK_URL:
+        raise RuntimeError("UPDATE_MODE=webhook требует WEBHOOK_URL")
+
+    secret = webhook_secret()
+    server = make_server(WEBHOOK_HOST, WEBHOOK_PORT, create_webhook_app(secret), threaded=True)
+
+    # Сервер уже слушает порт, поэтому первые обновления после регистрации не теряются
+    url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+    bot.set_webhook(url=url, secret_token=secret, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    print(f"🌐 Webhook зарегистрирован: {url}, слушаем {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+# ===== ЗАМЕР МАРШРУТИЗАЦИИ =====
+
+def legacy_routing_bot(storage, handler):
+    """Бот с прежней цепочкой регистраций telebot: предикаты проверяются по порядку
+
+    Порядок повторяет прежний main.py: команды, обычное сообщение в группе,
+    кнопки и ввод по состоянию пользователя."""
+    legacy = telebot.TeleBot(bot.token, threaded=False)
+    group = lambda message: message.chat.type in ['group', 'supergroup']
+    state = lambda message: storage.get_user_state(message.from_user.id)[0]
+    for name in router._commands:
+        legacy.message_handler(commands=[name])(handler)
+    legacy.message_handler(func=lambda message: True, content_types=['new_chat_members'])(handler)
+    legacy.message_handler(func=lambda message:
+                           group(message) and
+                           not message.text.startswith('/') and
+                           message.text not in ['❌ Отсутствую', '📊 Получить отчёт'] and
+                           state(message) is None)(handler)
+    legacy.message_handler(func=lambda message: message.text == '❌ Отсутствую')(handler)
+    legacy.message_handler(func=lambda message:
+                           group(message) and
+                           message.text != '📊 Получить отчёт' and
+                           state(message) == 'waiting_for_custom_reason')(handler)
+    for text in router._buttons:
+        if text != '❌ Отсутствую':
+            legacy.message_handler(func=lambda message, text=text: message.text == text)(handler)
+    legacy.message_handler(func=lambda message:
+                           message.chat.type == 'private' and
+                           state(message) == 'waiting_for_admin_removal')(handler)
+    legacy.callback_query_handler(func=lambda call: call.data.startswith('reason_'))(handler)
+    legacy.callback_query_handler(func=lambda call: call.data == 'exit_absence')(handler)
+    legacy.callback_query_handler(func=lambda call: call.data.startswith('approve_'))(handler)
+    return legacy
+
+def bench_routing(iterations=2000):
+    """Сравнить стоимость выбора обработчика на обновление: цепочка предикатов и UpdateRouter
+
+    Обработчики пустые, хранилище - MemoryDatabase, поэтому замер показывает
+    только маршрутизацию внутри process_new_updates."""
+    storage = MemoryDatabase()
+    storage.set_user_state(3, 'waiting_for_custom_reason')
+    storage.set_user_state(4, 'waiting_for_admin_removal')
+    calls = []
+    handler = lambda update: calls.append(update)
+
+    legacy = legacy_routing_bot(storage, handler)
+    routed = telebot.TeleBot(bot.token, threaded=False)
+    router.with_handler(handler, storage).attach(routed)
+
+    def message(user_id, chat_id, text):
+        chat_type = 'private' if chat_id > 0 else 'supergroup'
+        return types.Update.de_json({'update_id': 1, 'message': {
+            'message_id': 1, 'date': 0, 'text': text,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat': {'id': chat_id, 'type': chat_type}}})
+
+    def callback(user_id, data):
+        return types.Update.de_json({'update_id': 1, 'callback_query': {
+            'id': '1', 'chat_instance': '1', 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'message': {'message_id': 1, 'date': 0, 'text': 'bench',
+                        'chat': {'id': user_id, 'type': 'private'}}}})
+
+    samples = [
+        ("Сообщение в группе", message(2, -100, 'привет')),
+        ("Кнопка '❌ Отсутствую'", message(2, -100, '❌ Отсутствую')),
+        ("Причина 'Другое'", message(3, -100, 'к врачу')),
+        ("Кнопка 'ℹ️ Информация'", message(2, 2, 'ℹ️ Информация')),
+        ("Команда /delete", message(2, -100, '/delete 5')),
+        ("Ввод номера админа", message(4, 4, '1')),
+        ("Нажатие approve_", callback(5, 'approve_respectful_1')),
+    ]
+
+    print(f"{'Обновление':<26}{'было, мкс':>12}{'стало, мкс':>12}")
+    for name, update in samples:
+        results = []
+        for target in (legacy, routed):
+            calls.clear()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                target.process_new_updates([update])
+            elapsed = time.perf_counter() - started
+            assert len(calls) == iterations, f"{name}: обработчик не вызван"
+            results.append(elapsed / iterations * 1e6)
+        print(f"{name:<26}{results[0]:>12.1f}{results[1]:>12.1f}")
+    storage.close()
+
 # Запуск бота
 if __name__ == '__main__':
-    print("🤖 Telegram Bot - Русская версия")
-    print("🟢 Запускаем планировщик отчётов...")
+    # python main.py explain - планы выполнения запросов к БД
+    if len(sys.argv) > 1 and sys.argv[1] == 'explain':
+        print_query_plans()
+        sys.exit(0)
+
+    # python main.py bench-routing - стоимость выбора обработчика обновления до и после UpdateRouter
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-routing':
+        bench_routing()
+        sys.exit(0)
 
+    # python main.py archive - разовый перенос закрытых дней в архив
+    if len(sys.argv) > 1 and sys.argv[1] == 'archive':
+        db.archive_closed_days()
+        sys.exit(0)
 
+    print("🤖 Telegram Bot - Русская версия")
+    print("🟢 Запускаем архивацию закрытых дней...")
+    ArchiveJob(db).start()
+    print("🟢 Запускаем доставку сообщений из outbox...")
+    # С asyncio-транспортом outbox доставляет AsyncTransport
+    transport = create_async_transport() if BOT_ENGINE == 'asyncio' else None
+    if transport is None:
+        outbox.start()
+        atexit.register(outbox.stop)
+    print("🟢 Запускаем живые отчёты...")
+    live_reports.start()
+    print("🟢 Запускаем планировщик отчётов...")
+    report_scheduler.start()
 
     print("🟢 Запускаем бота...")
-    run_bot_with_restart()
+    run_bot_with_restart(transport)
 
 
@@ -0,0 +1,33 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+# main.py читает настройки при импорте: токен-заглушка и хранилище в памяти,
+# чтобы импорт не создавал attendance_bot.db в рабочем каталоге
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path):
+    """Пустое хранилище каждой реализации"""
+    if request.param == 'sqlite':
+        storage = main.Database(str(tmp_path / 'bot.db'))
+    else:
+        storage = main.MemoryDatabase()
+    yield storage
+    storage.close()
+
+
+def fixed_date(day):
+    """Подмена datetime.date, у которой today() возвращает day"""
+    class FixedDate(date):
+        @classmethod
+        def today(cls):
+            return day
+    return FixedDate
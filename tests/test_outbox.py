@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import pytest
+from telebot import apihelper
+
+import main
+
+
+def api_error(code, description):
+    return apihelper.ApiTelegramException(
+        'sendMessage', None, {'ok': False, 'error_code': code, 'description': description})
+
+
+@pytest.fixture
+def outbox():
+    """Outbox на хранилище в памяти; отправку тест задаёт в outbox.send"""
+    outbox = SimpleNamespace(storage=main.MemoryDatabase(), send=None)
+    outbox.worker = main.OutboxWorker(outbox.storage, lambda chat_id, text, **options: outbox.send(chat_id, text))
+    yield outbox
+    outbox.worker.stop()
+    outbox.storage.close()
+
+
+@pytest.mark.parametrize('error, permanent', [
+    (api_error(403, 'Forbidden: bot was blocked by the user'), True),
+    (api_error(400, 'Bad Request: chat not found'), True),
+    (api_error(429, 'Too Many Requests: retry after 5'), False),
+    (api_error(500, 'Internal Server Error'), False),
+    (ConnectionError('Connection reset by peer'), False),
+])
+def test_failure_classification(error, permanent):
+    message = {'id': 1}
+    assert main.OutboxWorker.failure([message], 42, error) == [(message, None, str(error), permanent)]
+
+
+def test_async_api_errors_are_classified():
+    asyncio_helper = pytest.importorskip('telebot.asyncio_helper')
+    error = asyncio_helper.ApiTelegramException(
+        'sendMessage', None, {'ok': False, 'error_code': 403, 'description': 'Forbidden'})
+    assert main.OutboxWorker.failure([{'id': 1}], 42, error)[0][3] is True
+
+
+def test_permanent_error_goes_to_dead_letter(outbox):
+    def send(chat_id, text):
+        raise api_error(403, 'Forbidden: bot was blocked by the user')
+    outbox.send = send
+    dead = []
+    outbox.worker.on_dead('notice', lambda message, error: dead.append((message['chat_id'], error)))
+    outbox.storage.enqueue_messages([{'chat_id': 42, 'text': 'привет', 'kind': 'notice'}])
+
+    assert outbox.worker.deliver_due() == 1
+    assert len(dead) == 1 and dead[0][0] == 42
+    assert outbox.storage.get_due_messages() == []
+
+
+def test_transient_error_is_retried(outbox, monkeypatch):
+    attempts = []
+
+    def send(chat_id, text):
+        attempts.append(chat_id)
+        if len(attempts) == 1:
+            raise api_error(500, 'Internal Server Error')
+    outbox.send = send
+    dead, sent = [], []
+    outbox.worker.on_dead('notice', lambda message, error: dead.append(message))
+    outbox.worker.on_sent('notice', lambda message, result: sent.append(message))
+    outbox.storage.enqueue_messages([{'chat_id': 42, 'text': 'привет', 'kind': 'notice'}])
+
+    assert outbox.worker.deliver_due() == 1
+    assert dead == [] and sent == []
+    # Повтор назначен с задержкой: сейчас сообщение не к отправке
+    assert outbox.storage.get_due_messages() == []
+
+    now = main.time.time()
+    monkeypatch.setattr(main.time, 'time', lambda: now + 24 * 3600)
+    assert outbox.worker.deliver_due() == 1
+    assert len(attempts) == 2 and len(sent) == 1 and dead == []
@@ -0,0 +1,252 @@
+import time
+from datetime import date
+
+import main
+from conftest import fixed_date
+
+
+def expect(actual, expected, what):
+    assert actual == expected, f"{what}: ожидалось {expected!r}, получено {actual!r}"
+
+
+def test_storage_conformance(storage, monkeypatch):
+    """Хранилище ведёт себя так, как ожидают обработчики
+
+    Один и тот же сценарий для каждой реализации Storage на пустом хранилище."""
+
+    user_id, other_id, chat_id, other_chat_id = 101, 102, -201, -202
+    changes = []
+    storage.add_absence_listener(changes.append)
+
+    # Состояния и служебные значения
+    expect(storage.get_user_state(user_id), (None, None), "состояние по умолчанию")
+    storage.set_user_state(user_id, 'waiting_for_reason', {'group_chat_id': chat_id})
+    expect(storage.get_user_state(user_id), ('waiting_for_reason', {'group_chat_id': chat_id}), "состояние с данными")
+    storage.set_user_state(user_id, 'waiting_for_fio')
+    expect(storage.get_user_state(user_id), ('waiting_for_fio', None), "состояние без данных")
+    storage.clear_user_state(user_id)
+    expect(storage.get_user_state(user_id), (None, None), "очищенное состояние")
+    expect(storage.get_last_update_id(), 0, "last_update_id по умолчанию")
+    storage.save_last_update_id(42)
+    expect(storage.get_last_update_id(), 42, "сохранённый last_update_id")
+
+    # Пользователи и username
+    expect(storage.get_user_fio(user_id), None, "ФИО незарегистрированного")
+    storage.register_user(user_id, 'Иванов Иван')
+    storage.register_user(user_id, 'Иванов Иван Иванович')
+    expect(storage.get_user_fio(user_id), 'Иванов Иван Иванович', "ФИО после повторной регистрации")
+    expect(storage.get_user_fios([user_id, other_id, user_id]),
+           {user_id: 'Иванов Иван Иванович', other_id: None}, "пакетное получение ФИО")
+    expect(storage.update_username('Ivanov', user_id), True, "новый username")
+    expect(storage.update_username('ivanov', user_id), False, "тот же username")
+    expect(storage.update_username(None, user_id), False, "пустой username")
+    expect(storage.get_user_id_by_username('IVANOV'), user_id, "поиск username без учёта регистра")
+    expect(storage.get_user_id_by_username('nobody'), None, "неизвестный username")
+
+    # Отметки за сегодня
+    del changes[:]
+    storage.add_absence(user_id, 'уважительно', '📋 Приказ на весь день', chat_id)
+    expect(bool(changes), True, "уведомление об изменении отсутствий")
+    expect(storage.get_today_absences(chat_id),
+           [('Иванов Иван Иванович', 'уважительно', '📋 Приказ на весь день', user_id)], "отчёт группы")
+    expect(storage.get_today_absences(other_chat_id), [], "отчёт другой группы")
+    expect(len(storage.get_today_absences()), 1, "отчёт по всем группам")
+    storage.add_absence(user_id, 'неуважительно', 'проспал', chat_id)
+    expect(storage.get_today_absences(chat_id),
+           [('Иванов Иван Иванович', 'неуважительно', 'проспал', user_id)], "повторная отметка заменяет прежнюю")
+    storage.add_absence(user_id, 'уважительно', '📋 Приказ на весь день', chat_id)
+    expect(storage.get_today_absences_for_groups([chat_id, other_chat_id]),
+           {chat_id: storage.get_today_absences(chat_id), other_chat_id: []}, "отчёт по нескольким группам")
+    storage.remove_absence_from_today(user_id)
+    expect(storage.get_today_absences(chat_id), [], "удалённая отметка")
+
+    # Активное отсутствие заменяет отметки и выводится в отчёте
+    storage.add_absence(user_id, 'неуважительно', 'проспал', chat_id)
+    storage.set_user_state(user_id, 'waiting_for_reason')
+    storage.start_active_absence(user_id, '🤒 Болею', chat_id)
+    expect(storage.get_user_state(user_id), (None, None), "состояние после начала отсутствия")
+    expect(storage.get_today_absences(chat_id),
+           [('Иванов Иван Иванович', 'уважительно', 'болеет', user_id)], "активное отсутствие в отчёте")
+    storage.set_active_absence_message(user_id, 555, user_id)
+    active = storage.get_active_absence(user_id)
+    expect(active[1:], (user_id, '🤒 Болею', 555, user_id, chat_id), "активное отсутствие")
+    expect(storage.get_all_active_absences(), [(user_id, '🤒 Болею', 'Иванов Иван Иванович')], "все активные")
+    expect(storage.end_active_absence(user_id), active, "завершение отсутствия")
+    expect(storage.end_active_absence(user_id), None, "повторное завершение")
+    expect(storage.get_today_absences(chat_id), [], "отчёт после выхода")
+    storage.add_active_absence(other_id, '😎 Отпуск', 1, other_id, other_chat_id)
+    expect(storage.get_active_absence(other_id)[1:], (other_id, '😎 Отпуск', 1, other_id, other_chat_id),
+           "добавленное активное отсутствие")
+    storage.remove_active_absence(other_id)
+    expect(storage.get_active_absence(other_id), None, "удалённое активное отсутствие")
+
+    # mark_absent заменяет всё, cancel_absence всё убирает
+    storage.start_active_absence(user_id, '😎 Отпуск', chat_id)
+    storage.set_user_state(user_id, 'waiting_for_reason')
+    storage.mark_absent(user_id, 'уважительно', '🎖️ Военкомат', chat_id)
+    expect(storage.get_active_absence(user_id), None, "активное отсутствие после отметки")
+    expect(storage.get_user_state(user_id), (None, None), "состояние после отметки")
+    expect(storage.get_today_absences(chat_id),
+           [('Иванов Иван Иванович', 'уважительно', '🎖️ Военкомат', user_id)], "отметка вместо отсутствия")
+    storage.cancel_absence(user_id)
+    expect(storage.get_today_absences(chat_id), [], "отчёт после /delete")
+
+    # Причина "Другое" и её утверждение
+    storage.set_user_state(user_id, 'waiting_for_custom_reason')
+    pending_id = storage.submit_custom_reason(user_id, 'к врачу', chat_id)
+    expect(storage.get_user_state(user_id), (None, None), "состояние после причины")
+    pending = storage.get_pending_absence(pending_id)
+    expect((pending[0], pending[1], pending[2], pending[4], pending[6]),
+           (pending_id, user_id, 'к врачу', chat_id, 'Иванов Иван Иванович'), "ожидающая причина")
+    expect(storage.approve_pending(pending_id, 'уважительно'), pending, "утверждение причины")
+    expect(storage.approve_pending(pending_id, 'неуважительно'), None, "повторное утверждение")
+    expect(storage.get_today_absences(chat_id),
+           [('Иванов Иван Иванович', 'уважительно', 'к врачу', user_id)], "утверждённая причина")
+    pending_id = storage.add_pending_absence(other_id, 'проверка', chat_id)
+    storage.delete_pending_absence(pending_id)
+    expect(storage.get_pending_absence(pending_id), None, "удалённая причина")
+
+    # Архив не трогает сегодняшний день
+    expect(storage.archive_closed_days(), {}, "архивация без закрытых дней")
+    expect(len(storage.get_today_absences(chat_id)), 1, "сегодняшние отметки после архивации")
+    expect(storage.get_group_month_stats(chat_id, '2000-01'), ([], []), "пустая сводка группы")
+    expect(storage.get_user_month_stats(chat_id, '2000-01'), [], "пустая сводка пользователей")
+
+    # Закрытый день уходит в архив и попадает в сводки месяца
+    with monkeypatch.context() as patch:
+        patch.setattr(main, 'date', fixed_date(date(2020, 1, 5)))
+        storage.add_absence(other_id, 'неуважительно', 'проспал', chat_id)
+    expect(storage.archive_closed_days(), {'2020-01': 1}, "архивация закрытого дня")
+    expect(storage.archive_closed_days(), {}, "повторная архивация")
+    expect(len(storage.get_today_absences(chat_id)), 1, "сегодняшние отметки после архивации закрытого дня")
+    expect(storage.get_group_month_stats(chat_id, '2020-01'),
+           ([('неуважительно', 1, 1)], [('проспал', 1)]), "сводка группы за архивный месяц")
+    expect(storage.get_user_month_stats(chat_id, '2020-01'),
+           [(other_id, None, 'неуважительно', 1)], "сводка пользователей за архивный месяц")
+
+    # Администраторы
+    storage.set_admin(user_id)
+    storage.set_admin(user_id)
+    expect(storage.get_admin_ids(), [user_id], "администраторы")
+    expect(storage.get_report_schedule(), [('admin', user_id, '09:00')], "время отчёта по умолчанию")
+    storage.set_admin_report_time(user_id, '08:30')
+    storage.set_group_report_time(chat_id, '10:15')
+    expect(sorted(storage.get_report_schedule()), [('admin', user_id, '08:30'), ('group', chat_id, '10:15')],
+           "расписание отчётов")
+    storage.set_group_report_time(chat_id, None)
+    expect(storage.get_report_schedule(), [('admin', user_id, '08:30')], "отключение отчёта в группу")
+    expect(storage.get_bot_state('probe'), None, "служебное значение по умолчанию")
+    storage.set_bot_state('probe', 1.5)
+    expect(storage.get_bot_state('probe'), '1.5', "служебное значение")
+    storage.remove_admin(user_id)
+    expect(storage.get_admin_ids(), [], "администраторы после удаления")
+
+    # Привязка группы ключом активации
+    storage.add_pending_bind(chat_id, user_id, 'ИС-21')
+    storage.add_activation_key('conformance', chat_id, other_id)
+    expect(storage.get_activation_key('conformance'), (chat_id, other_id, 0), "новый ключ")
+    expect(storage.get_activation_key('missing'), None, "неизвестный ключ")
+    expect(storage.use_activation_key('conformance', chat_id), 'ИС-21', "название из /start_bind")
+    expect(storage.get_activation_key('conformance'), (chat_id, other_id, 1), "использованный ключ")
+    expect(storage.get_group_name(chat_id), 'ИС-21', "название группы")
+    storage.update_group_name(chat_id, 'ИС-22')
+    storage.update_group_name(other_chat_id, 'нет такой группы')
+    expect(storage.get_group_name(chat_id), 'ИС-22', "новое название группы")
+    expect(storage.get_group_name(other_chat_id), None, "название непривязанной группы")
+
+    expect(storage.add_group_admin(chat_id, other_id), True, "добавление администратора группы")
+    expect(storage.add_group_admin(chat_id, other_id), True, "повторное добавление администратора")
+    storage.add_group_admin(chat_id, user_id)
+    expect(storage.get_group_admins(chat_id), [user_id, other_id], "администраторы группы")
+    expect(storage.is_group_admin(chat_id, other_id), True, "проверка прав")
+    expect(storage.is_group_admin(other_chat_id, other_id), False, "проверка прав в чужой группе")
+    expect(storage.get_admin_groups(other_id), [(chat_id, 'ИС-22')], "группы администратора")
+    expect(storage.get_all_group_admins(), [(chat_id, 'ИС-22', user_id), (chat_id, 'ИС-22', other_id)],
+           "все администраторы групп")
+    expect(storage.remove_group_admin(chat_id, other_id), True, "удаление администратора группы")
+    expect(storage.get_admin_groups(other_id), [], "группы после удаления")
+
+    # Outbox: постановка вместе с изменением данных, дедупликация, повторы и dead-letter
+    wakeups = []
+    storage.add_outbox_listener(lambda: wakeups.append(True))
+    absence_id = storage.start_active_absence(user_id, '🤒 Болею', chat_id, messages=lambda absence_id: [
+        {'chat_id': user_id, 'text': 'выход', 'kind': 'exit_prompt', 'dedup_key': f'exit:{absence_id}',
+         'payload': {'absence_id': absence_id}, 'options': {'parse_mode': 'Markdown'}},
+    ])
+    expect(storage.get_active_absence(user_id)[0], absence_id, "ID активного отсутствия")
+    expect(bool(wakeups), True, "уведомление о новых сообщениях outbox")
+    expect(storage.enqueue_messages([{'chat_id': user_id, 'text': 'дубль', 'dedup_key': f'exit:{absence_id}'},
+                                     {'chat_id': other_id, 'text': 'админу'}]), 1, "дедупликация outbox")
+    due = storage.get_due_messages()
+    expect([(m['chat_id'], m['text'], m['kind'], m['payload'], m['options'], m['attempts']) for m in due],
+           [(user_id, 'выход', 'exit_prompt', {'absence_id': absence_id}, {'parse_mode': 'Markdown'}, 0),
+            (other_id, 'админу', None, {}, {}, 0)], "сообщения к доставке")
+    expect(storage.record_deliveries([(due[0]['id'], None, False), (due[1]['id'], 'timeout', False)]),
+           {due[0]['id']: 'sent', due[1]['id']: 'pending'}, "итоги доставки")
+    expect(storage.get_due_messages(), [], "повтор после задержки")
+    expect(storage.record_deliveries([(due[1]['id'], 'Forbidden', True)]), {due[1]['id']: 'dead'}, "dead-letter")
+    storage.set_active_absence_message(user_id, 777, user_id, absence_id=absence_id + 1000)
+    expect(storage.get_active_absence(user_id)[3], None, "сообщение чужого отсутствия не привязывается")
+    storage.set_active_absence_message(user_id, 777, user_id, absence_id=absence_id)
+    expect(storage.get_active_absence(user_id)[3], 777, "привязка сообщения к отсутствию")
+    ended = storage.end_active_absence(user_id, messages=lambda absence: [
+        {'chat_id': other_id, 'text': f'вернулся {absence[2]}', 'dedup_key': f'back:{absence[0]}'},
+    ])
+    expect([m['text'] for m in storage.get_due_messages()], [f'вернулся {ended[2]}'], "сообщение о выходе")
+    pending_id = storage.submit_custom_reason(user_id, 'к врачу', chat_id, messages=lambda pending_id: [
+        {'chat_id': other_id, 'text': f'запрос {pending_id}'},
+    ])
+    expect([m['text'] for m in storage.get_due_messages()][-1], f'запрос {pending_id}', "запрос на подтверждение")
+    expect(storage.purge_outbox(days=0) >= 0, True, "очистка outbox")
+
+    # Сводка уведомлений: отложенные сообщения и их досрочная отправка
+    storage.set_notify_mode(other_id, 'digest')
+    expect(storage.get_notify_mode(other_id), 'digest', "режим уведомлений")
+    expect(storage.get_notify_mode(user_id), 'instant', "режим уведомлений по умолчанию")
+    storage.enqueue_messages([{'chat_id': other_id, 'text': 'в сводку', 'kind': 'digest',
+                               'not_before': time.time() + 3600}])
+    def due_digest():
+        return [m['text'] for m in storage.get_due_messages() if m['kind'] == 'digest']
+    expect(due_digest(), [], "сводка до конца окна")
+    storage.enqueue_messages([{'chat_id': other_id, 'text': 'срочно', 'kind': 'digest', 'flush_digest': True}])
+    expect(due_digest(), ['в сводку', 'срочно'], "досрочная отправка сводки")
+
+    # Живой отчёт
+    expect(storage.get_live_report_groups(), [], "живой отчёт выключен по умолчанию")
+    expect(storage.get_live_report_message(chat_id), None, "сообщения живого отчёта ещё нет")
+    storage.set_live_report(chat_id, True)
+    storage.set_live_report_message(chat_id, '2000-01-01', 55)
+    expect(storage.get_live_report_groups(), [chat_id], "включение живого отчёта")
+    storage.set_live_report(chat_id, False)
+    expect(storage.get_live_report_groups(), [], "выключение живого отчёта")
+    expect(storage.get_live_report_message(chat_id), ('2000-01-01', 55), "сообщение дня после выключения")
+
+
+def test_archive_moves_closed_days(storage, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(main, 'date', fixed_date(date(2020, 1, 5)))
+        storage.add_absence(1, 'неуважительно', 'проспал', -10)
+        storage.add_absence(2, 'уважительно', 'к врачу', -10)
+        patch.setattr(main, 'date', fixed_date(date(2020, 2, 3)))
+        storage.add_absence(1, 'уважительно', 'к врачу', -10)
+    storage.add_absence(3, 'уважительно', 'сегодня', -10)
+
+    assert storage.archive_closed_days() == {'2020-01': 2, '2020-02': 1}
+    assert storage.archive_closed_days() == {}
+    assert [row[3] for row in storage.get_today_absences(-10)] == [3]
+    assert storage.get_group_month_stats(-10, '2020-01') == (
+        [('неуважительно', 1, 1), ('уважительно', 1, 1)], [('к врачу', 1), ('проспал', 1)])
+    assert storage.get_user_month_stats(-10, '2020-02') == [(1, None, 'уважительно', 1)]
+
+
+def test_incomplete_storage_is_not_instantiable():
+    class Partial(main.Storage):
+        def close(self):
+            pass
+
+    try:
+        Partial()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("реализация без методов интерфейса создана")
@@ -0,0 +1,111 @@
+import itertools
+import json
+import time
+
+import pytest
+from telebot import types
+
+import main
+
+call_ids = itertools.count(1)
+
+
+def test_checkpoint_waits_for_unfinished_updates():
+    storage = main.MemoryDatabase()
+    checkpoint = main.UpdateCheckpoint(storage)
+    assert checkpoint.next_offset() is None
+    for update_id in (1, 2, 3):
+        checkpoint.accept(update_id)
+
+    checkpoint.done(3)
+    checkpoint.done(2)
+    assert checkpoint.watermark == 0 and checkpoint.next_offset() is None
+    # Telegram повторяет неподтверждённые обновления; принятые отбрасываются
+    assert not checkpoint.is_new(2) and checkpoint.is_new(4)
+
+    checkpoint.done(1)
+    assert checkpoint.watermark == 3 and checkpoint.next_offset() == 4
+    checkpoint.save()
+    assert storage.get_last_update_id() == 3
+    assert main.UpdateCheckpoint(storage).next_offset() == 4
+
+
+def test_checkpoint_skipped_update_does_not_hold_watermark():
+    checkpoint = main.UpdateCheckpoint(main.MemoryDatabase())
+    checkpoint.accept(1)
+    checkpoint.accept(2, skip=True)
+    assert checkpoint.watermark == 0
+    checkpoint.done(1)
+    assert checkpoint.next_offset() == 3
+
+
+def test_stale_checkpoint_is_ignored():
+    storage = main.MemoryDatabase()
+    storage.save_last_update_id(100)
+    storage.set_bot_state(main.UpdateCheckpoint.STATE_KEY, time.time() - main.UpdateCheckpoint.CHECKPOINT_MAX_AGE - 1)
+    assert main.UpdateCheckpoint(storage).next_offset() is None
+
+
+def callback_query(data='approve_1'):
+    return types.CallbackQuery.de_json(json.dumps({
+        'id': str(next(call_ids)), 'chat_instance': '1', 'data': data,
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'Админ'},
+    }))
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """Ответы на нажатия: [(callback_query_id, text)]"""
+    answers = []
+    monkeypatch.setattr(main, 'callback_results', main.IdempotencyCache())
+    monkeypatch.setattr(main.bot, 'answer_callback_query', lambda call_id, text=None: answers.append((call_id, text)))
+    return answers
+
+
+def test_repeated_callback_runs_operation_once(answers):
+    calls = []
+
+    @main.idempotent_callback(lambda call: f"approve:{call.data}")
+    def handler(call):
+        calls.append(call.id)
+        return main.CallbackAnswer("✅ Одобрено", repeat_text="Уже одобрено")
+
+    first, second = callback_query(), callback_query()
+    handler(first)
+    handler(second)
+    handler(first)
+    assert calls == [first.id]
+    assert answers == [(first.id, "✅ Одобрено"), (second.id, "Уже одобрено"), (first.id, "Уже одобрено")]
+
+
+def test_non_final_callback_answer_is_not_cached(answers):
+    calls = []
+
+    @main.idempotent_callback(lambda call: f"approve:{call.data}")
+    def handler(call):
+        calls.append(call.id)
+        return main.CallbackAnswer("❌ Нет прав", final=False)
+
+    first, second = callback_query(), callback_query()
+    handler(first)
+    handler(second)
+    assert calls == [first.id, second.id]
+    assert [text for _, text in answers] == ["❌ Нет прав", "❌ Нет прав"]
+
+
+def test_failed_callback_releases_operation(answers):
+    calls = []
+
+    @main.idempotent_callback(lambda call: f"approve:{call.data}")
+    def handler(call):
+        calls.append(call.id)
+        if len(calls) == 1:
+            raise RuntimeError('database is locked')
+        return main.CallbackAnswer("✅ Одобрено")
+
+    first, second = callback_query(), callback_query()
+    with pytest.raises(RuntimeError):
+        handler(first)
+    handler(second)
+    assert calls == [first.id, second.id]
+    assert answers == [(second.id, "✅ Одобрено")]